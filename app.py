@@ -1,90 +1,489 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g, Response, abort, stream_with_context, has_request_context
+from datetime import datetime, date
 import sqlite3
 import os
+import time
+from pathlib import Path
+import zlib
+import atexit
+import click
 from functools import wraps
+from db import ConnectionPool, ReadRouter, SchemaBootstrap, configure_sqlite
+from migrations import migrate
+from tokens import TokenAllocator
+from events import Broadcaster, sse_stream
+from queue_query import parse_queue_args, fetch_queue_page
+from queue_engine import QueueEngine
+from archive import Archiver, fetch_history_page
+from stats import QueueStats
+from rollups import HourlyRollups, parse_report_args
+from search import parse_search_args, search_patients
+from export import FORMATS, ExportStream, parse_export_args, export_filename
+from bulk import BulkError, parse_bulk_body, validate_row, register_patients
+from metrics import Metrics, instrument_app, instrument_connection, timed_acquire, pool_gauges
+from queue_json import RowCache, dumps, encode_array, stream_rows
+from page_cache import PageCache
+from changes import ChangeWatcher, apply_changes
+from write_behind import WriteBehindQueue, QueueFull, WriteFailed
+from wait_times import WaitEstimator, WARM_START_ROWS, wait_encoder, wait_rates
+from timestamps import now_ms, format_time, format_times
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-in-production'
 
+# Per-route, per-statement and pool wait timings served at /metrics
+metrics = Metrics(enabled=os.environ.get('METRICS_ENABLED', '1') == '1')
+instrument_app(app, metrics)
+
+# SQLite database file and connection pool settings
+DATABASE = os.environ.get('HOSPITAL_DB', 'hospital.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+
+# Optional read replica for the public queue reads (/queue and /api/queue):
+# HOSPITAL_READ_DB names a copy of the database, e.g. one kept fresh by
+# `flask --app app refresh-replica`. A copy more than DB_READ_MAX_LAG seconds
+# behind the primary, or behind the session's own last write, is skipped
+READ_DATABASE = os.environ.get('HOSPITAL_READ_DB')
+DB_READ_MAX_LAG = float(os.environ.get('DB_READ_MAX_LAG', 2))
+
+# Production storage profile, applied to every connection: WAL lets readers
+# run while a registration writes, synchronous=NORMAL is durable across app
+# crashes under WAL, busy_timeout waits for the write lock instead of
+# failing with "database is locked", mmap/cache keep hot pages in memory
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),
+    'temp_store': 'MEMORY'
+}
+
+# WRITE_BEHIND=1 answers /register as soon as the token is allocated and
+# commits queued registrations in batches from a background thread
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND') == '1'
+
+# Token numbering: TOKEN_DAILY_RESET=1 restarts every department at 001 each
+# day, TOKEN_BLOCK_SIZE > 1 lets busy kiosks reserve numbers in memory
+# (write-behind reserves 50 at a time by default so /register never commits)
+token_allocator = TokenAllocator(
+    'sqlite',
+    daily_reset=os.environ.get('TOKEN_DAILY_RESET') == '1',
+    block_size=int(os.environ.get('TOKEN_BLOCK_SIZE', 50 if WRITE_BEHIND else 1))
+)
+
+# In-memory view of waiting/in-consultation patients for the dashboard
+queue_engine = QueueEngine()
+
+# Moving averages behind estimated_wait_minutes; DEFAULT_CONSULTATION_MINUTES
+# is assumed until a department has completed a consultation
+wait_estimator = WaitEstimator(default_minutes=float(os.environ.get('DEFAULT_CONSULTATION_MINUTES', 10)))
+
+# Per-department gauges and per-day counters, maintained by each write
+queue_stats = QueueStats('sqlite')
+
+# Per-hour report aggregates, updated as each patient completes
+hourly_rollups = HourlyRollups('sqlite')
+
+# Fans queue change events out to /api/queue/stream subscribers
+broadcaster = Broadcaster()
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))
+
+# Rendered /queue pages, keyed by queue version and dropped on every write
+page_cache = PageCache()
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Create patients table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            token_no TEXT NOT NULL,
-            name TEXT NOT NULL,
-            department TEXT NOT NULL,
-            symptoms TEXT NOT NULL,
-            status TEXT DEFAULT 'Waiting',
-            time_in TEXT NOT NULL,
-            time_out TEXT
-        )
-    ''')
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL
-        )
-    ''')
-    
-    # Insert default doctor user if not exists
-    cursor.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('doctor',))
-    if cursor.fetchone()[0] == 0:
-        cursor.execute('''
-            INSERT INTO users (username, password, role) 
-            VALUES (?, ?, ?)
-        ''', ('doctor', 'doctor123', 'doctor'))
-    
-    conn.commit()
+    """Bring the schema up to date (a single PRAGMA read when nothing is pending)"""
+    conn = sqlite3.connect(DATABASE)
+    configure_sqlite(conn, SQLITE_PRAGMAS)
+    migrate(conn)
     conn.close()
 
-# Initialize database on startup
-init_db()
+# The schema is set up by the first request or CLI command rather than at
+# import, so importing the app or forking workers touches no database
+schema = SchemaBootstrap(init_db)
 
-def get_db_connection():
-    conn = sqlite3.connect('hospital.db')
+def create_app(bootstrap=False):
+    """Return the app, setting up the schema now with bootstrap=True instead of on first use"""
+    if bootstrap:
+        schema.ensure()
+    return app
+
+def _open_sqlite():
+    """Open a configured SQLite connection"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return configure_sqlite(conn, SQLITE_PRAGMAS)
+
+def _connect():
+    """Open a new SQLite connection for the pool"""
+    return instrument_connection(_open_sqlite(), metrics)
+
+pool = ConnectionPool(_connect, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, name='sqlite')
+
+def _connect_replica():
+    """Open a new read-only connection to the replica copy for the read pool"""
+    conn = sqlite3.connect(Path(READ_DATABASE).absolute().as_uri() + '?mode=ro', uri=True,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    return conn
+    # The copy's journal mode comes from the primary and cannot be set read-only
+    configure_sqlite(conn, {k: v for k, v in SQLITE_PRAGMAS.items() if k != 'journal_mode'})
+    return instrument_connection(conn, metrics)
+
+read_pool = (ConnectionPool(_connect_replica, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, name='sqlite-read')
+             if READ_DATABASE else None)
+read_router = ReadRouter(max_lag=DB_READ_MAX_LAG)
+
+# Completed patients older than ARCHIVE_AFTER_DAYS move to patients_history,
+# checked every ARCHIVE_INTERVAL seconds (0 disables the background job)
+archiver = Archiver(
+    pool, 'sqlite',
+    after_days=float(os.environ.get('ARCHIVE_AFTER_DAYS', 7)),
+    batch_size=int(os.environ.get('ARCHIVE_BATCH_SIZE', 500)),
+    interval=float(os.environ.get('ARCHIVE_INTERVAL', 3600)),
+    bump_version=lambda cursor: bump_queue_version(cursor),
+    on_archived=lambda version: patients_archived(version)
+)
+
+# Writes from other worker processes are noticed by polling PRAGMA
+# data_version every CHANGE_POLL_INTERVAL seconds (0 disables); with
+# CHANGE_SOCKET_DIR set, workers also wake each other over Unix sockets
+def apply_queue_changes(conn, old_version, new_version):
+    """Catch this worker's caches, engine and streams up with every worker's writes"""
+    read_router.observe(new_version)
+    page_cache.invalidate()
+    local_versions = change_watcher.take_local(new_version)
+    if not queue_engine.loaded and not broadcaster.subscriber_count():
+        return
+    # Rows committed after new_version wait for the next round, when their
+    # local versions have been taken too
+    rows = conn.execute('SELECT * FROM patients WHERE version > ? AND version <= ? ORDER BY version',
+                        (old_version, new_version)).fetchall()
+    apply_changes(rows, local_versions, queue_engine, broadcaster, patient_to_dict, wait_estimator)
+
+change_watcher = ChangeWatcher(
+    _open_sqlite, 'sqlite', apply_queue_changes,
+    interval=float(os.environ.get('CHANGE_POLL_INTERVAL', 0.02)),
+    socket_dir=os.environ.get('CHANGE_SOCKET_DIR')
+)
+
+def flush_registrations(conn, patients):
+    """Commit a batch of queued registrations in one transaction (writer thread)"""
+    try:
+        registered, version = register_patients(conn, conn.cursor(), patients, None, token_allocator,
+                                                queue_stats, bump_queue_version)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for patient in registered:
+        queue_changed('registered', patient, version)
+        if queue_engine.loaded:
+            queue_engine.add(patient)
+
+# WRITE_BEHIND_DURABILITY: queued (answer once queued) or committed (wait for
+# the batch commit); WRITE_BEHIND_WHEN_FULL: wait (up to
+# WRITE_BEHIND_FULL_TIMEOUT seconds) or reject, both answering 503 when full
+# or when a committed registration is not written within
+# WRITE_BEHIND_COMMIT_TIMEOUT seconds. A batch failing on a lost connection
+# or lock is retried up to WRITE_BEHIND_MAX_ATTEMPTS times; any other error
+# is narrowed down to the rows causing it, which are dropped
+write_behind = WriteBehindQueue(
+    _connect, flush_registrations,
+    enabled=WRITE_BEHIND,
+    max_pending=int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000)),
+    batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 200)),
+    interval=float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.005)),
+    durability=os.environ.get('WRITE_BEHIND_DURABILITY', 'queued'),
+    when_full=os.environ.get('WRITE_BEHIND_WHEN_FULL', 'wait'),
+    full_timeout=float(os.environ.get('WRITE_BEHIND_FULL_TIMEOUT', 1)),
+    drain_timeout=float(os.environ.get('WRITE_BEHIND_DRAIN_TIMEOUT', 10)),
+    commit_timeout=float(os.environ.get('WRITE_BEHIND_COMMIT_TIMEOUT', 5)),
+    max_attempts=int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 10)),
+    # Locked or unreadable database: worth another try; bad data is not
+    is_transient=lambda error: isinstance(error, sqlite3.OperationalError)
+)
+atexit.register(write_behind.close)
+
+@app.before_request
+def ensure_schema():
+    """Set up the schema before the first request (no-op afterwards)"""
+    schema.ensure()
+
+@app.before_request
+def start_background_jobs():
+    """Start the archiver, change watcher and registration writer threads with the first request (no-op afterwards)"""
+    archiver.start()
+    change_watcher.start()
+    write_behind.start()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema now"""
+    init_db()
+    print("Database schema is up to date")
+
+@app.cli.command('archive')
+def archive_command():
+    """Move old completed patients into patients_history now"""
+    schema.ensure()
+    print(f"Archived {archiver.run_once()} completed patients")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard counters from the patient tables"""
+    schema.ensure()
+    conn = pool.acquire()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        result = queue_stats.rebuild(conn.cursor())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+    print(f"Rebuilt stats for {result['departments']} departments over {result['days']} days")
+
+@app.cli.command('backfill-rollups')
+@click.option('--since', help='Only recompute arrivals from this day on (YYYY-MM-DD)')
+def backfill_rollups_command(since):
+    """Recompute the hourly report rollups from the patient tables"""
+    schema.ensure()
+    since = date.fromisoformat(since) if since else None
+    conn = pool.acquire()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        result = hourly_rollups.rebuild(conn.cursor(), since)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+    print(f"Rolled up {result['patients']} patients into {result['hours']} hours")
+
+@app.cli.command('refresh-replica')
+@click.option('--interval', type=float, default=1.0, show_default=True,
+              help='Seconds between copies (0 copies once)')
+def refresh_replica_command(interval):
+    """Keep HOSPITAL_READ_DB a fresh copy of the database, standing in for a read replica"""
+    if not READ_DATABASE:
+        raise click.UsageError('Set HOSPITAL_READ_DB to the file the replica should be written to')
+    schema.ensure()
+    source = _open_sqlite()
+    target = sqlite3.connect(READ_DATABASE)
+    print(f"Copying {DATABASE} to {READ_DATABASE}" + (f" every {interval:g}s" if interval > 0 else ''))
+    try:
+        while True:
+            # One backup step copies a consistent snapshot, and readers of the
+            # copy switch over to it in one go
+            source.backup(target)
+            if interval <= 0:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        target.close()
+        source.close()
+
+@app.cli.command('export-patients')
+@click.option('--from', 'date_from', help='First day of arrival to include (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last day of arrival to include (YYYY-MM-DD)')
+@click.option('--department', help='Only this department')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--no-archived', is_flag=True, help='Leave out patients_history')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8', lazy=True), default='-',
+              help='File to write (default: stdout)')
+def export_patients_command(date_from, date_to, department, fmt, no_archived, output):
+    """Write patient records as CSV or NDJSON, streamed in batches"""
+    schema.ensure()
+    try:
+        fmt, filters, tables = parse_export_args({'format': fmt, 'from': date_from, 'to': date_to,
+                                                  'department': department, 'archived': not no_archived})
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    stream = ExportStream(_open_sqlite(), 'sqlite', fmt, filters, tables)
+    for chunk in stream:
+        output.write(chunk)
+    click.echo(f"Exported {stream.rows} patients", err=True)
+
+def get_db_connection():
+    """Return the connection bound to the current request, checking one out on first use"""
+    if 'db' not in g:
+        g.db = timed_acquire(pool, metrics)
+    return g.db
+
+def get_read_connection():
+    """Return the read replica's connection bound to the current request
+    
+    Falls back to the primary's (get_db_connection()) when no replica is
+    configured or its copy cannot be opened.
+    """
+    if read_pool is None:
+        return get_db_connection()
+    if 'read_db' not in g:
+        try:
+            g.read_db = timed_acquire(read_pool, metrics)
+        except sqlite3.Error as e:
+            print(f"Error opening read replica: {e}")
+            return get_db_connection()
+    return g.read_db
+
+def open_queue_read():
+    """(conn, version) for a public queue read, routed by read_router
+    
+    The replica serves the read when it is within DB_READ_MAX_LAG seconds of
+    the primary and has both this session's last write and the ?since=
+    version the client already holds; otherwise the primary does.
+    """
+    conn = get_read_connection()
+    if conn is not g.get('db'):
+        # The watcher's current version, in case nothing has changed since it started
+        read_router.observe(change_watcher.version)
+        min_version = max(session.get('queue_version', 0), request.args.get('since', 0, type=int))
+        try:
+            version = get_queue_version(conn)
+            if read_router.use_replica(version, min_version):
+                return conn, version
+        except sqlite3.Error as e:
+            print(f"Error reading from read replica: {e}")
+        conn = get_db_connection()
+    return conn, get_queue_version(conn)
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Hand the request's connections back to their pools"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        read_pool.release(conn)
 
 def get_next_token(department):
-    """Generate next token number for a department"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Allocate the next token number for a department
     
-    # Get the last token number for this department
-    cursor.execute('''
-        SELECT token_no FROM patients 
-        WHERE department = ? 
-        ORDER BY id DESC LIMIT 1
-    ''', (department,))
+    Runs on the request's connection, so the counter bump commits together
+    with the patient INSERT that follows it.
+    """
+    return token_allocator.next_token(get_db_connection(), department)
+
+def get_queue_version(conn):
+    """Current queue version (one primary-key lookup)"""
+    return conn.execute('SELECT version FROM queue_version WHERE id = 1').fetchone()[0]
+
+def bump_queue_version(conn):
+    """Increment the queue version inside the caller's write transaction
     
-    result = cursor.fetchone()
-    conn.close()
+    The write lock taken here is held until commit, so versions are handed
+    out in commit order and a ?since= reader can never skip a change.
+    """
+    conn.execute('UPDATE queue_version SET version = version + 1 WHERE id = 1')
+    version = get_queue_version(conn)
+    change_watcher.begin_write(version)
+    return version
+
+def claim_next_patient(conn, doctor_id, department=None):
+    """Atomically move the longest-waiting patient into consultation
     
-    if result:
-        # Extract number from token (e.g., "CARDIO-001" -> 1)
-        last_token = result[0]
-        try:
-            last_num = int(last_token.split('-')[-1])
-            next_num = last_num + 1
-        except:
-            next_num = 1
-    else:
-        next_num = 1
-    
-    # Format token as DEPT-001, DEPT-002, etc.
-    dept_code = department[:5].upper()
-    token_no = f"{dept_code}-{next_num:03d}"
-    return token_no
+    BEGIN IMMEDIATE takes the write lock up front and a single
+    UPDATE ... RETURNING picks and claims the row, so concurrent doctors
+    can never be handed the same patient. Returns the claimed row and the
+    new queue version, or (None, None) if nobody is waiting.
+    """
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    department_filter = 'AND department = ?' if department else ''
+    time_called = now_ms()
+    # The row takes the next queue version, which is only bumped once a
+    # patient was actually claimed (the write lock keeps the two in step)
+    patient = conn.execute(f'''
+        UPDATE patients
+        SET status = 'In Consultation', doctor_id = ?, time_called = ?,
+            version = (SELECT version + 1 FROM queue_version WHERE id = 1)
+        WHERE id = (
+            SELECT id FROM patients
+            WHERE status = 'Waiting' {department_filter}
+            ORDER BY time_in ASC, id ASC
+            LIMIT 1
+        )
+        RETURNING *
+    ''', (doctor_id, time_called) + ((department,) if department else ())).fetchone()
+    if patient is None:
+        conn.rollback()
+        return None, None
+    version = bump_queue_version(conn)
+    queue_stats.called(conn.cursor(), patient['department'], time_called)
+    conn.commit()
+    return patient, version
+
+def queue_changed(event, patient, version):
+    """Drop cached pages, update wait estimates and notify stream subscribers and other workers after a committed write"""
+    change_watcher.local_write(version)
+    read_router.observe(version)
+    if read_pool is not None and has_request_context():
+        # Read-your-writes: this session's queue reads skip replicas that lack
+        # it (without a replica there is nothing to skip, so no cookie either)
+        session['queue_version'] = version
+    page_cache.invalidate()
+    wait_estimator.observe(event, patient)
+    broadcaster.publish(event, patient_to_dict(patient), event_id=version)
+    change_watcher.notify()
+
+def patients_archived(version):
+    """Drop cached pages and encoded rows after the archiver commits a batch"""
+    change_watcher.local_write(version)
+    read_router.observe(version)
+    page_cache.invalidate()
+    row_cache.clear()
+    change_watcher.notify()
+
+def get_queue_engine():
+    """Return the in-memory queue, loading it from the database on first use"""
+    queue_engine.ensure_loaded(lambda: get_db_connection().execute('''
+        SELECT * FROM patients WHERE status IN ('Waiting', 'In Consultation')
+    ''').fetchall())
+    return queue_engine
+
+def get_wait_estimator():
+    """Return the wait-time estimator, warmed from recently completed patients on first use"""
+    wait_estimator.ensure_warm(lambda: get_db_connection().execute('''
+        SELECT department, doctor_id, time_in, time_called, time_out FROM patients
+        WHERE status = 'Completed' ORDER BY time_out DESC LIMIT ?
+    ''', (WARM_START_ROWS,)).fetchall())
+    return wait_estimator
+
+def patient_to_dict(patient):
+    """Convert a patient row to the JSON shape used by the queue APIs"""
+    # Handle SQLite Row object
+    time_out = None
+    try:
+        time_out = patient['time_out'] if patient['time_out'] else None
+    except (KeyError, IndexError):
+        pass
+    
+    # Times are stored as epoch ms and only become text here
+    return {
+        'id': patient['id'],
+        'token_no': patient['token_no'],
+        'name': patient['name'],
+        'department': patient['department'],
+        'symptoms': patient['symptoms'],
+        'status': patient['status'],
+        'time_in': format_time(patient['time_in']),
+        'time_out': format_time(time_out)
+    }
+
+# Encoded JSON per (id, status, time_out), shared by every /api/queue poll
+row_cache = RowCache(patient_to_dict)
+
+def get_queue_patients(conn, filters):
+    """Get one page of the queue in display order, plus the cursor for the next page"""
+    return fetch_queue_page(lambda sql, params: conn.execute(sql, params).fetchall(), filters)
 
 def login_required(f):
     @wraps(f)
@@ -105,89 +504,330 @@ def register():
         department = request.form['department']
         symptoms = request.form['symptoms']
         
+        conn = get_db_connection()
         token_no = get_next_token(department)
-        time_in = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        time_in = now_ms()
+        
+        if write_behind.enabled:
+            conn.commit()  # Token counter bump, when not served from a block
+            try:
+                write_behind.submit({'token_no': token_no, 'name': name, 'department': department,
+                                     'symptoms': symptoms, 'time_in': time_in})
+            except QueueFull:
+                return render_template('register.html', error='Registration is busy, please try again'), 503
+            except WriteFailed as e:
+                print(f"Error registering patient: {e}")
+                return render_template('register.html', error='Registration could not be saved, please try again'), 503
+            return render_template('success.html', token=token_no, name=name)
+        
+        version = bump_queue_version(conn)
         
-        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO patients (token_no, name, department, symptoms, status, time_in)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (token_no, name, department, symptoms, 'Waiting', time_in))
+            INSERT INTO patients (token_no, name, department, symptoms, status, time_in, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (token_no, name, department, symptoms, 'Waiting', time_in, version))
+        # Read before the counter upsert below reuses the cursor
+        patient_id = cursor.lastrowid
+        queue_stats.registered(cursor, department, time_in)
         conn.commit()
-        conn.close()
+        
+        patient = {
+            'id': patient_id,
+            'token_no': token_no,
+            'name': name,
+            'department': department,
+            'symptoms': symptoms,
+            'status': 'Waiting',
+            'time_in': time_in,
+            'time_out': None
+        }
+        queue_changed('registered', patient, version)
+        if queue_engine.loaded:
+            queue_engine.add(patient)
         
         return render_template('success.html', token=token_no, name=name)
     
     return render_template('register.html')
 
+@app.route('/api/patients/bulk', methods=['POST'])
+@login_required
+def api_patients_bulk():
+    """Register many patients in one transaction from a JSON list or CSV upload"""
+    try:
+        rows = parse_bulk_body(request.content_type, request.get_data())
+    except BulkError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    results = []
+    patients = []
+    for index, row in enumerate(rows):
+        patient, errors = validate_row(row)
+        results.append({'row': index, 'status': 'invalid' if errors else 'created', 'errors': errors})
+        if patient:
+            patients.append(patient)
+    if not patients:
+        return jsonify({'created': 0, 'failed': len(results), 'results': results}), 400
+    
+    conn = get_db_connection()
+    time_in = now_ms()
+    try:
+        registered, version = register_patients(conn, conn.cursor(), patients, time_in,
+                                                token_allocator, queue_stats, bump_queue_version)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for patient in registered:
+        queue_changed('registered', patient, version)
+        if queue_engine.loaded:
+            queue_engine.add(patient)
+    
+    created = iter(registered)
+    for result in results:
+        if result['status'] == 'created':
+            patient = next(created)
+            result.update(id=patient['id'], token_no=patient['token_no'])
+    
+    return jsonify({'created': len(registered), 'failed': len(results) - len(registered),
+                    'results': results}), 201
+
 @app.route('/queue')
 def queue():
-    conn = get_db_connection()
-    # Get all patients including completed ones
-    patients = conn.execute('''
-        SELECT * FROM patients 
-        ORDER BY 
-            CASE status
-                WHEN 'In Consultation' THEN 1
-                WHEN 'Waiting' THEN 2
-                WHEN 'Completed' THEN 3
-                ELSE 4
-            END,
-            time_in DESC
-    ''').fetchall()
-    
-    # Get completed patients separately for the completed section
-    completed_patients = conn.execute('''
-        SELECT * FROM patients 
-        WHERE status = 'Completed'
-        ORDER BY time_out DESC
-        LIMIT 10
-    ''').fetchall()
-    conn.close()
+    try:
+        filters = parse_queue_args(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
     
-    return render_template('queue.html', patients=patients, completed_patients=completed_patients)
+    conn, version = open_queue_read()
+    
+    def build():
+        patients, next_cursor = get_queue_patients(conn, filters)
+        
+        # Get completed patients separately for the completed section
+        department_filter = 'AND department = ?' if filters['department'] else ''
+        completed_patients = conn.execute(f'''
+            SELECT * FROM patients 
+            WHERE status = 'Completed' {department_filter}
+            ORDER BY time_out DESC
+            LIMIT 10
+        ''', (filters['department'],) if filters['department'] else ()).fetchall()
+        
+        patients = [format_times(patient) for patient in patients]
+        completed_patients = [format_times(patient) for patient in completed_patients]
+        return render_template('queue.html', patients=patients, completed_patients=completed_patients,
+                               next_cursor=next_cursor, filters=filters)
+    
+    # Flashed messages belong to one visitor, so that render is not shared
+    if '_flashes' in session:
+        return build()
+    # Signed-in doctors may see their own navigation; visitors all share one page
+    key = (version, request.query_string, session.get('user_id'))
+    return page_cache.get_or_build(key, build)
+
+def queue_etag(version, estimates):
+    """ETag for a queue response: the queue version, the wait estimator's estimate_key() and the query parameters"""
+    if not request.query_string:
+        return f"q{version}-{estimates:08x}"
+    return f"q{version}-{estimates:08x}-{zlib.crc32(request.query_string):08x}"
+
+def queue_response(response, etag, version):
+    """Attach the validators clients use for conditional and delta polling"""
+    response.set_etag(etag)
+    response.headers['X-Queue-Version'] = str(version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def queue_encoder():
+    """Row encoder for /api/queue: cached JSON plus each waiting patient's estimated wait"""
+    return wait_encoder(row_cache.encode, get_queue_engine(), get_wait_estimator())
 
 @app.route('/api/queue')
 def api_queue():
     """API endpoint for AJAX queue updates"""
+    conn, version = open_queue_read()
+    since = request.args.get('since', type=int)
+    
+    # Nothing changed since the client's copy: skip the query and the encoding
+    # (estimates can move without a queue write, e.g. when a doctor goes idle)
+    etag = queue_etag(version, get_wait_estimator().estimate_key())
+    if request.if_none_match.contains(etag):
+        return queue_response(Response(status=304), etag, version)
+    
+    if since is not None:
+        # Delta: only rows written after the client's cursor, streamed in
+        # batches straight from the cursor (since=0 returns every row), plus
+        # the ids archived since then for the client to drop and per-department
+        # wait rates in place of per-row estimates
+        rates = wait_rates(get_queue_engine(), get_wait_estimator())
+        archived = [row[0] for row in conn.execute(
+            'SELECT id FROM archived_ids WHERE version > ? ORDER BY version', (since,))] if since else []
+        changed = conn.execute('''
+            SELECT * FROM patients WHERE version > ? ORDER BY version
+        ''', (since,))
+        body = stream_rows(changed, row_cache.encode, prefix=b'{"patients":[',
+                           suffix=b'],"archived":%s,"version":%d,"wait_minutes_per_patient":%s}'
+                                  % (dumps(archived), version, dumps(rates)))
+        response = Response(stream_with_context(body), mimetype='application/json')
+        return queue_response(response, etag, version)
+    
+    try:
+        filters = parse_queue_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    patients, next_cursor = get_queue_patients(conn, filters)
+    
+    # Unchanged patients reuse their encoded bytes from earlier polls
+    response = Response(encode_array(patients, queue_encoder()), mimetype='application/json')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return queue_response(response, etag, version)
+
+@app.route('/api/wait/<token_no>')
+def api_wait(token_no):
+    """Place in line and estimated wait for one token"""
+    engine = get_queue_engine()
+    estimator = get_wait_estimator()
+    patient = engine.find(token_no)
+    if patient is None:
+        return jsonify({'error': 'Token is not in the queue'}), 404
+    
+    department = patient['department']
+    patients_ahead = engine.positions(department).get(patient['id'], 0) if patient['status'] == 'Waiting' else 0
+    return jsonify({
+        'token_no': patient['token_no'],
+        'department': department,
+        'status': patient['status'],
+        'patients_ahead': patients_ahead,
+        'estimated_wait_minutes': (estimator.estimate_minutes(department, patients_ahead)
+                                   if patient['status'] == 'Waiting' else 0),
+        'department_stats': estimator.snapshot().get(department)
+    })
+
+@app.route('/api/queue/stream')
+def api_queue_stream():
+    """Server-Sent Events stream: one snapshot, then registered/called/completed events"""
+    # Subscribe before reading the snapshot so no change slips in between
+    subscription = broadcaster.subscribe()
+    try:
+        conn = get_db_connection()
+        snapshot_id = get_queue_version(conn)
+        # Snapshot is the first page of the default listing
+        patients, _ = get_queue_patients(conn, parse_queue_args({}))
+        snapshot = [patient_to_dict(patient) for patient in patients]
+    except Exception:
+        subscription.close()
+        raise
+    
+    # The connection goes back to the pool when this view returns,
+    # the stream itself only waits on the broadcaster
+    return Response(sse_stream(subscription, snapshot, snapshot_id, SSE_KEEPALIVE),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/history')
+@login_required
+def api_history():
+    """Archived patients, newest first, with the same filters as /api/queue"""
+    try:
+        filters = parse_queue_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     conn = get_db_connection()
-    # Get all patients including completed ones
-    patients = conn.execute('''
-        SELECT * FROM patients 
-        ORDER BY 
-            CASE status
-                WHEN 'In Consultation' THEN 1
-                WHEN 'Waiting' THEN 2
-                WHEN 'Completed' THEN 3
-                ELSE 4
-            END,
-            time_in DESC
-    ''').fetchall()
-    conn.close()
+    patients, next_cursor = fetch_history_page(
+        lambda sql, params: conn.execute(sql, params).fetchall(), filters)
     
-    # Convert to list of dictionaries
-    patients_list = []
-    for patient in patients:
-        # Handle SQLite Row object
-        time_out = None
-        try:
-            time_out = patient['time_out'] if patient['time_out'] else None
-        except (KeyError, IndexError):
-            pass
-        
-        patients_list.append({
-            'id': patient['id'],
-            'token_no': patient['token_no'],
-            'name': patient['name'],
-            'department': patient['department'],
-            'symptoms': patient['symptoms'],
-            'status': patient['status'],
-            'time_in': patient['time_in'],
-            'time_out': time_out
-        })
-    
-    return jsonify(patients_list)
+    return jsonify({
+        'patients': [patient_to_dict(patient) for patient in patients],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/stats')
+def api_stats():
+    """Queue counters per department: current gauges plus one day's totals"""
+    day = request.args.get('date') or date.today().isoformat()
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    
+    conn = get_db_connection()
+    return jsonify(queue_stats.snapshot(conn.cursor(), day))
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Patients whose name or symptoms match ?q=, best match first"""
+    try:
+        terms, department, status, limit, offset = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    patients, next_offset = search_patients(lambda sql, params: conn.execute(sql, params).fetchall(),
+                                            'sqlite', terms, department, status, limit, offset)
+    return jsonify({
+        'patients': [patient_to_dict(patient) for patient in patients],
+        'next_offset': next_offset
+    })
+
+@app.route('/api/reports')
+@login_required
+def api_reports():
+    """Patients and average/median wait and consultation time from the hourly rollups"""
+    try:
+        start, end, group, department = parse_report_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    rows = hourly_rollups.report(conn.cursor(), start, end, group, department)
+    return jsonify({'from': start.isoformat(), 'to': end.isoformat(), 'group': group, 'rows': rows})
+
+@app.route('/api/export')
+@login_required
+def api_export():
+    """Patient records for a date range as a streamed CSV or NDJSON download"""
+    try:
+        fmt, filters, tables = parse_export_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Its own connection rather than the request's pooled one, which goes
+    # back to the pool while the download is still streaming
+    stream = ExportStream(_open_sqlite(), 'sqlite', fmt, filters, tables)
+    return Response(stream, content_type=FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(fmt, filters)}"',
+        'X-Accel-Buffering': 'no'})
+
+@app.route('/api/db/pool')
+def api_db_pool():
+    """Connection pool usage and wait statistics, plus the replica state"""
+    stats = pool.stats()
+    if read_pool is not None:
+        stats['replica'] = dict(read_pool.stats(), routing=read_router.stats())
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the request, query and pool metrics"""
+    gauges = list(pool_gauges(pool))
+    if read_pool is not None:
+        gauges.extend(pool_gauges(read_pool))
+        routing = read_router.stats()
+        gauges.append(('db_read_replica_reads', {}, routing['replica_reads']))
+        gauges.append(('db_read_primary_reads', {}, routing['primary_reads']))
+    gauges.append(('queue_stream_subscribers', {}, broadcaster.subscriber_count()))
+    gauges.append(('queue_json_cached_rows', {}, row_cache.stats()['rows']))
+    for name, value in page_cache.stats().items():
+        gauges.append((f'queue_page_cache_{name}', {}, value))
+    gauges.append(('queue_changes_seen', {}, change_watcher.changes_seen))
+    for name, value in write_behind.stats().items():
+        if name not in ('enabled', 'durability'):
+            gauges.append((f'write_behind_{name}', {}, value))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -199,7 +839,6 @@ def login():
         user = conn.execute('''
             SELECT * FROM users WHERE username = ? AND password = ?
         ''', (username, password)).fetchone()
-        conn.close()
         
         if user:
             session['user_id'] = user['id']
@@ -219,82 +858,76 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
+    # A doctor can limit the dashboard and "Call Next Patient" to one department
+    if 'department' in request.args:
+        session['department'] = request.args['department'].strip() or None
+    department = session.get('department')
+    
     conn = get_db_connection()
+    engine = get_queue_engine()
     
-    # Get next waiting patient
-    next_patient = conn.execute('''
-        SELECT * FROM patients 
-        WHERE status = 'Waiting'
-        ORDER BY time_in ASC
-        LIMIT 1
-    ''').fetchone()
-    
-    # Get current patient in consultation
-    current_patient = conn.execute('''
-        SELECT * FROM patients 
-        WHERE status = 'In Consultation'
-        ORDER BY time_in ASC
-        LIMIT 1
-    ''').fetchone()
-    
-    # Get statistics
-    total_waiting = conn.execute('''
-        SELECT COUNT(*) FROM patients WHERE status = 'Waiting'
-    ''').fetchone()[0]
-    
-    total_today = conn.execute('''
-        SELECT COUNT(*) FROM patients 
-        WHERE DATE(time_in) = DATE('now')
-    ''').fetchone()[0]
+    # Next waiting patient, current consultation and waiting count come from memory
+    next_patient = engine.peek(department)
+    current_patient = engine.current(doctor_id=session['user_id'])
+    total_waiting = engine.waiting_count(department)
     
-    conn.close()
+    total_today = queue_stats.registered_on(conn.cursor(), date.today().isoformat(), department)
     
     return render_template('dashboard.html', 
-                         next_patient=next_patient,
-                         current_patient=current_patient,
+                         next_patient=format_times(next_patient) if next_patient else None,
+                         current_patient=format_times(current_patient) if current_patient else None,
                          total_waiting=total_waiting,
-                         total_today=total_today)
+                         total_today=total_today,
+                         department=department)
 
 @app.route('/next_patient', methods=['POST'])
 @login_required
 def next_patient():
     conn = get_db_connection()
+    department = request.form.get('department', '').strip() or session.get('department')
     
-    # Get the next waiting patient
-    patient = conn.execute('''
-        SELECT * FROM patients 
-        WHERE status = 'Waiting'
-        ORDER BY time_in ASC
-        LIMIT 1
-    ''').fetchone()
-    
+    patient, version = claim_next_patient(conn, session['user_id'], department)
     if patient:
-        # Update status to 'In Consultation'
-        conn.execute('''
-            UPDATE patients SET status = 'In Consultation'
-            WHERE id = ?
-        ''', (patient['id'],))
-        conn.commit()
+        called = get_queue_engine().add(patient)
+        queue_changed('called', called, version)
     
-    conn.close()
     return redirect(url_for('dashboard'))
 
 @app.route('/complete_patient/<int:patient_id>', methods=['POST'])
 @login_required
 def complete_patient(patient_id):
     conn = get_db_connection()
-    time_out = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    time_out = now_ms()
+    
+    # Read the current status under the write lock so the counters know
+    # which gauge the patient leaves; completing twice is a no-op
+    conn.execute('BEGIN IMMEDIATE')
+    current = conn.execute('''
+        SELECT department, status, time_in, time_called FROM patients WHERE id = ?
+    ''', (patient_id,)).fetchone()
+    if current is None or current['status'] == 'Completed':
+        conn.rollback()
+        return redirect(url_for('dashboard'))
     
+    version = bump_queue_version(conn)
     conn.execute('''
-        UPDATE patients SET status = 'Completed', time_out = ?
+        UPDATE patients SET status = 'Completed', time_out = ?, version = ?
         WHERE id = ?
-    ''', (time_out, patient_id))
+    ''', (time_out, version, patient_id))
+    queue_stats.completed(conn.cursor(), current['department'], time_out, current['status'])
+    hourly_rollups.completed(conn.cursor(), current['department'], current['time_in'],
+                             current['time_called'], time_out)
     conn.commit()
-    conn.close()
+    
+    queue_engine.complete(patient_id)
+    
+    patient = conn.execute('SELECT * FROM patients WHERE id = ?', (patient_id,)).fetchone()
+    if patient:
+        queue_changed('completed', patient, version)
     
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app(bootstrap=True).run(debug=True)
 
 
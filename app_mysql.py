@@ -1,24 +1,128 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, g, Response, abort, stream_with_context, has_request_context
+from datetime import datetime, date
 import mysql.connector
 from mysql.connector import Error
 from functools import wraps
 import os
+import zlib
+import atexit
+import click
+from db import CircuitBreaker, ConnectionPool, PoolTimeout, ReadRouter, SchemaBootstrap
+from tokens import TokenAllocator
+from events import Broadcaster, sse_stream
+from queue_query import parse_queue_args, fetch_queue_page
+from queue_engine import QueueEngine
+from archive import Archiver, fetch_history_page
+from stats import QueueStats
+from rollups import HourlyRollups, parse_report_args
+from search import parse_search_args, search_patients
+from export import FORMATS, ExportStream, parse_export_args, export_filename
+from bulk import BulkError, parse_bulk_body, validate_row, register_patients
+from metrics import Metrics, instrument_app, instrument_connection, timed_acquire, pool_gauges
+from queue_json import RowCache, dumps, encode_array, stream_rows
+from page_cache import LastGood, PageCache
+from changes import ChangeWatcher, apply_changes
+from write_behind import WriteBehindQueue, QueueFull, WriteFailed
+from wait_times import WaitEstimator, WARM_START_ROWS, wait_encoder, wait_rates
+from timestamps import format_time, to_datetime
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-in-production'
 
+# Per-route, per-statement and pool wait timings served at /metrics
+metrics = Metrics(enabled=os.environ.get('METRICS_ENABLED', '1') == '1')
+instrument_app(app, metrics)
+
 # MySQL Database Configuration
 # Update these values according to your XAMPP MySQL settings
+# (or set MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE)
 DB_CONFIG = {
-    'host': 'localhost',
-    'user': 'root',
-    'password': '',  # Default XAMPP MySQL password is empty
-    'database': 'hospital_queue',
+    'host': os.environ.get('MYSQL_HOST', 'localhost'),
+    'port': int(os.environ.get('MYSQL_PORT', 3306)),
+    'user': os.environ.get('MYSQL_USER', 'root'),
+    'password': os.environ.get('MYSQL_PASSWORD', ''),  # Default XAMPP MySQL password is empty
+    'database': os.environ.get('MYSQL_DATABASE', 'hospital_queue'),
     'charset': 'utf8mb4',
     'autocommit': False
 }
 
+# Connection pool settings
+# POOL_SIZE caps concurrent MySQL connections per worker process, a request
+# waits up to POOL_TIMEOUT seconds for a free one before failing
+POOL_CONFIG = {
+    'size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'validate_after': float(os.environ.get('DB_POOL_VALIDATE_AFTER', 30))
+}
+
+# Pooled connections give up on an unreachable server after DB_CONNECT_TIMEOUT
+# seconds. DB_BREAKER_FAILURES failed connects in a row open the circuit
+# breaker: requests then fail fast without touching MySQL, and one probe
+# connect is let through after DB_BREAKER_RESET seconds, doubling after each
+# failed probe up to DB_BREAKER_MAX_RESET
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 2))
+BREAKER_CONFIG = {
+    'failure_threshold': int(os.environ.get('DB_BREAKER_FAILURES', 3)),
+    'reset_timeout': float(os.environ.get('DB_BREAKER_RESET', 1)),
+    'max_reset_timeout': float(os.environ.get('DB_BREAKER_MAX_RESET', 30))
+}
+
+# Optional read replica for the public queue reads (/queue and /api/queue),
+# enabled by MYSQL_READ_HOST or MYSQL_READ_PORT; the other MYSQL_READ_*
+# settings default to the primary's. A replica more than DB_READ_MAX_LAG
+# seconds behind the primary, or behind the session's own last write, is
+# skipped for the primary
+READ_REPLICA = bool(os.environ.get('MYSQL_READ_HOST') or os.environ.get('MYSQL_READ_PORT'))
+READ_DB_CONFIG = {
+    **DB_CONFIG,
+    'host': os.environ.get('MYSQL_READ_HOST', DB_CONFIG['host']),
+    'port': int(os.environ.get('MYSQL_READ_PORT', DB_CONFIG['port'])),
+    'user': os.environ.get('MYSQL_READ_USER', DB_CONFIG['user']),
+    'password': os.environ.get('MYSQL_READ_PASSWORD', DB_CONFIG['password']),
+    'database': os.environ.get('MYSQL_READ_DATABASE', DB_CONFIG['database'])
+}
+DB_READ_MAX_LAG = float(os.environ.get('DB_READ_MAX_LAG', 2))
+
+# WRITE_BEHIND=1 answers /register as soon as the token is allocated and
+# commits queued registrations in batches from a background thread
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND') == '1'
+
+# Token numbering: TOKEN_DAILY_RESET=1 restarts every department at 001 each
+# day, TOKEN_BLOCK_SIZE > 1 lets busy kiosks reserve numbers in memory
+# (write-behind reserves 50 at a time by default so /register never commits)
+token_allocator = TokenAllocator(
+    'mysql',
+    daily_reset=os.environ.get('TOKEN_DAILY_RESET') == '1',
+    block_size=int(os.environ.get('TOKEN_BLOCK_SIZE', 50 if WRITE_BEHIND else 1))
+)
+
+# SKIP LOCKED needs MySQL 8.0+ or MariaDB 10.6+; older servers fall back
+# to plain FOR UPDATE, which is just as safe but makes doctors take turns
+USE_SKIP_LOCKED = os.environ.get('DB_SKIP_LOCKED', '1') == '1'
+
+# In-memory view of waiting/in-consultation patients for the dashboard
+queue_engine = QueueEngine()
+
+# Moving averages behind estimated_wait_minutes; DEFAULT_CONSULTATION_MINUTES
+# is assumed until a department has completed a consultation
+wait_estimator = WaitEstimator(default_minutes=float(os.environ.get('DEFAULT_CONSULTATION_MINUTES', 10)))
+
+# Per-department gauges and per-day counters, maintained by each write
+queue_stats = QueueStats('mysql')
+
+# Per-hour report aggregates, updated as each patient completes
+hourly_rollups = HourlyRollups('mysql')
+
+# Fans queue change events out to /api/queue/stream subscribers
+broadcaster = Broadcaster()
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))
+
+# Rendered /queue pages, keyed by queue version and dropped on every write
+page_cache = PageCache()
+
+# Last good /queue and /api/queue results, served marked stale while MySQL is down
+last_good = LastGood()
+
 def create_database_if_not_exists():
     """Create database if it doesn't exist"""
     try:
@@ -35,41 +139,342 @@ def create_database_if_not_exists():
         print(f"Error creating database: {e}")
         return False
 
-def get_db_connection():
-    """Create and return MySQL database connection"""
+def connect_mysql(**options):
+    """Open a new MySQL connection (init_db() creates the database on first run)"""
+    return instrument_connection(mysql.connector.connect(**DB_CONFIG, **options), metrics)
+
+def _ping(conn):
+    """Health check for idle pooled connections"""
+    conn.ping(reconnect=False)
+    return True
+
+pool = ConnectionPool(lambda: connect_mysql(connection_timeout=DB_CONNECT_TIMEOUT),
+                      validate=_ping, name='mysql', **POOL_CONFIG)
+db_breaker = CircuitBreaker(name='MySQL', **BREAKER_CONFIG)
+
+def connect_replica():
+    """Open a new connection to the read replica"""
+    return instrument_connection(
+        mysql.connector.connect(**READ_DB_CONFIG, connection_timeout=DB_CONNECT_TIMEOUT), metrics)
+
+read_pool = (ConnectionPool(connect_replica, validate=_ping, name='mysql-read', **POOL_CONFIG)
+             if READ_REPLICA else None)
+read_breaker = CircuitBreaker(name='MySQL replica', **BREAKER_CONFIG)
+read_router = ReadRouter(max_lag=DB_READ_MAX_LAG)
+
+# Completed patients older than after_days move to patients_history,
+# checked every interval seconds (0 disables the background job)
+ARCHIVE_CONFIG = {
+    'after_days': float(os.environ.get('ARCHIVE_AFTER_DAYS', 7)),
+    'batch_size': int(os.environ.get('ARCHIVE_BATCH_SIZE', 500)),
+    'interval': float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+}
+archiver = Archiver(pool, 'mysql', bump_version=lambda cursor: bump_queue_version(cursor),
+                    on_archived=lambda version: patients_archived(version), **ARCHIVE_CONFIG)
+
+# Writes from other worker processes are noticed by polling queue_version
+# every CHANGE_POLL_INTERVAL seconds (0 disables); with CHANGE_SOCKET_DIR
+# set, workers on one host also wake each other over Unix sockets
+def apply_queue_changes(conn, old_version, new_version):
+    """Catch this worker's caches, engine and streams up with every worker's writes"""
+    read_router.observe(new_version)
+    page_cache.invalidate()
+    local_versions = change_watcher.take_local(new_version)
+    if not queue_engine.loaded and not broadcaster.subscriber_count():
+        return
+    cursor = conn.cursor(dictionary=True)
     try:
-        # Try to connect
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
+        # Rows committed after new_version wait for the next round, when their
+        # local versions have been taken too
+        cursor.execute('SELECT * FROM patients WHERE version > %s AND version <= %s ORDER BY version',
+                       (old_version, new_version))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    apply_changes(rows, local_versions, queue_engine, broadcaster, patient_to_dict, wait_estimator)
+
+change_watcher = ChangeWatcher(
+    lambda: mysql.connector.connect(**DB_CONFIG), 'mysql', apply_queue_changes,
+    interval=float(os.environ.get('CHANGE_POLL_INTERVAL', 0.02)),
+    socket_dir=os.environ.get('CHANGE_SOCKET_DIR')
+)
+
+def flush_registrations(conn, patients):
+    """Commit a batch of queued registrations in one transaction (writer thread)"""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        registered, version = register_patients(conn, cursor, patients, None, token_allocator,
+                                                queue_stats, bump_queue_version, placeholder='%s')
+        conn.commit()
+    except Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    for patient in registered:
+        queue_changed('registered', patient, version)
+        if queue_engine.loaded:
+            queue_engine.add(patient)
+
+# WRITE_BEHIND_DURABILITY: queued (answer once queued) or committed (wait for
+# the batch commit); WRITE_BEHIND_WHEN_FULL: wait (up to
+# WRITE_BEHIND_FULL_TIMEOUT seconds) or reject, both answering 503 when full
+# or when a committed registration is not written within
+# WRITE_BEHIND_COMMIT_TIMEOUT seconds. A batch failing on a lost connection
+# or lock is retried up to WRITE_BEHIND_MAX_ATTEMPTS times; any other error
+# is narrowed down to the rows causing it, which are dropped
+WRITE_BEHIND_CONFIG = {
+    'max_pending': int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000)),
+    'batch_size': int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 200)),
+    'interval': float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.005)),
+    'durability': os.environ.get('WRITE_BEHIND_DURABILITY', 'queued'),
+    'when_full': os.environ.get('WRITE_BEHIND_WHEN_FULL', 'wait'),
+    'full_timeout': float(os.environ.get('WRITE_BEHIND_FULL_TIMEOUT', 1)),
+    'drain_timeout': float(os.environ.get('WRITE_BEHIND_DRAIN_TIMEOUT', 10)),
+    'commit_timeout': float(os.environ.get('WRITE_BEHIND_COMMIT_TIMEOUT', 5)),
+    'max_attempts': int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 10))
+}
+
+def transient_write_error(error):
+    """Whether a failed registration batch is worth retrying as it is
+    
+    Client-side errors (2xxx: lost or refused connection), lock wait
+    timeouts and deadlocks are; data errors such as 1406 (data too long)
+    would fail the same way every time.
+    """
+    if isinstance(error, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)):
+        return True
+    errno = getattr(error, 'errno', None) or 0
+    return 2000 <= errno < 3000 or errno in (1205, 1213)
+
+write_behind = WriteBehindQueue(connect_mysql, flush_registrations, enabled=WRITE_BEHIND,
+                                is_transient=transient_write_error, **WRITE_BEHIND_CONFIG)
+atexit.register(write_behind.close)
+
+@app.before_request
+def ensure_schema():
+    """Set up the schema before the first request (no-op afterwards)"""
+    schema.ensure()
+
+@app.before_request
+def start_background_jobs():
+    """Start the archiver, change watcher and registration writer threads with the first request (no-op afterwards)"""
+    archiver.start()
+    change_watcher.start()
+    write_behind.start()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the database schema now"""
+    if init_db():
+        print(f"Database schema is at version {SCHEMA_VERSION}")
+
+@app.cli.command('archive')
+def archive_command():
+    """Move old completed patients into patients_history now"""
+    schema.ensure()
+    try:
+        print(f"Archived {archiver.run_once()} completed patients")
     except Error as e:
-        # If database doesn't exist, try to create it
-        if e.errno == 1049:  # Unknown database error
-            print(f"Database not found. Attempting to create database...")
-            if create_database_if_not_exists():
-                try:
-                    conn = mysql.connector.connect(**DB_CONFIG)
-                    return conn
-                except Error as e2:
-                    print(f"Error connecting after database creation: {e2}")
-                    return None
-        else:
-            print(f"Error connecting to MySQL: {e}")
-            print(f"Please ensure:")
-            print(f"  1. MySQL service is running in XAMPP")
-            print(f"  2. Database '{DB_CONFIG['database']}' exists or can be created")
-            print(f"  3. Username and password are correct")
+        print(f"Error archiving patients: {e}")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard counters from the patient tables"""
+    schema.ensure()
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    try:
+        result = queue_stats.rebuild(cursor)
+        conn.commit()
+        print(f"Rebuilt stats for {result['departments']} departments over {result['days']} days")
+    except Error as e:
+        print(f"Error rebuilding stats: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        pool.release(conn)
+
+@app.cli.command('backfill-rollups')
+@click.option('--since', help='Only recompute arrivals from this day on (YYYY-MM-DD)')
+def backfill_rollups_command(since):
+    """Recompute the hourly report rollups from the patient tables"""
+    schema.ensure()
+    since = date.fromisoformat(since) if since else None
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    try:
+        result = hourly_rollups.rebuild(cursor, since)
+        conn.commit()
+        print(f"Rolled up {result['patients']} patients into {result['hours']} hours")
+    except Error as e:
+        print(f"Error backfilling rollups: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        pool.release(conn)
+
+@app.cli.command('export-patients')
+@click.option('--from', 'date_from', help='First day of arrival to include (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last day of arrival to include (YYYY-MM-DD)')
+@click.option('--department', help='Only this department')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--no-archived', is_flag=True, help='Leave out patients_history')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8', lazy=True), default='-',
+              help='File to write (default: stdout)')
+def export_patients_command(date_from, date_to, department, fmt, no_archived, output):
+    """Write patient records as CSV or NDJSON, streamed from an unbuffered cursor"""
+    schema.ensure()
+    try:
+        fmt, filters, tables = parse_export_args({'format': fmt, 'from': date_from, 'to': date_to,
+                                                  'department': department, 'archived': not no_archived})
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    try:
+        stream = ExportStream(mysql.connector.connect(**DB_CONFIG), 'mysql', fmt, filters, tables)
+        for chunk in stream:
+            output.write(chunk)
+        click.echo(f"Exported {stream.rows} patients", err=True)
+    except Error as e:
+        print(f"Error exporting patients: {e}")
+
+def get_db_connection():
+    """Return the pooled MySQL connection bound to the current request
+    
+    Returns None straight away while the circuit breaker is open.
+    """
+    if 'db' in g:
+        return g.db
+    if not db_breaker.allow():
         return None
+    try:
+        g.db = timed_acquire(pool, metrics)
+        db_breaker.record_success()
+        return g.db
+    except PoolTimeout as e:
+        # MySQL is fine, this worker is just busy: not a breaker failure
+        print(f"Error connecting to MySQL: {e}")
+    except Error as e:
+        if db_breaker.record_failure():
+            # Idle connections point at the same dead server
+            pool.close()
+        print(f"Error connecting to MySQL: {e}")
+        print(f"Please ensure:")
+        print(f"  1. MySQL service is running in XAMPP")
+        print(f"  2. Database '{DB_CONFIG['database']}' exists or can be created")
+        print(f"  3. Username and password are correct")
+    return None
 
-def init_db():
-    """Initialize database and create tables if they don't exist"""
-    conn = get_db_connection()
+def get_read_connection():
+    """Return the read replica's pooled connection bound to the current request
+    
+    Falls back to the primary's (get_db_connection()) when no replica is
+    configured or it cannot be reached.
+    """
+    if read_pool is None:
+        return get_db_connection()
+    if 'read_db' in g:
+        return g.read_db
+    if read_breaker.allow():
+        try:
+            g.read_db = timed_acquire(read_pool, metrics)
+            read_breaker.record_success()
+            return g.read_db
+        except PoolTimeout as e:
+            print(f"Error connecting to MySQL replica: {e}")
+        except Error as e:
+            if read_breaker.record_failure():
+                read_pool.close()
+            print(f"Error connecting to MySQL replica: {e}")
+    return get_db_connection()
+
+def open_queue_read():
+    """(conn, cursor, version) for a public queue read, routed by read_router
+    
+    The replica serves the read when it is within DB_READ_MAX_LAG seconds of
+    the primary and has both this session's last write and the ?since=
+    version the client already holds; otherwise the primary does. conn is
+    None when neither can be reached, version is None when the caller still
+    has to read it.
+    """
+    conn = get_read_connection()
+    if conn is not None and conn is not g.get('db'):
+        # The watcher's current version, in case nothing has changed since it started
+        read_router.observe(change_watcher.version)
+        min_version = max(session.get('queue_version', 0), request.args.get('since', 0, type=int))
+        cursor = conn.cursor(dictionary=True)
+        try:
+            version = get_queue_version(cursor)
+            if read_router.use_replica(version, min_version):
+                return conn, cursor, version
+        except Error as e:
+            print(f"Error reading from MySQL replica: {e}")
+        cursor.close()
+        conn = get_db_connection()
     if conn is None:
+        return None, None, None
+    return conn, conn.cursor(dictionary=True), None
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Hand the request's connections back to their pools"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        read_pool.release(conn)
+
+# Bump whenever init_db() gains a table, column or index; a database already
+# at this version is checked with a single query and left alone
+SCHEMA_VERSION = 1
+
+def schema_is_current(cursor):
+    """Whether schema_version says init_db() has nothing to do"""
+    try:
+        cursor.execute('SELECT version FROM schema_version WHERE id = 1')
+        row = cursor.fetchone()
+    except Error as e:
+        if e.errno == 1146:  # Table doesn't exist: never bootstrapped
+            return False
+        raise
+    return row is not None and row[0] >= SCHEMA_VERSION
+
+def init_db(breaker=None, **options):
+    """Create or upgrade the tables unless schema_version is already current
+    
+    Returns False if MySQL could not be reached or the schema not created.
+    With a circuit breaker, the connect is skipped while it is open and its
+    outcome is recorded; options go to connect_mysql().
+    """
+    if breaker is not None and not breaker.allow():
+        return False
+    # Runs outside any request, so it uses its own short-lived connection
+    try:
+        try:
+            conn = connect_mysql(**options)
+        except Error as e:
+            if e.errno != 1049:  # Unknown database: create it on first run
+                raise
+            print("Database not found. Attempting to create database...")
+            if not create_database_if_not_exists():
+                return False
+            conn = connect_mysql(**options)
+    except Error as e:
+        if breaker is not None and breaker.record_failure():
+            pool.close()
+        print(f"Error connecting to MySQL: {e}")
         print("Failed to connect to database. Please check your MySQL configuration.")
-        return
+        return False
+    if breaker is not None:
+        breaker.record_success()
     
     cursor = conn.cursor()
     
     try:
+        if schema_is_current(cursor):
+            return True
+        
         # Create patients table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS patients (
@@ -81,12 +486,90 @@ def init_db():
                 status VARCHAR(20) DEFAULT 'Waiting',
                 time_in DATETIME NOT NULL,
                 time_out DATETIME NULL,
+                version BIGINT NOT NULL DEFAULT 0,
+                doctor_id INT NULL,
+                time_called DATETIME NULL,
                 INDEX idx_status (status),
                 INDEX idx_department (department),
-                INDEX idx_time_in (time_in)
+                INDEX idx_time_in (time_in),
+                INDEX idx_version (version),
+                INDEX idx_status_time_in (status, time_in),
+                INDEX idx_dept_status_time_in (department, status, time_in),
+                INDEX idx_status_time_out (status, time_out),
+                FULLTEXT INDEX ft_name_symptoms (name, symptoms)
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         
+        # Add columns introduced after the first release to older databases
+        cursor.execute('''
+            SELECT COLUMN_NAME FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'patients'
+        ''')
+        existing_columns = {row[0] for row in cursor.fetchall()}
+        for column, definition in [('version', 'BIGINT NOT NULL DEFAULT 0, ADD INDEX idx_version (version)'),
+                                   ('doctor_id', 'INT NULL'),
+                                   ('time_called', 'DATETIME NULL')]:
+            if column not in existing_columns:
+                cursor.execute(f'ALTER TABLE patients ADD COLUMN {column} {definition}')
+        
+        # Indexes behind the filtered, keyset-paginated queue listing
+        cursor.execute('''
+            SELECT INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'patients'
+        ''')
+        existing_indexes = {row[0] for row in cursor.fetchall()}
+        for index_name, columns in [('idx_status_time_in', 'status, time_in'),
+                                    ('idx_dept_status_time_in', 'department, status, time_in'),
+                                    ('idx_status_time_out', 'status, time_out')]:
+            if index_name not in existing_indexes:
+                cursor.execute(f'ALTER TABLE patients ADD INDEX {index_name} ({columns})')
+        # Full-text index behind /api/search
+        if 'ft_name_symptoms' not in existing_indexes:
+            cursor.execute('ALTER TABLE patients ADD FULLTEXT INDEX ft_name_symptoms (name, symptoms)')
+        
+        # Create queue version table (single row, bumped by every queue write)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS queue_version (
+                id TINYINT PRIMARY KEY,
+                version BIGINT NOT NULL
+            ) ENGINE=InnoDB
+        ''')
+        cursor.execute('INSERT IGNORE INTO queue_version (id, version) VALUES (1, 0)')
+        
+        # Create history table for archived (completed) patients, partitioned
+        # by month of time_in; monthly partitions are split off pmax by the archiver
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patients_history (
+                id INT NOT NULL,
+                token_no VARCHAR(20) NOT NULL,
+                name VARCHAR(100) NOT NULL,
+                department VARCHAR(50) NOT NULL,
+                symptoms TEXT NOT NULL,
+                status VARCHAR(20),
+                time_in DATETIME NOT NULL,
+                time_out DATETIME NULL,
+                version BIGINT NOT NULL DEFAULT 0,
+                doctor_id INT NULL,
+                time_called DATETIME NULL,
+                archived_at DATETIME NOT NULL,
+                PRIMARY KEY (id, time_in),
+                INDEX idx_history_time_in (time_in),
+                INDEX idx_history_dept_time_in (department, time_in)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            PARTITION BY RANGE (TO_DAYS(time_in)) (
+                PARTITION pmax VALUES LESS THAN MAXVALUE
+            )
+        ''')
+        
+        # Create tombstones for archived patients, so ?since= deltas can report removals
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_ids (
+                version BIGINT NOT NULL,
+                id INT NOT NULL,
+                PRIMARY KEY (version, id)
+            ) ENGINE=InnoDB
+        ''')
+        
         # Create users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -97,6 +580,67 @@ def init_db():
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         
+        # Create token counters table (one row per department and reset period)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_sequences (
+                department VARCHAR(50) NOT NULL,
+                period VARCHAR(10) NOT NULL,
+                last_value INT NOT NULL,
+                PRIMARY KEY (department, period)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        token_allocator.seed(conn)
+        
+        # Create dashboard counter tables (gauges per department, totals per day)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS department_stats (
+                department VARCHAR(50) PRIMARY KEY,
+                waiting INT NOT NULL DEFAULT 0,
+                in_consultation INT NOT NULL DEFAULT 0
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day DATE NOT NULL,
+                department VARCHAR(50) NOT NULL,
+                registered INT NOT NULL DEFAULT 0,
+                called INT NOT NULL DEFAULT 0,
+                completed INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, department)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        # Fill the counters once for databases that predate them
+        cursor.execute('SELECT (SELECT COUNT(*) FROM department_stats) + (SELECT COUNT(*) FROM daily_stats)')
+        if cursor.fetchone()[0] == 0:
+            queue_stats.rebuild(cursor)
+        
+        # Create hourly report rollups (totals and duration histograms per arrival hour)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hourly_rollups (
+                hour DATETIME NOT NULL,
+                department VARCHAR(50) NOT NULL,
+                patients INT NOT NULL DEFAULT 0,
+                waited INT NOT NULL DEFAULT 0,
+                wait_seconds BIGINT NOT NULL DEFAULT 0,
+                consulted INT NOT NULL DEFAULT 0,
+                consultation_seconds BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (hour, department)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hourly_rollup_buckets (
+                hour DATETIME NOT NULL,
+                department VARCHAR(50) NOT NULL,
+                metric VARCHAR(20) NOT NULL,
+                bucket TINYINT NOT NULL,
+                patients INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (hour, department, metric, bucket)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        cursor.execute('SELECT COUNT(*) FROM hourly_rollups')
+        if cursor.fetchone()[0] == 0:
+            hourly_rollups.rebuild(cursor)
+        
         # Insert default doctor user if not exists
         cursor.execute('SELECT COUNT(*) FROM users WHERE username = %s', ('doctor',))
         if cursor.fetchone()[0] == 0:
@@ -105,58 +649,260 @@ def init_db():
                 VALUES (%s, %s, %s)
             ''', ('doctor', 'doctor123', 'doctor'))
         
+        # Recorded last, so a bootstrap that failed part way runs again
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id TINYINT PRIMARY KEY,
+                version INT NOT NULL
+            ) ENGINE=InnoDB
+        ''')
+        cursor.execute('''
+            INSERT INTO schema_version (id, version) VALUES (1, %s)
+            ON DUPLICATE KEY UPDATE version = VALUES(version)
+        ''', (SCHEMA_VERSION,))
+        
         conn.commit()
         print("Database initialized successfully!")
+        return True
         
     except Error as e:
         print(f"Error initializing database: {e}")
+        return False
     finally:
         cursor.close()
         conn.close()
 
-# Initialize database on startup
-init_db()
+# The schema is set up by the first request or CLI command rather than at
+# import, so importing the app or forking workers touches no database.
+# Like the requests it runs for, it fails fast through db_breaker and gives
+# up on an unreachable server after DB_CONNECT_TIMEOUT seconds
+schema = SchemaBootstrap(lambda: init_db(db_breaker, connection_timeout=DB_CONNECT_TIMEOUT))
+
+def create_app(bootstrap=False):
+    """Return the app, setting up the schema now with bootstrap=True instead of on first use"""
+    if bootstrap:
+        schema.ensure()
+    return app
 
 def get_next_token(department):
-    """Generate next token number for a department"""
+    """Allocate the next token number for a department
+    
+    Runs on the request's connection, so the counter row stays locked until
+    the patient INSERT that follows it commits.
+    """
     conn = get_db_connection()
     if conn is None:
         return None
     
-    cursor = conn.cursor()
-    
     try:
-        # Get the last token number for this department
-        cursor.execute('''
-            SELECT token_no FROM patients 
-            WHERE department = %s 
-            ORDER BY id DESC LIMIT 1
-        ''', (department,))
-        
-        result = cursor.fetchone()
-        
-        if result:
-            # Extract number from token (e.g., "CARDIO-001" -> 1)
-            last_token = result[0]
-            try:
-                last_num = int(last_token.split('-')[-1])
-                next_num = last_num + 1
-            except:
-                next_num = 1
-        else:
-            next_num = 1
-        
-        # Format token as DEPT-001, DEPT-002, etc.
-        dept_code = department[:5].upper()
-        token_no = f"{dept_code}-{next_num:03d}"
-        return token_no
-        
+        return token_allocator.next_token(conn, department)
     except Error as e:
         print(f"Error generating token: {e}")
+        conn.rollback()
         return None
-    finally:
-        cursor.close()
-        conn.close()
+
+def get_queue_version(cursor):
+    """Current queue version (one primary-key lookup)"""
+    cursor.execute('SELECT version FROM queue_version WHERE id = 1')
+    row = cursor.fetchone()
+    return row['version'] if isinstance(row, dict) else row[0]
+
+def bump_queue_version(cursor):
+    """Increment the queue version inside the caller's write transaction
+    
+    The row lock taken here is held until commit, so versions are handed
+    out in commit order and a ?since= reader can never skip a change.
+    """
+    cursor.execute('UPDATE queue_version SET version = version + 1 WHERE id = 1')
+    version = get_queue_version(cursor)
+    change_watcher.begin_write(version)
+    return version
+
+def queue_etag(version, estimates):
+    """ETag for a queue response: the queue version, the wait estimator's estimate_key() and the query parameters"""
+    if not request.query_string:
+        return f"q{version}-{estimates:08x}"
+    return f"q{version}-{estimates:08x}-{zlib.crc32(request.query_string):08x}"
+
+def queue_response(response, etag, version):
+    """Attach the validators clients use for conditional and delta polling"""
+    response.set_etag(etag)
+    response.headers['X-Queue-Version'] = str(version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def retry_later(response):
+    """Mark a response refused because MySQL is unreachable (503 with Retry-After)"""
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(db_breaker.retry_after()) + 1)
+    return response
+
+def stale_response(response, saved_at=None):
+    """Mark a response served from last_good while MySQL is unreachable"""
+    response.headers['X-Queue-Stale'] = '1'
+    if saved_at is not None:
+        response.headers['Age'] = str(int(datetime.now().timestamp() - saved_at))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def stale_queue_page():
+    """Last good /queue render for this query string, marked stale, or a 503 empty page"""
+    snapshot = last_good.get(('queue', request.query_string))
+    if snapshot is None:
+        page = render_template('queue.html', patients=[], completed_patients=[])
+        return retry_later(stale_response(Response(page)))
+    context, saved_at = snapshot
+    page = render_template('queue.html', stale_since=format_time(datetime.fromtimestamp(saved_at)), **context)
+    return stale_response(Response(page), saved_at)
+
+def stale_queue_json():
+    """Last good /api/queue body for this query string, marked stale, or a 503
+    
+    A delta poll is told nothing changed since its own version, so the
+    client keeps the copy it has.
+    """
+    since = request.args.get('since', type=int)
+    if since is not None:
+        response = Response(b'{"patients":[],"archived":[],"version":%d}' % since, mimetype='application/json')
+        response.headers['X-Queue-Version'] = str(since)
+        return stale_response(response)
+    snapshot = last_good.get(('api', request.query_string))
+    if snapshot is None:
+        return retry_later(stale_response(jsonify({'error': 'Database connection failed'})))
+    (body, next_cursor, version), saved_at = snapshot
+    response = Response(body, mimetype='application/json')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    response.headers['X-Queue-Version'] = str(version)
+    return stale_response(response, saved_at)
+
+def claim_next_patient(conn, cursor, doctor_id, department=None):
+    """Atomically move the longest-waiting patient into consultation
+    
+    SELECT ... FOR UPDATE SKIP LOCKED locks the head of the queue and lets
+    concurrent doctors skip past rows another transaction is claiming, so no
+    patient is ever handed to two doctors. Returns the claimed row and the
+    new queue version, or (None, None) if nobody is waiting.
+    """
+    global USE_SKIP_LOCKED
+    department_filter = 'AND department = %s' if department else ''
+    params = (department,) if department else ()
+    try:
+        cursor.execute(f'''
+            SELECT * FROM patients
+            WHERE status = 'Waiting' {department_filter}
+            ORDER BY time_in ASC, id ASC
+            LIMIT 1
+            FOR UPDATE {'SKIP LOCKED' if USE_SKIP_LOCKED else ''}
+        ''', params)
+    except Error as e:
+        if not USE_SKIP_LOCKED or e.errno != 1064:  # 1064 = syntax error
+            raise
+        print("SKIP LOCKED not supported by this server, falling back to FOR UPDATE")
+        USE_SKIP_LOCKED = False
+        conn.rollback()
+        return claim_next_patient(conn, cursor, doctor_id, department)
+    
+    patient = cursor.fetchone()
+    if patient is None:
+        conn.rollback()
+        return None, None
+    
+    time_called = datetime.now().replace(microsecond=0)
+    version = bump_queue_version(cursor)
+    cursor.execute('''
+        UPDATE patients
+        SET status = 'In Consultation', doctor_id = %s, time_called = %s, version = %s
+        WHERE id = %s
+    ''', (doctor_id, time_called, version, patient['id']))
+    queue_stats.called(cursor, patient['department'], time_called)
+    conn.commit()
+    patient.update(status='In Consultation', doctor_id=doctor_id, time_called=time_called, version=version)
+    return patient, version
+
+def queue_changed(event, patient, version):
+    """Drop cached pages, update wait estimates and notify stream subscribers and other workers after a committed write"""
+    change_watcher.local_write(version)
+    read_router.observe(version)
+    if read_pool is not None and has_request_context():
+        # Read-your-writes: this session's queue reads skip replicas that lack
+        # it (without a replica there is nothing to skip, so no cookie either)
+        session['queue_version'] = version
+    page_cache.invalidate()
+    wait_estimator.observe(event, patient)
+    broadcaster.publish(event, patient_to_dict(patient), event_id=version)
+    change_watcher.notify()
+
+def patients_archived(version):
+    """Drop cached pages and encoded rows after the archiver commits a batch"""
+    change_watcher.local_write(version)
+    read_router.observe(version)
+    page_cache.invalidate()
+    row_cache.clear()
+    change_watcher.notify()
+
+def get_queue_engine(cursor):
+    """Return the in-memory queue, loading it from the database on first use"""
+    def fetch_active():
+        cursor.execute('''
+            SELECT * FROM patients WHERE status IN ('Waiting', 'In Consultation')
+        ''')
+        return cursor.fetchall()
+    queue_engine.ensure_loaded(fetch_active)
+    return queue_engine
+
+def get_wait_estimator(cursor):
+    """Return the wait-time estimator, warmed from recently completed patients on first use"""
+    def fetch_recent():
+        cursor.execute('''
+            SELECT department, doctor_id, time_in, time_called, time_out FROM patients
+            WHERE status = 'Completed' ORDER BY time_out DESC LIMIT %s
+        ''', (WARM_START_ROWS,))
+        return cursor.fetchall()
+    wait_estimator.ensure_warm(fetch_recent)
+    return wait_estimator
+
+def queue_waits(cursor=None):
+    """The queue engine and wait estimator behind /api/queue's estimates
+    
+    Both are kept current from the primary, so their first load reads it
+    too: through `cursor` when that is the primary's, else on a cursor of
+    its own. Without the primary, returns (None, None) and rows go out
+    without estimates.
+    """
+    if cursor is None and not (queue_engine.loaded and wait_estimator.warmed):
+        conn = get_db_connection()
+        if conn is None:
+            return None, None
+        cursor = conn.cursor(dictionary=True)
+        try:
+            return queue_waits(cursor)
+        finally:
+            cursor.close()
+    return get_queue_engine(cursor), get_wait_estimator(cursor)
+
+def patient_to_dict(patient):
+    """Convert a patient row to the JSON shape used by the queue APIs"""
+    return {
+        'id': patient['id'],
+        'token_no': patient['token_no'],
+        'name': patient['name'],
+        'department': patient['department'],
+        'symptoms': patient['symptoms'],
+        'status': patient['status'],
+        'time_in': format_time(patient.get('time_in')),
+        'time_out': format_time(patient.get('time_out'))
+    }
+
+# Encoded JSON per (id, status, time_out), shared by every /api/queue poll
+row_cache = RowCache(patient_to_dict)
+
+def get_queue_patients(cursor, filters):
+    """Get one page of the queue in display order, plus the cursor for the next page"""
+    def execute(sql, params):
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    return fetch_queue_page(execute, filters, placeholder='%s', db_time=to_datetime)
 
 def login_required(f):
     @wraps(f)
@@ -189,26 +935,60 @@ def register():
             flash('Please describe the symptoms', 'danger')
             return render_template('register.html')
         
+        # Refused up front (and fast while the breaker is open) rather than
+        # queueing a registration that cannot be written
+        conn = get_db_connection()
+        if conn is None:
+            flash('Database connection failed. Please check if MySQL is running.', 'danger')
+            return retry_later(Response(render_template('register.html')))
+        
         # Generate token
         token_no = get_next_token(department)
         if not token_no:
             flash('Error generating token. Please try again.', 'danger')
             return render_template('register.html')
         
-        time_in = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        time_in = datetime.now().replace(microsecond=0)
         
-        conn = get_db_connection()
-        if conn is None:
-            flash('Database connection failed. Please check if MySQL is running.', 'danger')
-            return render_template('register.html')
+        if write_behind.enabled:
+            conn.commit()  # Token counter bump, when not served from a block
+            try:
+                write_behind.submit({'token_no': token_no, 'name': name, 'department': department,
+                                     'symptoms': symptoms, 'time_in': time_in})
+            except QueueFull:
+                flash('Registration is busy, please try again.', 'danger')
+                return render_template('register.html'), 503
+            except WriteFailed as e:
+                print(f"Error registering patient: {e}")
+                flash('Registration could not be saved. Please try again.', 'danger')
+                return render_template('register.html'), 503
+            flash(f'Patient registered successfully! Token: {token_no}', 'success')
+            return render_template('success.html', token=token_no, name=name)
         
         cursor = conn.cursor()
         try:
+            version = bump_queue_version(cursor)
             cursor.execute('''
-                INSERT INTO patients (token_no, name, department, symptoms, status, time_in)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (token_no, name, department, symptoms, 'Waiting', time_in))
+                INSERT INTO patients (token_no, name, department, symptoms, status, time_in, version)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ''', (token_no, name, department, symptoms, 'Waiting', time_in, version))
+            # Read before the counter upsert below reuses the cursor
+            patient_id = cursor.lastrowid
+            queue_stats.registered(cursor, department, time_in)
             conn.commit()
+            patient = {
+                'id': patient_id,
+                'token_no': token_no,
+                'name': name,
+                'department': department,
+                'symptoms': symptoms,
+                'status': 'Waiting',
+                'time_in': time_in,
+                'time_out': None
+            }
+            queue_changed('registered', patient, version)
+            if queue_engine.loaded:
+                queue_engine.add(patient)
             flash(f'Patient registered successfully! Token: {token_no}', 'success')
             return render_template('success.html', token=token_no, name=name)
         except Error as e:
@@ -218,115 +998,390 @@ def register():
             return render_template('register.html')
         finally:
             cursor.close()
-            conn.close()
     
     return render_template('register.html')
 
-@app.route('/queue')
-def queue():
+@app.route('/api/patients/bulk', methods=['POST'])
+@login_required
+def api_patients_bulk():
+    """Register many patients in one transaction from a JSON list or CSV upload"""
+    try:
+        rows = parse_bulk_body(request.content_type, request.get_data())
+    except BulkError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    results = []
+    patients = []
+    for index, row in enumerate(rows):
+        patient, errors = validate_row(row)
+        results.append({'row': index, 'status': 'invalid' if errors else 'created', 'errors': errors})
+        if patient:
+            patients.append(patient)
+    if not patients:
+        return jsonify({'created': 0, 'failed': len(results), 'results': results}), 400
+    
     conn = get_db_connection()
     if conn is None:
-        return render_template('queue.html', patients=[], completed_patients=[])
+        return retry_later(jsonify({'error': 'Database connection failed'}))
     
-    cursor = conn.cursor(dictionary=True)
+    time_in = datetime.now().replace(microsecond=0)
+    cursor = conn.cursor()
     try:
-        # Get all patients including completed ones
-        cursor.execute('''
-            SELECT * FROM patients 
-            ORDER BY 
-                CASE status
-                    WHEN 'In Consultation' THEN 1
-                    WHEN 'Waiting' THEN 2
-                    WHEN 'Completed' THEN 3
-                    ELSE 4
-                END,
-                time_in DESC
-        ''')
-        patients = cursor.fetchall()
+        registered, version = register_patients(conn, cursor, patients, time_in, token_allocator,
+                                                queue_stats, bump_queue_version, placeholder='%s')
+        conn.commit()
+    except Error as e:
+        print(f"Error registering patients in bulk: {e}")
+        conn.rollback()
+        return jsonify({'error': 'Failed to register patients'}), 500
+    finally:
+        cursor.close()
+    
+    for patient in registered:
+        queue_changed('registered', patient, version)
+        if queue_engine.loaded:
+            queue_engine.add(patient)
+    
+    created = iter(registered)
+    for result in results:
+        if result['status'] == 'created':
+            patient = next(created)
+            result.update(id=patient['id'], token_no=patient['token_no'])
+    
+    return jsonify({'created': len(registered), 'failed': len(results) - len(registered),
+                    'results': results}), 201
+
+@app.route('/queue')
+def queue():
+    try:
+        filters = parse_queue_args(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+    
+    conn, cursor, version = open_queue_read()
+    if conn is None:
+        return stale_queue_page()
+    
+    def build():
+        patients, next_cursor = get_queue_patients(cursor, filters)
         
         # Get completed patients separately for the completed section
-        cursor.execute('''
+        department_filter = 'AND department = %s' if filters['department'] else ''
+        cursor.execute(f'''
             SELECT * FROM patients 
-            WHERE status = 'Completed'
+            WHERE status = 'Completed' {department_filter}
             ORDER BY time_out DESC
             LIMIT 10
-        ''')
+        ''', (filters['department'],) if filters['department'] else ())
         completed_patients = cursor.fetchall()
         
-        return render_template('queue.html', patients=patients, completed_patients=completed_patients)
+        context = {'patients': patients, 'completed_patients': completed_patients,
+                   'next_cursor': next_cursor, 'filters': filters}
+        last_good.save(('queue', request.query_string), context)
+        return render_template('queue.html', **context)
+    
+    try:
+        # Flashed messages belong to one visitor, so that render is not shared
+        if '_flashes' in session:
+            return build()
+        # Signed-in doctors may see their own navigation; visitors all share one page
+        if version is None:
+            version = get_queue_version(cursor)
+        key = (version, request.query_string, session.get('user_id'))
+        return page_cache.get_or_build(key, build)
     except Error as e:
         print(f"Error fetching queue: {e}")
-        return render_template('queue.html', patients=[], completed_patients=[])
+        return stale_queue_page()
     finally:
         cursor.close()
-        conn.close()
 
 @app.route('/api/queue')
 def api_queue():
     """API endpoint for AJAX queue updates"""
-    conn = get_db_connection()
+    conn, cursor, version = open_queue_read()
     if conn is None:
-        return jsonify([])
+        return stale_queue_json()
     
-    cursor = conn.cursor(dictionary=True)
     try:
-        # Get all patients including completed ones
-        cursor.execute('''
-            SELECT * FROM patients 
-            ORDER BY 
-                CASE status
-                    WHEN 'In Consultation' THEN 1
-                    WHEN 'Waiting' THEN 2
-                    WHEN 'Completed' THEN 3
-                    ELSE 4
-                END,
-                time_in DESC
-        ''')
-        patients = cursor.fetchall()
-        
-        # Convert datetime objects to strings
-        patients_list = []
-        for patient in patients:
-            # Handle datetime conversion safely
-            time_in_str = None
-            time_out_str = None
-            
-            try:
-                if patient['time_in']:
-                    if isinstance(patient['time_in'], str):
-                        time_in_str = patient['time_in']
-                    else:
-                        time_in_str = patient['time_in'].strftime('%Y-%m-%d %H:%M:%S')
-            except (KeyError, AttributeError):
-                pass
+        if version is None:
+            version = get_queue_version(cursor)
+        since = request.args.get('since', type=int)
+        
+        # Reads the engine and estimator before the unbuffered cursor below opens
+        engine, estimator = queue_waits(cursor if conn is g.get('db') else None)
+        
+        # Nothing changed since the client's copy: skip the query and the encoding
+        # (estimates can move without a queue write, e.g. when a doctor goes idle)
+        etag = queue_etag(version, estimator.estimate_key() if estimator else 0)
+        if request.if_none_match.contains(etag):
+            return queue_response(Response(status=304), etag, version)
+        
+        if since is not None:
+            # Delta: only rows written after the client's cursor, streamed in
+            # batches from an unbuffered cursor (since=0 returns every row),
+            # plus the ids archived since then for the client to drop and
+            # per-department wait rates in place of per-row estimates
+            rates = wait_rates(engine, estimator) if engine else {}
+            archived = []
+            if since:
+                cursor.execute('SELECT id FROM archived_ids WHERE version > %s ORDER BY version', (since,))
+                archived = [row['id'] for row in cursor.fetchall()]
+            changed = conn.cursor(dictionary=True)
+            changed.execute('''
+                SELECT * FROM patients WHERE version > %s ORDER BY version
+            ''', (since,))
             
-            try:
-                if patient.get('time_out'):
-                    if isinstance(patient['time_out'], str):
-                        time_out_str = patient['time_out']
-                    else:
-                        time_out_str = patient['time_out'].strftime('%Y-%m-%d %H:%M:%S')
-            except (KeyError, AttributeError):
-                pass
+            def body():
+                try:
+                    yield from stream_rows(changed, row_cache.encode, prefix=b'{"patients":[',
+                                           suffix=b'],"archived":%s,"version":%d,"wait_minutes_per_patient":%s}'
+                                                  % (dumps(archived), version, dumps(rates)))
+                except Error as e:
+                    # Headers are gone already; a truncated body tells the client to retry
+                    print(f"Error streaming queue changes: {e}")
+                finally:
+                    changed.close()
             
-            patients_list.append({
-                'id': patient['id'],
-                'token_no': patient['token_no'],
-                'name': patient['name'],
-                'department': patient['department'],
-                'symptoms': patient['symptoms'],
-                'status': patient['status'],
-                'time_in': time_in_str,
-                'time_out': time_out_str
-            })
-        
-        return jsonify(patients_list)
+            response = Response(stream_with_context(body()), mimetype='application/json')
+            return queue_response(response, etag, version)
+        
+        try:
+            filters = parse_queue_args(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        patients, next_cursor = get_queue_patients(cursor, filters)
+        
+        # Unchanged patients reuse their encoded bytes from earlier polls
+        encode = wait_encoder(row_cache.encode, engine, estimator) if engine else row_cache.encode
+        body = encode_array(patients, encode)
+        last_good.save(('api', request.query_string), (body, next_cursor, version))
+        response = Response(body, mimetype='application/json')
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return queue_response(response, etag, version)
     except Error as e:
         print(f"Error fetching queue: {e}")
-        return jsonify([])
+        return stale_queue_json()
     finally:
         cursor.close()
-        conn.close()
+
+@app.route('/api/wait/<token_no>')
+def api_wait(token_no):
+    """Place in line and estimated wait for one token"""
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    cursor = conn.cursor(dictionary=True)
+    try:
+        engine = get_queue_engine(cursor)
+        estimator = get_wait_estimator(cursor)
+    except Error as e:
+        print(f"Error estimating wait: {e}")
+        return jsonify({'error': 'Database error'}), 500
+    finally:
+        cursor.close()
+    
+    patient = engine.find(token_no)
+    if patient is None:
+        return jsonify({'error': 'Token is not in the queue'}), 404
+    
+    department = patient['department']
+    patients_ahead = engine.positions(department).get(patient['id'], 0) if patient['status'] == 'Waiting' else 0
+    return jsonify({
+        'token_no': patient['token_no'],
+        'department': department,
+        'status': patient['status'],
+        'patients_ahead': patients_ahead,
+        'estimated_wait_minutes': (estimator.estimate_minutes(department, patients_ahead)
+                                   if patient['status'] == 'Waiting' else 0),
+        'department_stats': estimator.snapshot().get(department)
+    })
+
+@app.route('/api/queue/stream')
+def api_queue_stream():
+    """Server-Sent Events stream: one snapshot, then registered/called/completed events"""
+    conn = get_db_connection()
+    if conn is None:
+        # EventSource clients retry on their own
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    # Subscribe before reading the snapshot so no change slips in between
+    subscription = broadcaster.subscribe()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        snapshot_id = get_queue_version(cursor)
+        # Snapshot is the first page of the default listing
+        patients, _ = get_queue_patients(cursor, parse_queue_args({}))
+        snapshot = [patient_to_dict(patient) for patient in patients]
+    except Error as e:
+        print(f"Error fetching queue: {e}")
+        subscription.close()
+        return jsonify({'error': 'Failed to load queue'}), 503
+    finally:
+        cursor.close()
+    
+    # The connection goes back to the pool when this view returns,
+    # the stream itself only waits on the broadcaster
+    return Response(sse_stream(subscription, snapshot, snapshot_id, SSE_KEEPALIVE),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/history')
+@login_required
+def api_history():
+    """Archived patients, newest first, with the same filters as /api/queue"""
+    try:
+        filters = parse_queue_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    cursor = conn.cursor(dictionary=True)
+    try:
+        def execute(sql, params):
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        patients, next_cursor = fetch_history_page(execute, filters, placeholder='%s', db_time=to_datetime)
+        return jsonify({
+            'patients': [patient_to_dict(patient) for patient in patients],
+            'next_cursor': next_cursor
+        })
+    except Error as e:
+        print(f"Error fetching history: {e}")
+        return jsonify({'error': 'Failed to load history'}), 500
+    finally:
+        cursor.close()
+
+@app.route('/api/stats')
+def api_stats():
+    """Queue counters per department: current gauges plus one day's totals"""
+    day = request.args.get('date') or date.today().isoformat()
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    cursor = conn.cursor()
+    try:
+        return jsonify(queue_stats.snapshot(cursor, day))
+    except Error as e:
+        print(f"Error fetching stats: {e}")
+        return jsonify({'error': 'Failed to load stats'}), 500
+    finally:
+        cursor.close()
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Patients whose name or symptoms match ?q=, best match first"""
+    try:
+        terms, department, status, limit, offset = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    cursor = conn.cursor(dictionary=True)
+    def execute(sql, params):
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    try:
+        patients, next_offset = search_patients(execute, 'mysql', terms, department, status, limit, offset)
+    except Error as e:
+        print(f"Error searching patients: {e}")
+        return jsonify({'error': 'Search failed'}), 500
+    finally:
+        cursor.close()
+    return jsonify({
+        'patients': [patient_to_dict(patient) for patient in patients],
+        'next_offset': next_offset
+    })
+
+@app.route('/api/reports')
+@login_required
+def api_reports():
+    """Patients and average/median wait and consultation time from the hourly rollups"""
+    try:
+        start, end, group, department = parse_report_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'error': 'Database connection failed'}), 503
+    
+    cursor = conn.cursor()
+    try:
+        rows = hourly_rollups.report(cursor, start, end, group, department)
+    except Error as e:
+        print(f"Error building report: {e}")
+        return jsonify({'error': 'Failed to build report'}), 500
+    finally:
+        cursor.close()
+    return jsonify({'from': start.isoformat(), 'to': end.isoformat(), 'group': group, 'rows': rows})
+
+@app.route('/api/export')
+@login_required
+def api_export():
+    """Patient records for a date range as a streamed CSV or NDJSON download"""
+    try:
+        fmt, filters, tables = parse_export_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Its own connection rather than a pooled one: the unbuffered cursor
+    # keeps it busy for as long as the download takes
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+    except Error as e:
+        print(f"Error connecting to MySQL for export: {e}")
+        return jsonify({'error': 'Database connection failed'}), 503
+    stream = ExportStream(conn, 'mysql', fmt, filters, tables)
+    return Response(stream, content_type=FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(fmt, filters)}"',
+        'X-Accel-Buffering': 'no'})
+
+@app.route('/api/db/pool')
+def api_db_pool():
+    """Connection pool usage and wait statistics, plus the circuit breaker and replica state"""
+    stats = dict(pool.stats(), breaker=db_breaker.stats())
+    if read_pool is not None:
+        stats['replica'] = dict(read_pool.stats(), breaker=read_breaker.stats(), routing=read_router.stats())
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the request, query and pool metrics"""
+    gauges = list(pool_gauges(pool))
+    if read_pool is not None:
+        gauges.extend(pool_gauges(read_pool))
+        routing = read_router.stats()
+        gauges.append(('db_read_replica_reads', {}, routing['replica_reads']))
+        gauges.append(('db_read_primary_reads', {}, routing['primary_reads']))
+    gauges.append(('queue_stream_subscribers', {}, broadcaster.subscriber_count()))
+    gauges.append(('queue_json_cached_rows', {}, row_cache.stats()['rows']))
+    for name, value in page_cache.stats().items():
+        gauges.append((f'queue_page_cache_{name}', {}, value))
+    gauges.append(('queue_changes_seen', {}, change_watcher.changes_seen))
+    breaker = db_breaker.stats()
+    gauges.append(('db_breaker_open', {}, int(breaker['state'] != 'closed')))
+    for name in ('consecutive_failures', 'opened', 'rejected', 'probes'):
+        gauges.append((f'db_breaker_{name}', {}, breaker[name]))
+    gauges.append(('queue_stale_served', {}, last_good.stats()['served']))
+    for name, value in write_behind.stats().items():
+        if name not in ('enabled', 'durability'):
+            gauges.append((f'write_behind_{name}', {}, value))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -361,7 +1416,6 @@ def login():
             return render_template('login.html', error='Database error. Please try again.')
         finally:
             cursor.close()
-            conn.close()
     
     return render_template('login.html')
 
@@ -373,6 +1427,11 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
+    # A doctor can limit the dashboard and "Call Next Patient" to one department
+    if 'department' in request.args:
+        session['department'] = request.args['department'].strip() or None
+    department = session.get('department')
+    
     conn = get_db_connection()
     if conn is None:
         return render_template('dashboard.html', 
@@ -383,43 +1442,21 @@ def dashboard():
     
     cursor = conn.cursor(dictionary=True)
     try:
-        # Get next waiting patient
-        cursor.execute('''
-            SELECT * FROM patients 
-            WHERE status = 'Waiting'
-            ORDER BY time_in ASC
-            LIMIT 1
-        ''')
-        next_patient = cursor.fetchone()
+        engine = get_queue_engine(cursor)
         
-        # Get current patient in consultation
-        cursor.execute('''
-            SELECT * FROM patients 
-            WHERE status = 'In Consultation'
-            ORDER BY time_in ASC
-            LIMIT 1
-        ''')
-        current_patient = cursor.fetchone()
-        
-        # Get statistics
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM patients WHERE status = 'Waiting'
-        ''')
-        result = cursor.fetchone()
-        total_waiting = result['count'] if result else 0
+        # Next waiting patient, current consultation and waiting count come from memory
+        next_patient = engine.peek(department)
+        current_patient = engine.current(doctor_id=session['user_id'])
+        total_waiting = engine.waiting_count(department)
         
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM patients 
-            WHERE DATE(time_in) = CURDATE()
-        ''')
-        result = cursor.fetchone()
-        total_today = result['count'] if result else 0
+        total_today = queue_stats.registered_on(cursor, date.today().isoformat(), department)
         
         return render_template('dashboard.html', 
                              next_patient=next_patient,
                              current_patient=current_patient,
                              total_waiting=total_waiting,
-                             total_today=total_today)
+                             total_today=total_today,
+                             department=department)
     except Error as e:
         print(f"Error fetching dashboard data: {e}")
         return render_template('dashboard.html', 
@@ -429,7 +1466,6 @@ def dashboard():
                              total_today=0)
     finally:
         cursor.close()
-        conn.close()
 
 @app.route('/next_patient', methods=['POST'])
 @login_required
@@ -439,24 +1475,13 @@ def next_patient():
         flash('Database connection failed. Please check if MySQL is running.', 'danger')
         return redirect(url_for('dashboard'))
     
+    department = request.form.get('department', '').strip() or session.get('department')
     cursor = conn.cursor(dictionary=True)
     try:
-        # Get the next waiting patient
-        cursor.execute('''
-            SELECT * FROM patients 
-            WHERE status = 'Waiting'
-            ORDER BY time_in ASC
-            LIMIT 1
-        ''')
-        patient = cursor.fetchone()
-        
+        patient, version = claim_next_patient(conn, cursor, session['user_id'], department)
         if patient:
-            # Update status to 'In Consultation'
-            cursor.execute('''
-                UPDATE patients SET status = 'In Consultation'
-                WHERE id = %s
-            ''', (patient['id'],))
-            conn.commit()
+            called = get_queue_engine(cursor).add(patient)
+            queue_changed('called', called, version)
             flash(f'Patient {patient["token_no"]} called for consultation', 'success')
         else:
             flash('No patients waiting in queue', 'info')
@@ -466,7 +1491,6 @@ def next_patient():
         flash('Error calling next patient. Please try again.', 'danger')
     finally:
         cursor.close()
-        conn.close()
     
     return redirect(url_for('dashboard'))
 
@@ -478,19 +1502,30 @@ def complete_patient(patient_id):
         flash('Database connection failed. Please check if MySQL is running.', 'danger')
         return redirect(url_for('dashboard'))
     
-    time_out = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    time_out = datetime.now().replace(microsecond=0)
     cursor = conn.cursor(dictionary=True)
     try:
-        # First check if patient exists
-        cursor.execute('SELECT * FROM patients WHERE id = %s', (patient_id,))
+        # First check if patient exists; the row lock keeps the status (and so
+        # the counter that gets decremented) stable until commit
+        cursor.execute('SELECT * FROM patients WHERE id = %s FOR UPDATE', (patient_id,))
         patient = cursor.fetchone()
         
-        if patient:
+        if patient and patient['status'] == 'Completed':
+            conn.rollback()
+            flash(f'Consultation for {patient["token_no"]} is already completed', 'info')
+        elif patient:
+            version = bump_queue_version(cursor)
             cursor.execute('''
-                UPDATE patients SET status = 'Completed', time_out = %s
+                UPDATE patients SET status = 'Completed', time_out = %s, version = %s
                 WHERE id = %s
-            ''', (time_out, patient_id))
+            ''', (time_out, version, patient_id))
+            queue_stats.completed(cursor, patient['department'], time_out, patient['status'])
+            hourly_rollups.completed(cursor, patient['department'], patient['time_in'],
+                                     patient['time_called'], time_out)
             conn.commit()
+            patient.update(status='Completed', time_out=time_out)
+            queue_engine.complete(patient_id)
+            queue_changed('completed', patient, version)
             flash(f'Consultation completed for {patient["token_no"]}', 'success')
         else:
             flash('Patient not found', 'danger')
@@ -500,11 +1535,10 @@ def complete_patient(patient_id):
         flash('Error completing consultation. Please try again.', 'danger')
     finally:
         cursor.close()
-        conn.close()
     
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app(bootstrap=True).run(debug=True)
 
 
@@ -0,0 +1,240 @@
+"""Archival of completed patients into patients_history
+
+Completed rows older than the archive window are moved out of the hot
+patients table in small batches, one short transaction per batch, so the
+live queue queries only ever touch today's working set. History stays
+queryable through /api/history, and each moved id leaves a tombstone in
+archived_ids under the batch's queue version so ?since= deltas can tell
+clients to drop it. On MySQL, patients_history is range
+partitioned by month of time_in and new monthly partitions are split off
+the catch-all partition before each run.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+from queue_query import encode_cursor
+from timestamps import DB_TIME, to_ms
+
+# Columns copied verbatim from patients to patients_history
+ARCHIVED_COLUMNS = ['id', 'token_no', 'name', 'department', 'symptoms', 'status',
+                    'time_in', 'time_out', 'version', 'doctor_id', 'time_called']
+
+SQL = {
+    'sqlite': {
+        'begin': 'BEGIN IMMEDIATE',
+        'select_batch': '''
+            SELECT id FROM patients
+            WHERE status = 'Completed' AND time_out < ?
+              AND id < (SELECT MAX(id) FROM patients)
+            ORDER BY id
+            LIMIT ?
+        ''',
+        'placeholder': '?',
+    },
+    'mysql': {
+        'begin': None,
+        'select_batch': '''
+            SELECT id FROM patients
+            WHERE status = 'Completed' AND time_out < %s
+              AND id < (SELECT MAX(id) FROM (SELECT id FROM patients) AS newest)
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE
+        ''',
+        'placeholder': '%s',
+    },
+}
+
+
+class Archiver:
+    """Moves completed patients older than `after_days` into patients_history
+
+    The newest patient row is never archived, so the id counter cannot be
+    reset to an id that already exists in history (InnoDB before MySQL 8
+    recomputes AUTO_INCREMENT from MAX(id) on restart).
+
+    Each batch takes a queue version from `bump_version(cursor)` inside its
+    transaction, records its ids in archived_ids under that version and
+    hands it to `on_archived(version)` after commit, so version-keyed caches,
+    delta polls and other workers see the rows leave.
+    """
+
+    def __init__(self, pool, dialect, after_days=7, batch_size=500, interval=3600,
+                 bump_version=None, on_archived=None):
+        self.pool = pool
+        self.dialect = dialect
+        self.sql = SQL[dialect]
+        self.db_time = DB_TIME[dialect]
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.bump_version = bump_version
+        self.on_archived = on_archived
+        self._thread = None
+        self._stop = threading.Event()
+        self.last_run = None
+        self.last_archived = 0
+
+    def run_once(self):
+        """Archive everything past the window, batch by batch; returns rows moved"""
+        cutoff = self.db_time(datetime.now() - timedelta(days=self.after_days))
+        conn = self.pool.acquire()
+        moved = 0
+        try:
+            if self.dialect == 'mysql':
+                ensure_month_partitions(conn)
+            while True:
+                batch = self._archive_batch(conn, cutoff)
+                moved += batch
+                if batch < self.batch_size:
+                    break
+                # Let queue writes in between batches
+                time.sleep(0.01)
+        finally:
+            self.pool.release(conn)
+        self.last_run = datetime.now()
+        self.last_archived = moved
+        return moved
+
+    def _archive_batch(self, conn, cutoff):
+        ph = self.sql['placeholder']
+        cursor = conn.cursor()
+        try:
+            if self.sql['begin']:
+                cursor.execute(self.sql['begin'])
+            cursor.execute(self.sql['select_batch'], (cutoff, self.batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                conn.rollback()
+                return 0
+            id_list = ', '.join([ph] * len(ids))
+            columns = ', '.join(ARCHIVED_COLUMNS)
+            version = None
+            if self.bump_version:
+                version = self.bump_version(cursor)
+                cursor.executemany(f'INSERT INTO archived_ids (version, id) VALUES ({ph}, {ph})',
+                                   [(version, patient_id) for patient_id in ids])
+            cursor.execute(f'''
+                INSERT INTO patients_history ({columns}, archived_at)
+                SELECT {columns}, {ph} FROM patients WHERE id IN ({id_list})
+            ''', [self.db_time(datetime.now().replace(microsecond=0))] + ids)
+            cursor.execute(f'DELETE FROM patients WHERE id IN ({id_list})', ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        if self.on_archived:
+            self.on_archived(version)
+        return len(ids)
+
+    def start(self):
+        """Run the archiver in a daemon thread every `interval` seconds"""
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='patient-archiver', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                moved = self.run_once()
+                if moved:
+                    print(f"Archived {moved} completed patients")
+            except Exception as e:
+                print(f"Error archiving patients: {e}")
+
+    def stats(self):
+        return {
+            'after_days': self.after_days,
+            'batch_size': self.batch_size,
+            'interval': self.interval,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'last_run': self.last_run.strftime('%Y-%m-%d %H:%M:%S') if self.last_run else None,
+            'last_archived': self.last_archived,
+        }
+
+
+def ensure_month_partitions(conn, months_ahead=1):
+    """Split monthly partitions off pmax up to `months_ahead` months from now (MySQL)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'patients_history'
+              AND PARTITION_NAME IS NOT NULL
+        ''')
+        existing = sorted(row[0] for row in cursor.fetchall() if row[0] != 'pmax')
+        if existing:
+            month = datetime.strptime(existing[-1][1:], '%Y%m')
+            month = _next_month(month)
+        else:
+            # Everything before the oldest archived month lands in the first partition
+            cursor.execute("SELECT MIN(time_in) FROM patients WHERE status = 'Completed'")
+            oldest = cursor.fetchone()[0] or datetime.now()
+            if isinstance(oldest, str):
+                oldest = datetime.strptime(oldest[:10], '%Y-%m-%d')
+            month = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+        last = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(months_ahead):
+            last = _next_month(last)
+        while month <= last:
+            upper = _next_month(month)
+            cursor.execute(f'''
+                ALTER TABLE patients_history REORGANIZE PARTITION pmax INTO (
+                    PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{upper:%Y-%m-%d}')),
+                    PARTITION pmax VALUES LESS THAN MAXVALUE
+                )
+            ''')
+            month = upper
+    finally:
+        cursor.close()
+
+
+def _next_month(month):
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def fetch_history_page(execute, filters, placeholder='?', db_time=to_ms):
+    """Return (rows, next_cursor) for archived patients, newest first
+
+    Takes the filters produced by queue_query.parse_queue_args(); the status
+    filter is ignored since every archived patient is Completed.
+    """
+    where = []
+    params = []
+    if filters['department']:
+        where.append(f'department = {placeholder}')
+        params.append(filters['department'])
+    if filters['date_from']:
+        where.append(f'time_in >= {placeholder}')
+        params.append(db_time(filters['date_from']))
+    if filters['date_to']:
+        where.append(f'time_in < {placeholder}')
+        params.append(db_time(filters['date_to']))
+    if filters['cursor']:
+        _, after_time, after_id = filters['cursor']
+        where.append(f'(time_in < {placeholder} OR (time_in = {placeholder} AND id < {placeholder}))')
+        params.extend([db_time(after_time), db_time(after_time), after_id])
+
+    limit = filters['limit']
+    rows = execute(f'''
+        SELECT * FROM patients_history
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY time_in DESC, id DESC
+        LIMIT {int(limit) + 1}
+    ''', params)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(0, last['time_in'], last['id'])
+    return rows, next_cursor
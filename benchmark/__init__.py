@@ -0,0 +1,4 @@
+"""Load generation and latency benchmark for app.py and app_mysql.py
+
+Run with `python -m benchmark --help` from the project root.
+"""
@@ -0,0 +1,93 @@
+"""Command line entry point: python -m benchmark
+
+Examples:
+    python -m benchmark                                  # SQLite, test client
+    python -m benchmark --backend both --mode wsgi
+    python -m benchmark --output results.json --baseline benchmark/baseline.json
+    python -m benchmark --save-baseline benchmark/baseline.json
+
+Exits with status 1 if a check fails or a route regressed against the
+baseline by more than --tolerance.
+"""
+import argparse
+import json
+import sys
+
+from benchmark.report import compare, format_results, load_baseline, parameter_mismatches, save_baseline
+from benchmark.scenario import BACKENDS, BackendUnavailable, Scenario, load_app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Hospital queue load benchmark')
+    parser.add_argument('--backend', choices=list(BACKENDS) + ['both'], default='sqlite')
+    parser.add_argument('--mode', choices=['client', 'wsgi'], default='client',
+                        help='Flask test client in-process, or HTTP against a local threaded WSGI server')
+    parser.add_argument('--patients', type=int, default=500, help='patients registered in the burst')
+    parser.add_argument('--kiosks', type=int, default=4, help='concurrent registration clients')
+    parser.add_argument('--pollers', type=int, default=20, help='concurrent /api/queue pollers')
+    parser.add_argument('--screens', type=int, default=2, help='concurrent /queue page viewers')
+    parser.add_argument('--doctors', type=int, default=4, help='concurrent doctors')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of steady-state load')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pause between a client\'s requests')
+    parser.add_argument('--bulk-size', type=int, default=100, help='patients per /api/patients/bulk request')
+    parser.add_argument('--mysql-database', default='hospital_queue_bench',
+                        help='scratch MySQL database (dropped and recreated on every run)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--save-baseline', help='store these results as the baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95/rps change against the baseline (0.2 = 20%%)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backends = list(BACKENDS) if args.backend == 'both' else [args.backend]
+
+    all_results = []
+    failed = False
+    for backend in backends:
+        try:
+            module = load_app(backend, mysql_database=args.mysql_database)
+        except BackendUnavailable as e:
+            print(f"Skipping {backend}: {e}")
+            failed = failed or args.backend != 'both'
+            continue
+        results = Scenario(module, backend, mode=args.mode, patients=args.patients, kiosks=args.kiosks,
+                           pollers=args.pollers, screens=args.screens, doctors=args.doctors,
+                           duration=args.duration, think_time=args.think_time, bulk_size=args.bulk_size).run()
+        all_results.append(results)
+        print(format_results(results))
+        failed = failed or not all(check['ok'] for check in results['checks'].values())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+        for results in all_results:
+            base = baseline.get(results['meta']['backend'])
+            if not base:
+                print(f"No baseline for {results['meta']['backend']}")
+                continue
+            mismatches = parameter_mismatches(results, base)
+            if mismatches:
+                # A run of another size would show spurious regressions (or hide real ones)
+                print(f"NOT COMPARED {results['meta']['backend']}: run parameters differ from the baseline "
+                      f"({'; '.join(mismatches)}); rerun with the baseline's parameters or refresh it")
+                failed = True
+                continue
+            regressions = compare(results, base, args.tolerance)
+            for regression in regressions:
+                print(f"REGRESSION {results['meta']['backend']} {regression}")
+            failed = failed or bool(regressions)
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, all_results)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
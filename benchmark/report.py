@@ -0,0 +1,130 @@
+"""Latency recording, summaries and baseline comparison for the benchmark"""
+import json
+import math
+import threading
+import time
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Collects request latencies per route for one phase"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._statuses = {}
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def record(self, route, seconds, status):
+        with self._lock:
+            self._samples.setdefault(route, []).append(seconds)
+            statuses = self._statuses.setdefault(route, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def summary(self):
+        """Per-route count, requests/s, latency percentiles (ms) and status counts"""
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        routes = {}
+        with self._lock:
+            for route, samples in sorted(self._samples.items()):
+                samples = sorted(samples)
+                routes[route] = {
+                    'count': len(samples),
+                    'rps': round(len(samples) / elapsed, 1) if elapsed > 0 else None,
+                    'p50_ms': _ms(percentile(samples, 50)),
+                    'p95_ms': _ms(percentile(samples, 95)),
+                    'p99_ms': _ms(percentile(samples, 99)),
+                    'max_ms': _ms(samples[-1]),
+                    'statuses': {str(k): v for k, v in sorted(self._statuses[route].items())},
+                }
+        return {'elapsed_s': round(elapsed, 3), 'routes': routes}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def format_results(results):
+    """Human-readable table of one backend's results"""
+    lines = [f"== {results['meta']['backend']} ({results['meta']['mode']}) =="]
+    for phase, summary in results['phases'].items():
+        lines.append(f"-- {phase} ({summary['elapsed_s']} s"
+                     + (f", {summary['patients_per_s']} patients/s)" if 'patients_per_s' in summary else ')'))
+        lines.append(f"   {'route':<34}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for route, stats in summary['routes'].items():
+            lines.append(f"   {route:<34}{stats['count']:>8}{stats['rps']:>10}"
+                         f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    for check, outcome in results.get('checks', {}).items():
+        lines.append(f"-- check {check}: {'ok' if outcome['ok'] else 'FAILED'} {outcome['detail']}")
+    return '\n'.join(lines)
+
+
+# Run metadata that is not a run parameter
+UNCOMPARED_META = ('backend', 'timestamp')
+
+
+def parameter_mismatches(results, baseline):
+    """Run parameters (meta) that differ from the baseline's, as 'name: baseline -> run' strings
+
+    Latencies and rates only compare between runs of the same size and shape.
+    """
+    run, base = results['meta'], baseline.get('meta', {})
+    return [f"{name}: {base.get(name)} -> {run.get(name)}"
+            for name in sorted(set(run) | set(base))
+            if name not in UNCOMPARED_META and run.get(name) != base.get(name)]
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Routes that got slower (p95) or slower to serve (rps) than the baseline
+
+    Registration phases are also held to their patients/s. Returns a list of
+    human-readable regression descriptions; routes missing from either side
+    are ignored.
+    """
+    regressions = []
+    for phase, summary in results['phases'].items():
+        base_phase = baseline.get('phases', {}).get(phase, {})
+        if base_phase.get('patients_per_s') and summary.get('patients_per_s') is not None \
+                and summary['patients_per_s'] < base_phase['patients_per_s'] * (1 - tolerance):
+            regressions.append(f"{phase}: patients/s {base_phase['patients_per_s']} -> {summary['patients_per_s']}")
+        base_routes = base_phase.get('routes', {})
+        for route, stats in summary['routes'].items():
+            base = base_routes.get(route)
+            if not base:
+                continue
+            if base['p95_ms'] and stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{phase} {route}: p95 {base['p95_ms']} -> {stats['p95_ms']} ms")
+            if base['rps'] and stats['rps'] < base['rps'] * (1 - tolerance):
+                regressions.append(f"{phase} {route}: rps {base['rps']} -> {stats['rps']}")
+    return regressions
+
+
+def load_baseline(path):
+    """Baseline results keyed by backend, or {} if the file does not exist"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, all_results):
+    baseline = load_baseline(path)
+    for results in all_results:
+        baseline[results['meta']['backend']] = results
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
@@ -0,0 +1,392 @@
+"""A simulated clinic day driven against app.py or app_mysql.py
+
+The app is imported in-process with its database pointed at a scratch
+location (a temporary SQLite file, or a dedicated MySQL database that is
+dropped first), then exercised either through Flask's test client or over
+HTTP against a local threaded WSGI server:
+
+1. registration: kiosks post /register as fast as they can
+2. steady: pollers hit /api/queue (ETag and ?since= deltas), screens load
+   /queue, and doctors cycle /next_patient, /dashboard, /complete_patient
+3. claim_check: every remaining waiting patient is called concurrently and
+   each must be handed to exactly one doctor
+4. bulk_registration: the same number of patients as the registration burst
+   is posted to /api/patients/bulk in batches, for comparison with the
+   single-row path (both phases report patients_per_s)
+"""
+import http.client
+import importlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import jinja2
+
+from benchmark.report import Recorder
+
+BACKENDS = {'sqlite': 'app', 'mysql': 'app_mysql'}
+
+DEPARTMENTS = ['Cardiology', 'Orthopedics', 'Neurology', 'General Medicine', 'Pediatrics']
+
+# Used only when the templates/ folder is not present, so the routes can
+# still be timed; the real templates always take precedence
+STAND_IN_TEMPLATES = {name: f'{name}' for name in [
+    'register.html', 'success.html', 'queue.html', 'login.html', 'dashboard.html'
+]}
+
+
+class BackendUnavailable(Exception):
+    """The selected database could not be reached"""
+
+
+class TestClientSession:
+    """One simulated user talking to the app through Flask's test client"""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None, json_body=None):
+        response = self._client.open(path, method=method, data=data, json=json_body, headers=headers)
+        status, response_headers = response.status_code, dict(response.headers)
+        response.close()
+        return status, response_headers
+
+
+class HttpSession:
+    """One simulated user talking to a local WSGI server over HTTP/1.1"""
+
+    def __init__(self, host, port):
+        self._conn = http.client.HTTPConnection(host, port, timeout=30)
+        self._cookies = SimpleCookie()
+
+    def request(self, method, path, data=None, headers=None, json_body=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self._cookies:
+            headers['Cookie'] = '; '.join(f'{k}={m.value}' for k, m in self._cookies.items())
+        self._conn.request(method, path, body=body, headers=headers)
+        response = self._conn.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            self._cookies.load(header)
+        return response.status, dict(response.headers)
+
+
+def load_app(backend, mysql_database='hospital_queue_bench'):
+    """Import the backend's app module against a scratch database"""
+    os.environ['ARCHIVE_INTERVAL'] = '0'
+    if backend == 'sqlite':
+        workdir = tempfile.mkdtemp(prefix='hospital-bench-')
+        os.environ['HOSPITAL_DB'] = os.path.join(workdir, 'bench.db')
+    else:
+        os.environ['MYSQL_DATABASE'] = mysql_database
+        _drop_mysql_database(mysql_database)
+
+    module = importlib.import_module(BACKENDS[backend])
+    # Set up the schema before the clock starts rather than in the first request
+    module.create_app(bootstrap=True)
+    try:
+        module.pool.release(module.pool.acquire())
+    except Exception as e:
+        raise BackendUnavailable(f"{backend} backend unavailable: {e}")
+
+    if not os.path.isdir(os.path.join(module.app.root_path, 'templates')):
+        module.app.jinja_loader = jinja2.DictLoader(STAND_IN_TEMPLATES)
+    module.app.config['TESTING'] = True
+    return module
+
+
+def _drop_mysql_database(name):
+    import mysql.connector
+    try:
+        conn = mysql.connector.connect(
+            host=os.environ.get('MYSQL_HOST', 'localhost'),
+            port=int(os.environ.get('MYSQL_PORT', 3306)),
+            user=os.environ.get('MYSQL_USER', 'root'),
+            password=os.environ.get('MYSQL_PASSWORD', ''))
+    except mysql.connector.Error as e:
+        raise BackendUnavailable(f"mysql backend unavailable: {e}")
+    try:
+        conn.cursor().execute(f'DROP DATABASE IF EXISTS `{name}`')
+    finally:
+        conn.close()
+
+
+def add_doctors(module, backend, count):
+    """Create `count` doctor accounts and return their (username, user id) pairs"""
+    ph = '?' if backend == 'sqlite' else '%s'
+    conn = module.pool.acquire()
+    cursor = conn.cursor()
+    doctors = []
+    try:
+        for i in range(count):
+            username = f'bench-doctor-{i}'
+            cursor.execute(f'INSERT INTO users (username, password, role) VALUES ({ph}, {ph}, {ph})',
+                           (username, 'bench', 'doctor'))
+            doctors.append((username, cursor.lastrowid))
+        conn.commit()
+    finally:
+        cursor.close()
+        module.pool.release(conn)
+    return doctors
+
+
+def count_waiting(module):
+    """Waiting patients according to the database (the engine may not be loaded)"""
+    conn = module.pool.acquire()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM patients WHERE status = 'Waiting'")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        module.pool.release(conn)
+
+
+class Scenario:
+    """Runs the three phases and returns machine-readable results"""
+
+    def __init__(self, module, backend, mode='client', patients=500, kiosks=4, pollers=20,
+                 screens=2, doctors=4, duration=10.0, think_time=0.0, bulk_size=100):
+        self.module = module
+        self.backend = backend
+        self.mode = mode
+        self.patients = patients
+        self.kiosks = kiosks
+        self.pollers = pollers
+        self.screens = screens
+        self.doctors = doctors
+        self.duration = duration
+        self.think_time = think_time
+        self.bulk_size = bulk_size
+        self._server = None
+
+    def session(self):
+        if self.mode == 'client':
+            return TestClientSession(self.module.app)
+        return HttpSession('127.0.0.1', self._server.server_port)
+
+    def timed(self, recorder, session, route, method, path, **kwargs):
+        started = time.perf_counter()
+        status, headers = session.request(method, path, **kwargs)
+        recorder.record(route, time.perf_counter() - started, status)
+        return status, headers
+
+    def run(self):
+        if self.mode == 'wsgi':
+            self._start_server()
+        try:
+            doctors = add_doctors(self.module, self.backend, self.doctors)
+            phases = {
+                'registration': self.registration_phase(),
+                'steady': self.steady_phase(doctors),
+            }
+            claim_summary, claim_check = self.claim_check_phase(doctors)
+            phases['claim_check'] = claim_summary
+            phases['bulk_registration'] = self.bulk_registration_phase(doctors)
+        finally:
+            if self._server:
+                self._server.shutdown()
+        return {
+            'meta': {
+                'backend': self.backend,
+                'mode': self.mode,
+                'templates': 'stand-in' if isinstance(self.module.app.jinja_loader, jinja2.DictLoader) else 'app',
+                'patients': self.patients,
+                'kiosks': self.kiosks,
+                'pollers': self.pollers,
+                'screens': self.screens,
+                'doctors': self.doctors,
+                'duration_s': self.duration,
+                'think_time_s': self.think_time,
+                'bulk_size': self.bulk_size,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'phases': phases,
+            'checks': {'no_double_claims': claim_check},
+        }
+
+    def _start_server(self):
+        from werkzeug.serving import make_server
+        # One access log line per request would dominate the measurement
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self._server = make_server('127.0.0.1', 0, self.module.app, threaded=True)
+        threading.Thread(target=self._server.serve_forever, name='bench-wsgi', daemon=True).start()
+
+    def _run_actors(self, recorder, actors):
+        threads = [threading.Thread(target=actor, daemon=True) for actor in actors]
+        recorder.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recorder.stop()
+        return recorder.summary()
+
+    def _login(self, session, username, password):
+        status, _ = session.request('POST', '/login', data={'username': username, 'password': password})
+        if status != 302:
+            raise RuntimeError(f"login failed for {username} (HTTP {status})")
+
+    def registration_phase(self):
+        recorder = Recorder()
+        counter = iter(range(self.patients))
+        lock = threading.Lock()
+
+        def kiosk():
+            session = self.session()
+            while True:
+                with lock:
+                    n = next(counter, None)
+                if n is None:
+                    return
+                self.timed(recorder, session, 'POST /register', 'POST', '/register', data={
+                    'name': f'Patient {n}',
+                    'department': DEPARTMENTS[n % len(DEPARTMENTS)],
+                    'symptoms': 'Benchmark symptoms',
+                })
+
+        summary = self._run_actors(recorder, [kiosk] * self.kiosks)
+        summary['patients_per_s'] = _per_second(self.patients, summary['elapsed_s'])
+        return summary
+
+    def bulk_registration_phase(self, doctors):
+        """Register the same patients as registration_phase, bulk_size per request"""
+        recorder = Recorder()
+        batches = iter(range(0, self.patients, self.bulk_size))
+        lock = threading.Lock()
+
+        def clerk(username):
+            def run():
+                session = self.session()
+                # The bulk API is for signed-in staff
+                self._login(session, username, 'bench')
+                while True:
+                    with lock:
+                        start = next(batches, None)
+                    if start is None:
+                        return
+                    patients = [{
+                        'name': f'Bulk patient {n}',
+                        'department': DEPARTMENTS[n % len(DEPARTMENTS)],
+                        'symptoms': 'Benchmark symptoms',
+                    } for n in range(start, min(start + self.bulk_size, self.patients))]
+                    self.timed(recorder, session, 'POST /api/patients/bulk', 'POST', '/api/patients/bulk',
+                               json_body=patients)
+            return run
+
+        summary = self._run_actors(recorder, [clerk(doctors[i % len(doctors)][0]) for i in range(self.kiosks)])
+        summary['patients_per_s'] = _per_second(self.patients, summary['elapsed_s'])
+        return summary
+
+    def steady_phase(self, doctors):
+        recorder = Recorder()
+        deadline = time.perf_counter() + self.duration
+
+        def poller(use_since):
+            def run():
+                session = self.session()
+                etag = None
+                version = None
+                while time.perf_counter() < deadline:
+                    if use_since and version is not None:
+                        status, headers = self.timed(recorder, session, 'GET /api/queue?since', 'GET',
+                                                     f'/api/queue?since={version}')
+                    else:
+                        status, headers = self.timed(recorder, session, 'GET /api/queue', 'GET', '/api/queue',
+                                                     headers={'If-None-Match': etag} if etag else None)
+                        etag = headers.get('ETag', etag)
+                    version = headers.get('X-Queue-Version', version)
+                    if self.think_time:
+                        time.sleep(self.think_time)
+            return run
+
+        def screen():
+            session = self.session()
+            while time.perf_counter() < deadline:
+                self.timed(recorder, session, 'GET /queue', 'GET', '/queue')
+                if self.think_time:
+                    time.sleep(self.think_time)
+
+        def doctor(username, user_id):
+            def run():
+                session = self.session()
+                self._login(session, username, 'bench')
+                while time.perf_counter() < deadline:
+                    self.timed(recorder, session, 'POST /next_patient', 'POST', '/next_patient')
+                    self.timed(recorder, session, 'GET /dashboard', 'GET', '/dashboard')
+                    patient = self.module.queue_engine.current(doctor_id=user_id)
+                    if patient:
+                        self.timed(recorder, session, 'POST /complete_patient', 'POST',
+                                   f"/complete_patient/{patient['id']}")
+                    if self.think_time:
+                        time.sleep(self.think_time)
+            return run
+
+        actors = [poller(use_since=i % 4 == 3) for i in range(self.pollers)]
+        actors += [screen] * self.screens
+        actors += [doctor(username, user_id) for username, user_id in doctors]
+        return self._run_actors(recorder, actors)
+
+    def claim_check_phase(self, doctors):
+        """Call every waiting patient concurrently; each must be claimed once"""
+        recorder = Recorder()
+        waiting = count_waiting(self.module)
+        remaining = iter(range(waiting))
+        lock = threading.Lock()
+        subscription = self.module.broadcaster.subscribe()
+        called = []
+        done = threading.Event()
+
+        def collect():
+            # Drain as we go so a long queue cannot overflow the subscription
+            while True:
+                message = subscription.get(timeout=0.2)
+                if message is None:
+                    if done.is_set():
+                        return
+                elif message[1] == 'called':
+                    called.append(message[2]['id'])
+
+        def doctor(username):
+            def run():
+                session = self.session()
+                self._login(session, username, 'bench')
+                while True:
+                    with lock:
+                        n = next(remaining, None)
+                    if n is None:
+                        return
+                    self.timed(recorder, session, 'POST /next_patient', 'POST', '/next_patient')
+            return run
+
+        collector = threading.Thread(target=collect, daemon=True)
+        collector.start()
+        try:
+            summary = self._run_actors(recorder, [doctor(username) for username, _ in doctors])
+        finally:
+            done.set()
+            collector.join()
+            subscription.close()
+
+        duplicates = len(called) - len(set(called))
+        left = count_waiting(self.module)
+        ok = duplicates == 0 and len(called) == waiting and left == 0
+        detail = (f"{waiting} waiting, {len(called)} called events, "
+                  f"{len(set(called))} distinct patients, {duplicates} double claims, {left} left waiting")
+        return summary, {'ok': ok, 'detail': detail}
+
+
+def _per_second(count, elapsed):
+    return round(count / elapsed, 1) if elapsed > 0 else None
@@ -0,0 +1,131 @@
+"""Bulk patient registration shared by app.py and app_mysql.py
+
+POST /api/patients/bulk takes a JSON list (or {"patients": [...]}) or a CSV
+file with name, department and symptoms columns. Valid rows are registered
+in one transaction: one token allocation per department for all of its
+rows, one queue version bump, and a single executemany INSERT. Invalid rows
+are reported back with their errors and do not stop the rest.
+"""
+import csv
+import io
+import json
+
+from stats import day_of
+from tokens import format_token
+
+# Largest batch accepted in one request
+MAX_BULK_ROWS = 1000
+
+# Column limits from the MySQL schema (VARCHAR sizes)
+FIELD_LIMITS = {'name': 100, 'department': 50, 'symptoms': None}
+
+
+class BulkError(ValueError):
+    """The request body as a whole could not be read"""
+
+
+def parse_bulk_body(content_type, body):
+    """Return the list of submitted rows (dicts) from a JSON or CSV body"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+    if content_type in ('text/csv', 'application/csv'):
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        try:
+            data = json.loads(text or 'null')
+        except ValueError:
+            raise BulkError('Body must be JSON or CSV')
+        rows = data.get('patients') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise BulkError('Expected a list of patients')
+    if not rows:
+        raise BulkError('No patients given')
+    if len(rows) > MAX_BULK_ROWS:
+        raise BulkError(f'At most {MAX_BULK_ROWS} patients per request')
+    return rows
+
+
+def validate_row(row):
+    """Return (patient, errors) for one submitted row"""
+    if not isinstance(row, dict):
+        return None, ['Row must be an object']
+    patient = {}
+    errors = []
+    for field, limit in FIELD_LIMITS.items():
+        value = row.get(field)
+        value = value.strip() if isinstance(value, str) else ''
+        if not value:
+            errors.append(f'{field} is required')
+        elif limit and len(value) > limit:
+            errors.append(f'{field} must be at most {limit} characters')
+        patient[field] = value
+    return (None, errors) if errors else (patient, [])
+
+
+def assign_tokens(conn, patients, allocator):
+    """Allocate token_no for each patient, in submission order within each department
+
+    Block allocation commits on its own, so call this before writing
+    anything else in the transaction.
+    """
+    by_department = {}
+    for patient in patients:
+        by_department.setdefault(patient['department'], []).append(patient)
+    for department, group in by_department.items():
+        numbers = allocator.allocate(conn, department, len(group))
+        for patient, number in zip(group, numbers):
+            patient['token_no'] = format_token(department, number)
+
+
+def register_patients(conn, cursor, patients, time_in, allocator, stats, bump_version,
+                      placeholder='?'):
+    """Insert validated patients in the caller's transaction
+
+    Patients without a token_no get one first (see assign_tokens), and
+    patients without their own time_in are stamped with `time_in`. Returns
+    (patient dicts in input order, queue version); the caller commits.
+    """
+    unassigned = [p for p in patients if not p.get('token_no')]
+    if unassigned:
+        assign_tokens(conn, unassigned, allocator)
+    for patient in patients:
+        patient.setdefault('time_in', time_in)
+
+    version = bump_version(cursor)
+    ph = placeholder
+    cursor.executemany(f'''
+        INSERT INTO patients (token_no, name, department, symptoms, status, time_in, version)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+    ''', [(p['token_no'], p['name'], p['department'], p['symptoms'], 'Waiting', p['time_in'], version)
+          for p in patients])
+
+    # Every row of this batch carries the new version, so one indexed read
+    # returns their ids whatever the driver reports for executemany
+    cursor.execute(f'SELECT id, department, token_no FROM patients WHERE version = {ph}', (version,))
+    ids = {}
+    for row in cursor.fetchall():
+        patient_id, department, token_no = row.values() if isinstance(row, dict) else tuple(row)
+        ids[(department, token_no)] = patient_id
+
+    counts = {}
+    for patient in patients:
+        key = (patient['department'], day_of(patient['time_in']))
+        if key not in counts:
+            counts[key] = [patient['time_in'], 0]
+        counts[key][1] += 1
+    for (department, _day), (first_time_in, count) in counts.items():
+        stats.registered(cursor, department, first_time_in, count=count)
+
+    registered = []
+    for patient in patients:
+        registered.append({
+            'id': ids[(patient['department'], patient['token_no'])],
+            'token_no': patient['token_no'],
+            'name': patient['name'],
+            'department': patient['department'],
+            'symptoms': patient['symptoms'],
+            'status': 'Waiting',
+            'time_in': patient['time_in'],
+            'time_out': None
+        })
+    return registered, version
@@ -0,0 +1,241 @@
+"""Cross-worker change notification shared by app.py and app_mysql.py
+
+Under gunicorn each worker process has its own page cache, queue engine
+and stream subscribers, so a write made by one worker has to reach the
+others. Every queue write already bumps queue_version in its transaction;
+a ChangeWatcher thread in each worker polls that counter on a dedicated
+connection every few milliseconds. On SQLite it first checks
+PRAGMA data_version, which changes only when another connection commits
+and costs no page read, so an idle queue is almost free to watch.
+
+When the version moves, the watcher hands the rows written since the last
+version it saw to the app, which refreshes its caches and engine and
+re-publishes the changes to its own stream subscribers. With socket_dir
+set, writers also send a datagram to every worker's Unix socket in that
+directory, which wakes the watchers at once instead of at the next poll.
+
+A worker's own writes are not re-published. bump_queue_version() marks
+its version pending inside the transaction and queue_changed() confirms
+it as local once the commit succeeded; the watcher stops short of a
+pending version until then. One that is never confirmed was rolled back,
+and after confirm_timeout the watcher treats it as another writer's.
+"""
+import os
+import select
+import socket
+import threading
+import time
+
+# Stream event sent for a patient row in each status
+STATUS_EVENTS = {'Waiting': 'registered', 'In Consultation': 'called', 'Completed': 'completed'}
+
+
+class ChangeWatcher:
+    """Background thread that notices queue writes from any worker on this host
+
+    `connect()` opens the watcher's own connection, `on_change(conn,
+    old_version, new_version)` runs in the watcher thread after each change.
+    """
+
+    def __init__(self, connect, dialect, on_change, interval=0.02, socket_dir=None, confirm_timeout=1.0):
+        self.connect = connect
+        self.dialect = dialect
+        self.on_change = on_change
+        self.interval = interval
+        self.socket_dir = socket_dir
+        self.confirm_timeout = confirm_timeout
+        self.version = None
+        self._data_version = None
+        self._local = set()
+        # Versions being written by this worker -> when the watcher first waited on one
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sock = None
+        self._sock_path = None
+        self._sender = None
+        self.changes_seen = 0
+
+    def start(self):
+        """Start watching (no-op if disabled or already running in this process)"""
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        if self.socket_dir:
+            self._bind_socket()
+        self._thread = threading.Thread(target=self._loop, name='queue-change-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self._sock_path)
+            except OSError:
+                pass
+
+    def begin_write(self, version):
+        """Record a version this worker is writing (called inside its transaction)"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            self._pending.setdefault(version, None)
+
+    def local_write(self, version):
+        """Record a version this worker committed, so it is not re-published"""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            self._pending.pop(version, None)
+            self._local.add(version)
+
+    def take_local(self, up_to):
+        """Versions this worker wrote, up to and including `up_to`"""
+        with self._lock:
+            local = {v for v in self._local if v <= up_to}
+            self._local -= local
+            return local
+
+    def notify(self):
+        """Wake the other workers' watchers now (only with socket_dir)"""
+        if not self._sock_path:
+            return
+        for name in os.listdir(self.socket_dir):
+            path = os.path.join(self.socket_dir, name)
+            if not name.startswith('worker-') or path == self._sock_path:
+                continue
+            try:
+                self._sender.sendto(b'!', path)
+            except BlockingIOError:
+                pass  # Its buffer is full, so it has been woken already
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that exited
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {
+            'running': bool(self._thread and self._thread.is_alive()),
+            'interval': self.interval,
+            'socket': self._sock_path,
+            'version': self.version,
+            'changes_seen': self.changes_seen,
+        }
+
+    def _bind_socket(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self._sock_path = os.path.join(self.socket_dir, f'worker-{os.getpid()}.sock')
+        try:
+            os.unlink(self._sock_path)
+        except OSError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self._sock_path)
+        self._sock.setblocking(False)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+
+    def _loop(self):
+        conn = None
+        while not self._stop.is_set():
+            try:
+                if conn is None:
+                    conn = self.connect()
+                    if self.version is None:
+                        self.version = self._read_version(conn)
+                self._poll(conn)
+            except Exception as e:
+                print(f"Error watching queue changes: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+                self._stop.wait(1)
+                continue
+            self._wait()
+        if conn is not None:
+            conn.close()
+
+    def _poll(self, conn):
+        if self.dialect == 'sqlite':
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return
+        version = self._read_version(conn)
+        settled = self._settled(version) if version != self.version else version
+        if settled != self.version:
+            old, self.version = self.version, settled
+            self.changes_seen += 1
+            self.on_change(conn, old, settled)
+        if self.dialect == 'sqlite' and settled == version:
+            # A deferred version is read again on the next poll
+            self._data_version = data_version
+        # End the read snapshot so the next poll sees new commits (MySQL REPEATABLE READ)
+        conn.rollback()
+
+    def _settled(self, version):
+        """Highest version up to `version` below every unconfirmed write of this worker"""
+        now = time.monotonic()
+        with self._lock:
+            for pending in sorted(v for v in self._pending if self.version < v <= version):
+                waited_since = self._pending[pending]
+                if waited_since is None:
+                    # Versions commit in order, so this write has ended: the
+                    # confirmation is normally a few microseconds away
+                    self._pending[pending] = waited_since = now
+                if now - waited_since < self.confirm_timeout:
+                    return pending - 1
+                # Rolled back, and the version was committed by another writer
+                del self._pending[pending]
+            return version
+
+    def _read_version(self, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT version FROM queue_version WHERE id = 1')
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def _wait(self):
+        if self._sock is None:
+            self._stop.wait(self.interval)
+            return
+        readable, _, _ = select.select([self._sock], [], [], self.interval)
+        if readable:
+            # Drain every pending nudge; one poll covers them all
+            try:
+                while self._sock.recv(16):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def apply_changes(rows, local_versions, engine, broadcaster, to_dict, estimator=None):
+    """Bring a worker's engine, stream subscribers and estimates up to date with changed rows
+
+    Rows are applied to the engine even when this worker wrote them (the
+    operations are idempotent and the latest row state always wins), but
+    only other workers' changes are published and fed to the wait-time
+    estimator, since local writes were handled when they committed.
+    """
+    for row in rows:
+        if engine.loaded:
+            if row['status'] in ('Waiting', 'In Consultation'):
+                engine.add(row)
+            else:
+                engine.complete(row['id'])
+        if row['version'] not in local_versions:
+            event = STATUS_EVENTS.get(row['status'], 'changed')
+            if estimator is not None:
+                estimator.observe(event, row)
+            broadcaster.publish(event, to_dict(row), event_id=row['version'])
@@ -16,11 +16,27 @@ CREATE TABLE IF NOT EXISTS patients (
     status VARCHAR(20) DEFAULT 'Waiting',
     time_in DATETIME NOT NULL,
     time_out DATETIME NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    doctor_id INT NULL,
+    time_called DATETIME NULL,
     INDEX idx_status (status),
     INDEX idx_department (department),
-    INDEX idx_time_in (time_in)
+    INDEX idx_time_in (time_in),
+    INDEX idx_version (version),
+    INDEX idx_status_time_in (status, time_in),
+    INDEX idx_dept_status_time_in (department, status, time_in),
+    INDEX idx_status_time_out (status, time_out),
+    FULLTEXT INDEX ft_name_symptoms (name, symptoms)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- Create queue version table (single row, bumped by every queue write)
+CREATE TABLE IF NOT EXISTS queue_version (
+    id TINYINT PRIMARY KEY,
+    version BIGINT NOT NULL
+) ENGINE=InnoDB;
+
+INSERT IGNORE INTO queue_version (id, version) VALUES (1, 0);
+
 -- Create users table
 CREATE TABLE IF NOT EXISTS users (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -29,6 +45,90 @@ CREATE TABLE IF NOT EXISTS users (
     role VARCHAR(20) NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- Create history table for archived (completed) patients, partitioned by
+-- month of time_in; the app splits monthly partitions off pmax as it archives
+CREATE TABLE IF NOT EXISTS patients_history (
+    id INT NOT NULL,
+    token_no VARCHAR(20) NOT NULL,
+    name VARCHAR(100) NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    symptoms TEXT NOT NULL,
+    status VARCHAR(20),
+    time_in DATETIME NOT NULL,
+    time_out DATETIME NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    doctor_id INT NULL,
+    time_called DATETIME NULL,
+    archived_at DATETIME NOT NULL,
+    PRIMARY KEY (id, time_in),
+    INDEX idx_history_time_in (time_in),
+    INDEX idx_history_dept_time_in (department, time_in)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+PARTITION BY RANGE (TO_DAYS(time_in)) (
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Create tombstones for archived patients, so ?since= deltas can report removals
+CREATE TABLE IF NOT EXISTS archived_ids (
+    version BIGINT NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (version, id)
+) ENGINE=InnoDB;
+
+-- Create token counters table (one row per department and reset period)
+-- period is 'all', or the date when daily token reset is enabled
+CREATE TABLE IF NOT EXISTS token_sequences (
+    department VARCHAR(50) NOT NULL,
+    period VARCHAR(10) NOT NULL,
+    last_value INT NOT NULL,
+    PRIMARY KEY (department, period)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Create dashboard counter tables, updated by every queue write
+-- (run `flask --app app_mysql rebuild-stats` to reconcile them)
+CREATE TABLE IF NOT EXISTS department_stats (
+    department VARCHAR(50) PRIMARY KEY,
+    waiting INT NOT NULL DEFAULT 0,
+    in_consultation INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day DATE NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    registered INT NOT NULL DEFAULT 0,
+    called INT NOT NULL DEFAULT 0,
+    completed INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, department)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Create hourly report rollups, updated as each patient completes
+-- (run `flask --app app_mysql backfill-rollups` to recompute them)
+CREATE TABLE IF NOT EXISTS hourly_rollups (
+    hour DATETIME NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    patients INT NOT NULL DEFAULT 0,
+    waited INT NOT NULL DEFAULT 0,
+    wait_seconds BIGINT NOT NULL DEFAULT 0,
+    consulted INT NOT NULL DEFAULT 0,
+    consultation_seconds BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, department)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS hourly_rollup_buckets (
+    hour DATETIME NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    metric VARCHAR(20) NOT NULL,
+    bucket TINYINT NOT NULL,
+    patients INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, department, metric, bucket)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Schema version, written by the app once it has checked and seeded the schema
+CREATE TABLE IF NOT EXISTS schema_version (
+    id TINYINT PRIMARY KEY,
+    version INT NOT NULL
+) ENGINE=InnoDB;
+
 -- Insert default doctor user
 -- Password: doctor123
 INSERT INTO users (username, password, role) 
@@ -0,0 +1,385 @@
+"""Connection management shared by app.py (SQLite) and app_mysql.py (MySQL)
+
+Both apps borrow exactly one connection per request from a bounded pool and
+hand it back when the app context tears down, so the connect/auth handshake
+is paid once per pooled connection instead of once per query. The schema
+is set up by the first request or CLI command rather than at import.
+app_mysql.py guards acquisition with a CircuitBreaker, so while MySQL is
+down requests fail in microseconds instead of each waiting on connect().
+With a read replica configured, ReadRouter decides per public queue read
+whether the replica is fresh enough or the primary has to serve it.
+"""
+import threading
+import time
+from collections import deque
+
+
+def configure_sqlite(conn, pragmas):
+    """Apply per-connection PRAGMA settings (journal_mode=WAL persists in the file)"""
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the timeout"""
+
+
+class _Waiter:
+    """A thread blocked in acquire(), woken with a connection or a free slot"""
+    __slots__ = ('event', 'entry')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.entry = None
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of reusable database connections
+
+    `connect` creates a new connection, `validate` (optional) returns False
+    for a connection that should be thrown away instead of reused. It only
+    runs for connections that sat idle longer than `validate_after` seconds,
+    so a busy pool doesn't pay a ping round trip on every checkout.
+
+    Blocked callers are served first come, first served: a released
+    connection is handed straight to the longest waiter, so a thread that
+    checks connections out in a tight loop cannot starve the others.
+    """
+
+    def __init__(self, connect, size=5, timeout=5.0, validate=None, validate_after=0.0, name='db'):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._connect = connect
+        self._validate = validate
+        self._idle = []
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self, timeout=None):
+        """Check out a healthy connection, creating one if the pool has room"""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.perf_counter()
+        deadline = started + timeout
+
+        while True:
+            entry = self._take_idle_or_reserve(deadline)
+            if entry is None:
+                # A slot was reserved for us, open a fresh connection
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._free_slot()
+                    raise
+                break
+            conn, released_at = entry
+            if time.monotonic() - released_at >= self.validate_after and not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+            break
+
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back any open transaction"""
+        with self._lock:
+            self._in_use -= 1
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        entry = (conn, time.monotonic())
+        with self._lock:
+            if self._waiters:
+                self._wake(entry)
+            else:
+                self._idle.append(entry)
+
+    def close(self):
+        """Close every idle connection (used on shutdown and in tests)"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, _ = self._idle.pop()
+            self._discard(conn)
+
+    def stats(self):
+        """Snapshot of pool usage and wait-time counters"""
+        with self._lock:
+            return {
+                'name': self.name,
+                'size': self.size,
+                'created': self._created,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': len(self._waiters),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'wait_avg_ms': round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+    def _take_idle_or_reserve(self, deadline):
+        """Return an idle (conn, released_at) entry, or None for a reserved slot"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._created < self.size:
+                self._created += 1
+                return None
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+
+        waiter.event.wait(max(0.0, deadline - time.perf_counter()))
+        with self._lock:
+            # Checked under the lock: a hand-over may race with the timeout
+            if waiter.event.is_set():
+                return waiter.entry
+            self._waiters.remove(waiter)
+            self._timeouts += 1
+        raise PoolTimeout(f"No {self.name} connection available after {self.timeout}s "
+                          f"(pool size {self.size})")
+
+    def _wake(self, entry):
+        # Caller holds the lock; entry None hands over a free slot instead
+        waiter = self._waiters.popleft()
+        waiter.entry = entry
+        waiter.event.set()
+
+    def _free_slot(self):
+        # Caller holds the lock; a waiter takes the slot over if there is one
+        if self._waiters:
+            self._wake(None)
+        else:
+            self._created -= 1
+
+    def _is_healthy(self, conn):
+        if self._validate is None:
+            return True
+        try:
+            return bool(self._validate(conn))
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._free_slot()
+            self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class SchemaBootstrap:
+    """Runs the schema setup once per process, on first use instead of at import
+
+    `setup()` brings the schema up to date and returns False if it could not
+    (database unreachable). Concurrent first callers wait for one run; after
+    a failure the next attempt is made no sooner than `retry_after` seconds
+    later, so an unreachable database is not retried by every request.
+    """
+
+    def __init__(self, setup, retry_after=5.0):
+        self.setup = setup
+        self.retry_after = retry_after
+        self.done = False
+        self._lock = threading.Lock()
+        self._next_attempt = 0.0
+
+    def ensure(self):
+        """Run setup() unless it already succeeded; returns whether the schema is ready"""
+        if self.done:
+            return True
+        with self._lock:
+            if not self.done and time.monotonic() >= self._next_attempt:
+                if self.setup() is False:
+                    self._next_attempt = time.monotonic() + self.retry_after
+                else:
+                    self.done = True
+            return self.done
+
+
+class CircuitBreaker:
+    """Fails fast while the database is unreachable instead of letting every caller wait on it
+
+    Closed, every call goes through; `failure_threshold` failures in a row
+    open the breaker. Open, allow() returns False without touching the
+    database. Once `reset_timeout` seconds have passed, one caller is let
+    through as a probe (half-open): its success closes the breaker, its
+    failure reopens it for twice as long, up to `max_reset_timeout`. A probe
+    that never reports back is replaced by another after the same wait.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=1.0, max_reset_timeout=30.0, name='db'):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._retry_at = 0.0
+        self._opened = 0
+        self._rejected = 0
+        self._probes = 0
+
+    @property
+    def is_open(self):
+        """Whether calls are being refused right now (a probe may be due)"""
+        return self._state != 'closed'
+
+    def retry_after(self):
+        """Seconds until the next probe, for Retry-After headers"""
+        return max(0.0, self._retry_at - time.monotonic())
+
+    def allow(self):
+        """Whether the caller may try the database; must be followed by record_*()"""
+        if self._state == 'closed':
+            return True
+        with self._lock:
+            if self._state == 'closed':
+                return True
+            now = time.monotonic()
+            if now < self._retry_at:
+                self._rejected += 1
+                return False
+            # Half-open: this caller probes, everyone else keeps failing fast
+            self._state = 'half_open'
+            self._retry_at = now + self._timeout
+            self._probes += 1
+            return True
+
+    def record_success(self):
+        if self._state == 'closed' and not self._failures:
+            return
+        with self._lock:
+            if self._state != 'closed':
+                print(f"{self.name} reachable again, closing circuit breaker")
+            self._state = 'closed'
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def record_failure(self):
+        """Count a failed call; returns True if this failure opened the breaker"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == 'closed':
+                self._failures += 1
+                if self._failures < self.failure_threshold:
+                    return False
+                self._opened += 1
+                print(f"{self.name} unreachable after {self._failures} failures, "
+                      f"opening circuit breaker for {self._timeout:g}s")
+            elif self._state == 'half_open':
+                # Failed probe: back off exponentially before the next one
+                self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+            else:
+                # Late failure from a call let through before the breaker opened
+                return False
+            self._state = 'open'
+            self._retry_at = now + self._timeout
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'reset_timeout': self._timeout,
+                'retry_after': round(max(0.0, self._retry_at - time.monotonic()), 3) if self._state != 'closed' else 0.0,
+                'opened': self._opened,
+                'rejected': self._rejected,
+                'probes': self._probes,
+            }
+
+
+class ReadRouter:
+    """Decides whether a replica is fresh enough to serve a queue read
+
+    observe(version) records each queue version of the primary as this
+    process learns of it: its own commits and the change watcher's polls.
+    A replica at version r lags by the time since the primary first moved
+    past r. use_replica() sends a read to the primary when that exceeds
+    `max_lag` seconds, or when r is older than `min_version` (the caller's
+    own last write, or the version its client already has), so a session
+    never reads back past what it has seen.
+    """
+
+    def __init__(self, max_lag=2.0):
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        # (version, first seen) in ascending order, for the last max_lag seconds
+        self._seen = deque()
+        # Highest version first seen more than max_lag seconds ago
+        self._expired = 0
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def observe(self, version):
+        """Record a primary queue version (older or repeated versions are ignored)"""
+        if version is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            latest = self._seen[-1][0] if self._seen else self._expired
+            if version > latest:
+                self._seen.append((version, now))
+            self._expire(now)
+
+    def use_replica(self, version, min_version=None):
+        """Whether a replica read at queue `version` may be served to this caller"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            fresh = (min_version is None or version >= min_version) and version >= self._expired
+            if fresh:
+                # The earliest primary version past the replica's, scanning back from
+                # the newest: a healthy replica is only a few versions behind
+                first_seen = None
+                for seen_version, seen_at in reversed(self._seen):
+                    if seen_version <= version:
+                        break
+                    first_seen = seen_at
+                fresh = first_seen is None or now - first_seen <= self.max_lag
+            if fresh:
+                self.replica_reads += 1
+            else:
+                self.primary_reads += 1
+            return fresh
+
+    def stats(self):
+        with self._lock:
+            latest = self._seen[-1][0] if self._seen else self._expired
+            return {
+                'max_lag': self.max_lag,
+                'primary_version': latest,
+                'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+            }
+
+    def _expire(self, now):
+        # Caller holds the lock
+        while self._seen and now - self._seen[0][1] > self.max_lag:
+            self._expired = self._seen.popleft()[0]
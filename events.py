@@ -0,0 +1,108 @@
+"""In-process queue change broadcaster and Server-Sent Events helpers
+
+The write routes publish one event per change (registered, called,
+completed) and every /api/queue/stream subscriber receives it from memory,
+so waiting-room screens cost nothing while the queue is quiet.
+"""
+import json
+import queue
+import threading
+
+
+class Subscription:
+    """One subscriber's bounded inbox of pending events"""
+
+    def __init__(self, broadcaster, max_pending):
+        self._broadcaster = broadcaster
+        self._inbox = queue.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        """Next (id, event, data) tuple, or None if nothing arrived in time"""
+        try:
+            return self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+
+class Broadcaster:
+    """Fans change events out to every live subscriber
+
+    A subscriber that falls more than max_pending events behind is dropped
+    and told to resync, instead of letting its backlog grow without bound.
+    """
+
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.last_id = 0
+
+    def subscribe(self):
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event, data, event_id=None):
+        """Send an event to all subscribers and return its id
+
+        Callers pass the queue version as event_id so stream clients and
+        ?since= pollers share one cursor.
+        """
+        with self._lock:
+            self.last_id = event_id if event_id is not None else self.last_id + 1
+            message = (self.last_id, event, data)
+            for subscription in list(self._subscribers):
+                try:
+                    subscription._inbox.put_nowait(message)
+                except queue.Full:
+                    subscription.overflowed = True
+                    self._subscribers.discard(subscription)
+            return self.last_id
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def format_sse(event, data, event_id=None):
+    """Encode one Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def sse_stream(subscription, snapshot, snapshot_id, keepalive=15.0):
+    """Yield the initial snapshot, then change events until the client leaves
+
+    The snapshot must be fetched after subscribing so no change can fall in
+    between; events that overlap the snapshot carry full rows and are safe to
+    apply twice.
+    """
+    try:
+        yield format_sse('snapshot', snapshot, snapshot_id)
+        while True:
+            if subscription.overflowed:
+                # Client fell too far behind; it reconnects and gets a fresh snapshot
+                yield format_sse('resync', {})
+                return
+            message = subscription.get(timeout=keepalive)
+            if message is None:
+                # Comment line keeps proxies from timing out an idle stream
+                yield ': keepalive\n\n'
+                continue
+            event_id, event, data = message
+            yield format_sse(event, data, event_id)
+    finally:
+        subscription.close()
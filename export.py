@@ -0,0 +1,192 @@
+"""Streaming CSV / NDJSON export of patient records, shared by app.py and app_mysql.py
+
+An export reads its rows in fetchmany batches and yields one encoded chunk
+per batch, so memory stays flat however many years of history are asked
+for. Each export gets its own connection (never a pooled one, so it cannot
+starve the queue routes) and reads inside a single snapshot transaction:
+rows the archiver moves mid-export are neither missed nor repeated, and
+writers are not blocked (WAL on SQLite, MVCC on InnoDB). On MySQL the
+cursor is unbuffered, so rows come off the socket as they are written out.
+
+Archived patients come first in arrival order, then the live patients
+table in registration order; both orders are served by existing indexes,
+so the database never has to sort the range.
+"""
+import csv
+import io
+import json
+from datetime import date, timedelta
+
+from timestamps import DB_TIME, TIME_COLUMNS, format_time, to_ms
+
+# Columns written, in order
+COLUMNS = ('id', 'token_no', 'name', 'department', 'symptoms', 'status', 'doctor_id',
+           'time_in', 'time_called', 'time_out')
+
+# Positions of the columns formatted as 'YYYY-MM-DD HH:MM:SS' on the way out
+TIME_INDEXES = tuple(i for i, column in enumerate(COLUMNS) if column in TIME_COLUMNS)
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows fetched (and written out as one chunk) at a time
+BATCH_SIZE = 1000
+
+SQL = {
+    'sqlite': {
+        'begin': 'BEGIN',
+        'cursor': {},
+        'placeholder': '?',
+    },
+    'mysql': {
+        'begin': 'START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY',
+        'cursor': {'buffered': False},
+        'placeholder': '%s',
+    },
+}
+
+# (table, ORDER BY) in export order
+SOURCES = {
+    'patients_history': 'time_in, id',
+    'patients': 'id',
+}
+
+
+def parse_export_args(args):
+    """(format, filters, tables) from export query args / CLI options
+
+    from and to are YYYY-MM-DD days of arrival (to is inclusive); archived=0
+    leaves out patients_history. Raises ValueError with a message for the
+    client on bad input.
+    """
+    fmt = (args.get('format') or 'csv').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+    try:
+        start = date.fromisoformat(args['from']) if args.get('from') else None
+        end = date.fromisoformat(args['to']) if args.get('to') else None
+    except ValueError:
+        raise ValueError('from and to must be YYYY-MM-DD') from None
+    if start and end and start > end:
+        raise ValueError('from must not be after to')
+    filters = {
+        'department': (args.get('department') or '').strip() or None,
+        'date_from': f'{start.isoformat()} 00:00:00' if start else None,
+        'date_to': f'{(end + timedelta(days=1)).isoformat()} 00:00:00' if end else None,
+    }
+    archived = str(args.get('archived', '1')).lower() not in ('0', 'false', 'no')
+    tables = tuple(SOURCES) if archived else ('patients',)
+    return fmt, filters, tables
+
+
+def export_filename(fmt, filters):
+    """Attachment file name describing the exported range"""
+    start = filters['date_from'][:10] if filters['date_from'] else 'start'
+    end = (date.fromisoformat(filters['date_to'][:10]) - timedelta(days=1)).isoformat() if filters['date_to'] else 'now'
+    department = f"-{filters['department'].lower().replace(' ', '_')}" if filters['department'] else ''
+    return f'patients{department}-{start}-{end}.{fmt}'
+
+
+def export_query(table, filters, placeholder, db_time=to_ms):
+    """SELECT for one source table with the export filters applied"""
+    where = []
+    params = []
+    if filters['department']:
+        where.append(f'department = {placeholder}')
+        params.append(filters['department'])
+    if filters['date_from']:
+        where.append(f'time_in >= {placeholder}')
+        params.append(db_time(filters['date_from']))
+    if filters['date_to']:
+        where.append(f'time_in < {placeholder}')
+        params.append(db_time(filters['date_to']))
+    sql = f'''
+        SELECT {', '.join(COLUMNS)} FROM {table}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY {SOURCES[table]}
+    '''
+    return sql, params
+
+
+def _values(row):
+    # Epoch ms from SQLite and datetimes from MySQL both leave as text
+    values = list(row)
+    for i in TIME_INDEXES:
+        values[i] = format_time(values[i])
+    return values
+
+
+def encode_csv(rows, header=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(COLUMNS)
+    writer.writerows(_values(row) for row in rows)
+    return buffer.getvalue()
+
+
+def encode_ndjson(rows):
+    return ''.join(json.dumps(dict(zip(COLUMNS, _values(row))), ensure_ascii=False) + '\n'
+                   for row in rows)
+
+
+class ExportStream:
+    """Iterable of text chunks for one export; close() releases its connection
+
+    Takes ownership of `conn`. It is closed when the last chunk has been
+    produced, or by close() when the client goes away mid-download (WSGI
+    servers call close() on the response iterable either way).
+    """
+
+    def __init__(self, conn, dialect, fmt, filters, tables=tuple(SOURCES), batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.sql = SQL[dialect]
+        self.db_time = DB_TIME[dialect]
+        self.fmt = fmt
+        self.filters = filters
+        self.tables = tables
+        self.batch_size = batch_size
+        self.rows = 0
+        self._cursor = None
+
+    def __iter__(self):
+        if self.conn is None:
+            return
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(self.sql['begin'])
+            cursor.close()
+            if self.fmt == 'csv':
+                yield encode_csv((), header=True)
+            for table in self.tables:
+                sql, params = export_query(table, self.filters, self.sql['placeholder'], self.db_time)
+                self._cursor = self.conn.cursor(**self.sql['cursor'])
+                self._cursor.execute(sql, params)
+                while True:
+                    batch = self._cursor.fetchmany(self.batch_size)
+                    if not batch:
+                        break
+                    self.rows += len(batch)
+                    yield encode_csv(batch) if self.fmt == 'csv' else encode_ndjson(batch)
+                self._cursor.close()
+                self._cursor = None
+            self.conn.rollback()
+        finally:
+            self.close()
+
+    def close(self):
+        """Drop the cursor and connection (safe to call more than once)"""
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        # An abandoned unbuffered MySQL cursor still has rows on the wire;
+        # closing the connection discards them
+        for resource in (self._cursor, conn):
+            if resource is not None:
+                try:
+                    resource.close()
+                except Exception:
+                    pass
+        self._cursor = None
@@ -0,0 +1,296 @@
+"""Request, query and connection-pool timing for app.py and app_mysql.py
+
+Cheap enough to leave on under load: an observation is one bisect and a
+few additions under a lock, and the Prometheus text is only built when
+/metrics is scraped. Set METRICS_ENABLED=0 to turn instrumentation off.
+
+- http_request_duration_seconds{route, method, status}: Flask before/after hooks
+- db_query_duration_seconds{statement} and db_query_rows_total{statement}:
+  every cursor.execute / executemany on a pooled connection
+- db_pool_acquire_duration_seconds{pool}: time spent waiting for a connection
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+from flask import g, request
+
+# Upper bounds in seconds, from sub-millisecond lookups to slow page loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Distinct statement labels kept before the rest are folded into "other"
+MAX_STATEMENTS = 200
+
+HELP = {
+    'http_request_duration_seconds': 'Time spent handling a request, by route',
+    'db_query_duration_seconds': 'Time spent in cursor.execute, by normalized statement',
+    'db_query_rows_total': 'Rows fetched or affected, by normalized statement',
+    'db_pool_acquire_duration_seconds': 'Time spent waiting for a pooled connection',
+}
+
+
+class Histogram:
+    """Fixed-bucket latency histogram, plus a row counter used for queries"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def add_rows(self, count):
+        with self._lock:
+            self.rows += count
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Metrics:
+    """Named histograms and counters keyed by label values"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._queries = {}
+
+    def histogram(self, name, **labels):
+        """The histogram for a metric and label set, created on first use"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def query(self, sql):
+        """Histogram for a SQL string, cached by the raw text so repeats cost one dict lookup"""
+        histogram = self._queries.get(sql)
+        if histogram is None:
+            label = statement_label(sql)
+            with self._lock:
+                known = {labels for name, labels in self._histograms if name == 'db_query_duration_seconds'}
+                if (('statement', label),) not in known and len(known) >= MAX_STATEMENTS:
+                    label = 'other'
+            histogram = self.histogram('db_query_duration_seconds', statement=label)
+            if len(self._queries) < 4 * MAX_STATEMENTS:
+                self._queries[sql] = histogram
+        return histogram
+
+    def render(self, gauges=()):
+        """Prometheus text exposition format
+
+        `gauges` is an iterable of (name, labels dict, value) read at scrape
+        time, e.g. connection pool usage.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        # Query row counts live on the query histograms
+        query_rows = [(('db_query_rows_total', labels), histogram.rows)
+                      for (name, labels), histogram in histograms if name == 'db_query_duration_seconds']
+        for (name, labels), value in counters + query_rows:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for name, labels, value in gauges:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    """Collapse whitespace and literals so one query shape maps to one label"""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r"'[^']*'", "'?'", sql)
+    sql = re.sub(r'\b\d+\b', 'N', sql)
+    return sql[:160]
+
+
+def _number(value):
+    return str(int(value)) if value == int(value) else repr(float(value))
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = []
+    for key, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times execute/executemany and counts rows"""
+
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._query = None
+
+    def execute(self, sql, params=()):
+        self._query = query = self._metrics.query(sql)
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(sql, params)
+        finally:
+            query.observe(time.perf_counter() - started)
+        self._count_affected()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._query = query = self._metrics.query(sql)
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            query.observe(time.perf_counter() - started)
+        self._count_affected()
+        return self
+
+    def _count_affected(self):
+        # SELECTs report -1 (SQLite) or 0 (MySQL, before fetching); their rows are counted as fetched
+        if self._cursor.description is None and self._cursor.rowcount > 0:
+            self._query.add_rows(self._cursor.rowcount)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._query.add_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        if rows:
+            self._query.add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if rows:
+            self._query.add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._query.add_rows(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """Connection proxy whose cursors (and sqlite3's conn.execute) are timed"""
+
+    def __init__(self, conn, metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._metrics)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def instrument_connection(conn, metrics):
+    """Wrap a new pooled connection if instrumentation is on"""
+    return InstrumentedConnection(conn, metrics) if metrics.enabled else conn
+
+
+def timed_acquire(pool, metrics):
+    """pool.acquire(), recording the wait in db_pool_acquire_duration_seconds"""
+    if not metrics.enabled:
+        return pool.acquire()
+    started = time.perf_counter()
+    try:
+        return pool.acquire()
+    finally:
+        metrics.observe('db_pool_acquire_duration_seconds', time.perf_counter() - started, pool=pool.name)
+
+
+def pool_gauges(pool):
+    """Scrape-time gauges for a ConnectionPool"""
+    stats = pool.stats()
+    for state in ('idle', 'in_use', 'waiting'):
+        yield 'db_pool_connections', {'pool': pool.name, 'state': state}, stats[state]
+    yield 'db_pool_timeouts', {'pool': pool.name}, stats['timeouts']
+
+
+def instrument_app(app, metrics):
+    """Register the before/after hooks that time every request"""
+    if not metrics.enabled:
+        return
+    routes = {}
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            key = (route, request.method, response.status_code)
+            histogram = routes.get(key)
+            if histogram is None:
+                histogram = routes[key] = metrics.histogram('http_request_duration_seconds', route=route,
+                                                            method=request.method,
+                                                            status=str(response.status_code))
+            histogram.observe(time.perf_counter() - started)
+        return response
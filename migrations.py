@@ -0,0 +1,434 @@
+"""Versioned schema migrations for the SQLite backend (app.py)
+
+The schema version lives in PRAGMA user_version. migrate() reads it with one
+cheap query and applies only the steps above it, each in its own
+BEGIN IMMEDIATE transaction, so starting a worker against an up-to-date
+database no longer re-runs any DDL. Steps are written to be safe on
+databases created by the old CREATE TABLE IF NOT EXISTS init_db().
+
+To change the schema, append a new (version, description, function) entry
+to MIGRATIONS; never edit a step that has already shipped. Steps only run
+SQL written out in this file, never app code, so a step replayed on an old
+database does exactly what it did when it shipped.
+
+Run `python migrations.py [hospital.db]` to upgrade a database file ahead
+of deploying (for example the epoch-ms conversion in step 10, which
+rewrites the patient tables): it backs the file up first and compacts it
+afterwards.
+"""
+import argparse
+import sqlite3
+
+
+def _columns(cursor, table):
+    return {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+
+
+def _add_columns(cursor, table, columns):
+    existing = _columns(cursor, table)
+    for column, definition in columns:
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _baseline(cursor):
+    # Create patients table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_no TEXT NOT NULL,
+            name TEXT NOT NULL,
+            department TEXT NOT NULL,
+            symptoms TEXT NOT NULL,
+            status TEXT DEFAULT 'Waiting',
+            time_in TEXT NOT NULL,
+            time_out TEXT
+        )
+    ''')
+
+    # Create users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL
+        )
+    ''')
+
+    # Insert default doctor user if not exists
+    cursor.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('doctor',))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('''
+            INSERT INTO users (username, password, role)
+            VALUES (?, ?, ?)
+        ''', ('doctor', 'doctor123', 'doctor'))
+
+
+def _queue_version(cursor):
+    _add_columns(cursor, 'patients', [('version', 'INTEGER NOT NULL DEFAULT 0')])
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_version ON patients (version)')
+
+    # Single row, bumped by every queue write
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS queue_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO queue_version (id, version) VALUES (1, 0)')
+
+
+def _doctor_claims(cursor):
+    _add_columns(cursor, 'patients', [('doctor_id', 'INTEGER'), ('time_called', 'TEXT')])
+
+
+def _token_sequences(cursor):
+    # One row per department and reset period
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_sequences (
+            department TEXT NOT NULL,
+            period TEXT NOT NULL,
+            last_value INTEGER NOT NULL,
+            PRIMARY KEY (department, period)
+        )
+    ''')
+    # Seed each department's counter from the last token it issued
+    # (DEPT-001 style), so existing queues do not restart at 001
+    cursor.execute('''
+        SELECT department, token_no FROM patients
+        WHERE id IN (SELECT MAX(id) FROM patients GROUP BY department)
+    ''')
+    for department, token_no in cursor.fetchall():
+        try:
+            last_value = int(token_no.split('-')[-1])
+        except (ValueError, AttributeError):
+            last_value = 0
+        cursor.execute('INSERT OR IGNORE INTO token_sequences (department, period, last_value) VALUES (?, ?, ?)',
+                       (department, 'all', last_value))
+
+
+def _patients_history(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patients_history (
+            id INTEGER PRIMARY KEY,
+            token_no TEXT NOT NULL,
+            name TEXT NOT NULL,
+            department TEXT NOT NULL,
+            symptoms TEXT NOT NULL,
+            status TEXT,
+            time_in TEXT NOT NULL,
+            time_out TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            doctor_id INTEGER,
+            time_called TEXT,
+            archived_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_time_in ON patients_history (time_in)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_dept_time_in ON patients_history (department, time_in)')
+
+
+def _route_indexes(cursor):
+    # Queue pages, claims and the waiting count: status = ? ORDER BY time_in
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_status_time_in ON patients (status, time_in)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_dept_status_time_in ON patients (department, status, time_in)')
+    # Latest patient per department (token counter seeding)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_dept_id ON patients (department, id)')
+    # Recently completed panel and archival: status = 'Completed' ORDER BY / < time_out
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_status_time_out ON patients (status, time_out)')
+
+
+def _queue_stats(cursor):
+    # Current waiting / in-consultation gauges per department
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS department_stats (
+            department TEXT PRIMARY KEY,
+            waiting INTEGER NOT NULL DEFAULT 0,
+            in_consultation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Registered / called / completed per day and department
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            department TEXT NOT NULL,
+            registered INTEGER NOT NULL DEFAULT 0,
+            called INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, department)
+        )
+    ''')
+    # Fill both from the existing rows (times are still 'YYYY-MM-DD HH:MM:SS' text here)
+    cursor.execute('DELETE FROM department_stats')
+    cursor.execute('DELETE FROM daily_stats')
+    cursor.execute('''
+        INSERT INTO department_stats (department, waiting, in_consultation)
+        SELECT department, SUM(status = 'Waiting'), SUM(status = 'In Consultation') FROM patients
+        WHERE status IN ('Waiting', 'In Consultation')
+        GROUP BY department
+    ''')
+    events = ' UNION ALL '.join(
+        f"SELECT COALESCE(DATE({column}), DATE('now', 'localtime')) AS day, department, "
+        f"{int(slot == 0)} AS registered, {int(slot == 1)} AS called, {int(slot == 2)} AS completed "
+        f"FROM {table} WHERE {column} IS NOT NULL"
+        for table in ('patients', 'patients_history')
+        for slot, column in enumerate(('time_in', 'time_called', 'time_out')))
+    cursor.execute(f'''
+        INSERT INTO daily_stats (day, department, registered, called, completed)
+        SELECT day, department, SUM(registered), SUM(called), SUM(completed) FROM ({events})
+        GROUP BY day, department
+    ''')
+
+
+def _hourly_rollups(cursor):
+    # Patients and summed wait / consultation time per arrival hour and department
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_rollups (
+            hour TEXT NOT NULL,
+            department TEXT NOT NULL,
+            patients INTEGER NOT NULL DEFAULT 0,
+            waited INTEGER NOT NULL DEFAULT 0,
+            wait_seconds INTEGER NOT NULL DEFAULT 0,
+            consulted INTEGER NOT NULL DEFAULT 0,
+            consultation_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, department)
+        )
+    ''')
+    # Duration histograms behind the report medians
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_rollup_buckets (
+            hour TEXT NOT NULL,
+            department TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            patients INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, department, metric, bucket)
+        )
+    ''')
+    # Fill both from the completed patients (times are still text here):
+    # wait is time_in to time_called, consultation time_called to time_out,
+    # each left out when unknown or negative
+    completed = ' UNION ALL '.join(f'''
+        SELECT hour, department,
+               CASE WHEN wait >= 0 THEN wait END AS wait,
+               CASE WHEN consultation >= 0 THEN consultation END AS consultation
+        FROM (
+            SELECT substr(time_in, 1, 13) || ':00:00' AS hour, department,
+                   CAST(ROUND((julianday(time_called) - julianday(time_in)) * 86400) AS INTEGER) AS wait,
+                   CAST(ROUND((julianday(time_out) - julianday(time_called)) * 86400) AS INTEGER) AS consultation
+            FROM {table} WHERE status = 'Completed'
+        )
+    ''' for table in ('patients', 'patients_history'))
+    cursor.execute('DELETE FROM hourly_rollups')
+    cursor.execute('DELETE FROM hourly_rollup_buckets')
+    cursor.execute(f'''
+        INSERT INTO hourly_rollups (hour, department, patients, waited, wait_seconds, consulted, consultation_seconds)
+        SELECT hour, department, COUNT(*), COUNT(wait), COALESCE(SUM(wait), 0),
+               COUNT(consultation), COALESCE(SUM(consultation), 0)
+        FROM ({completed})
+        GROUP BY hour, department
+    ''')
+    # Bucket upper bounds in minutes as shipped; longer durations land in bucket 13
+    bounds = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240)
+    bucket = 'CASE ' + ' '.join(f'WHEN seconds <= {minutes * 60} THEN {i}' for i, minutes in enumerate(bounds)) \
+        + f' ELSE {len(bounds)} END'
+    cursor.execute(f'''
+        INSERT INTO hourly_rollup_buckets (hour, department, metric, bucket, patients)
+        SELECT hour, department, metric, bucket, COUNT(*) FROM (
+            SELECT hour, department, metric, {bucket} AS bucket FROM (
+                SELECT hour, department, 'wait' AS metric, wait AS seconds FROM ({completed}) WHERE wait IS NOT NULL
+                UNION ALL
+                SELECT hour, department, 'consultation', consultation FROM ({completed}) WHERE consultation IS NOT NULL
+            )
+        )
+        GROUP BY hour, department, metric, bucket
+    ''')
+
+
+def _patient_search(cursor):
+    # Full-text index over name and symptoms, reading its text from patients
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            name, symptoms,
+            content='patients', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    _patient_search_triggers(cursor)
+    cursor.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+
+def _patient_search_triggers(cursor):
+    # Triggers keep it in step with every insert, edit and archival delete
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, name, symptoms) VALUES (new.id, new.name, new.symptoms);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, symptoms)
+            VALUES ('delete', old.id, old.name, old.symptoms);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF name, symptoms ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, symptoms)
+            VALUES ('delete', old.id, old.name, old.symptoms);
+            INSERT INTO patients_fts (rowid, name, symptoms) VALUES (new.id, new.name, new.symptoms);
+        END
+    ''')
+
+
+def _epoch_ms(column):
+    # Local 'YYYY-MM-DD HH:MM:SS' text to epoch milliseconds ('utc' reads it as local time)
+    return (f"CASE WHEN {column} IS NULL OR {column} = '' THEN NULL "
+            f"WHEN typeof({column}) = 'integer' THEN {column} "
+            f"ELSE CAST(strftime('%s', {column}, 'utc') AS INTEGER) * 1000 END")
+
+
+def _rebuild_table(cursor, table, create, columns, time_columns):
+    # SQLite cannot change a column's type in place: copy into a new table,
+    # converting the time columns, then swap it in (indexes and triggers go
+    # with the old table and are recreated by the caller)
+    cursor.execute(create.format(table=f'{table}_new'))
+    selected = ', '.join(_epoch_ms(c) if c in time_columns else c for c in columns)
+    cursor.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {selected} FROM {table}')
+    cursor.execute(f'DROP TABLE {table}')
+    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+
+def _epoch_times(cursor):
+    time_columns = ('time_in', 'time_out', 'time_called', 'archived_at')
+    # Keep the AUTOINCREMENT high-water mark, which may be above MAX(id)
+    row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'patients'").fetchone()
+    _rebuild_table(cursor, 'patients', '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_no TEXT NOT NULL,
+            name TEXT NOT NULL,
+            department TEXT NOT NULL,
+            symptoms TEXT NOT NULL,
+            status TEXT DEFAULT 'Waiting',
+            time_in INTEGER NOT NULL,
+            time_out INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            doctor_id INTEGER,
+            time_called INTEGER
+        )
+    ''', ['id', 'token_no', 'name', 'department', 'symptoms', 'status', 'time_in', 'time_out',
+          'version', 'doctor_id', 'time_called'], time_columns)
+    if row:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'patients'", (row[0],))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_version ON patients (version)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_status_time_in ON patients (status, time_in)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_dept_status_time_in ON patients (department, status, time_in)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_dept_id ON patients (department, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_status_time_out ON patients (status, time_out)')
+    # Arrival range scans without a status (exports, token seeding)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_time_in ON patients (time_in)')
+    _patient_search_triggers(cursor)
+
+    _rebuild_table(cursor, 'patients_history', '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY,
+            token_no TEXT NOT NULL,
+            name TEXT NOT NULL,
+            department TEXT NOT NULL,
+            symptoms TEXT NOT NULL,
+            status TEXT,
+            time_in INTEGER NOT NULL,
+            time_out INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            doctor_id INTEGER,
+            time_called INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+    ''', ['id', 'token_no', 'name', 'department', 'symptoms', 'status', 'time_in', 'time_out',
+          'version', 'doctor_id', 'time_called', 'archived_at'], time_columns)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_time_in ON patients_history (time_in)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_dept_time_in ON patients_history (department, time_in)')
+
+
+def _archived_ids(cursor):
+    # Tombstones for archived patients, so ?since= deltas can report removals
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_ids (
+            version INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (version, id)
+        )
+    ''')
+
+
+MIGRATIONS = [
+    (1, 'patients and users tables, default doctor', _baseline),
+    (2, 'queue version counter', _queue_version),
+    (3, 'doctor and call time on claimed patients', _doctor_claims),
+    (4, 'per-department token counters', _token_sequences),
+    (5, 'patients_history archive table', _patients_history),
+    (6, 'indexes used by the queue routes', _route_indexes),
+    (7, 'dashboard counters', _queue_stats),
+    (8, 'hourly report rollups', _hourly_rollups),
+    (9, 'full-text patient search', _patient_search),
+    (10, 'patient times as integer epoch milliseconds', _epoch_times),
+    (11, 'archived patient tombstones for queue deltas', _archived_ids),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply pending migrations; returns the list of versions applied"""
+    applied = []
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return applied
+
+    for version, description, step in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-check under the write lock in case another worker got here first
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            step(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade a SQLite hospital database to the current schema')
+    parser.add_argument('database', nargs='?', default='hospital.db')
+    parser.add_argument('--no-backup', action='store_true', help='skip the copy made before migrating')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    if schema_version(conn) >= SCHEMA_VERSION:
+        print(f"{args.database} is already at schema version {SCHEMA_VERSION}")
+        return
+    if not args.no_backup:
+        backup = f'{args.database}.v{schema_version(conn)}.bak'
+        # The backup API copies a consistent snapshot, WAL contents included
+        target = sqlite3.connect(backup)
+        conn.backup(target)
+        target.close()
+        print(f"Backed up {args.database} to {backup}")
+    migrate(conn)
+    # Rewritten tables leave free pages behind; give them back to the filesystem
+    conn.execute('VACUUM')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Rendered-page cache for /queue shared by app.py and app_mysql.py
+
+Pages are keyed by the queue version (plus the query string and whatever
+else changes the output), so a cached page can never outlive the data it
+shows, and the write routes call invalidate() to drop old pages as soon as
+they commit. When many waiting-room screens miss at once, one request
+builds the page and the rest wait for its result instead of all running
+the same queries and render.
+
+LastGood keeps the most recent successful result per key regardless of
+version, for serving (marked stale) while the database is unreachable.
+"""
+import threading
+import time
+
+# Pages kept at once (one per distinct filter combination in use)
+MAX_PAGES = 64
+
+# How long a coalesced request waits for the builder before building itself
+BUILD_WAIT = 10.0
+
+
+class _Build:
+    """A page being built, which concurrent misses for the same key wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class PageCache:
+    """Version-keyed response bodies with coalesced rebuilds"""
+
+    def __init__(self, max_pages=MAX_PAGES, build_wait=BUILD_WAIT):
+        self.max_pages = max_pages
+        self.build_wait = build_wait
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._building = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_build(self, key, build):
+        """Cached body for key, or build() it once for every concurrent caller"""
+        with self._lock:
+            value = self._pages.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            pending = self._building.get(key)
+            if pending is None:
+                pending = self._building[key] = _Build()
+                generation = self._generation
+                self.misses += 1
+            else:
+                self.coalesced += 1
+                generation = None
+
+        if generation is None:
+            # Someone else is building this page; if they fail, build it ourselves
+            if pending.done.wait(self.build_wait) and pending.value is not None:
+                return pending.value
+            return build()
+
+        try:
+            value = build()
+            pending.value = value
+            with self._lock:
+                # Skip storing a page that a write invalidated mid-build
+                if generation == self._generation:
+                    if len(self._pages) >= self.max_pages:
+                        self._pages.clear()
+                    self._pages[key] = value
+            return value
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+            pending.done.set()
+
+    def invalidate(self):
+        """Drop every cached page (called by the write routes after commit)"""
+        with self._lock:
+            self._generation += 1
+            self._pages.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'pages': len(self._pages), 'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced}
+
+
+class LastGood:
+    """Most recent good result per key, kept to fall back on during an outage"""
+
+    def __init__(self, max_entries=MAX_PAGES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.served = 0
+
+    def save(self, key, value):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Oldest first: dicts keep insertion order and save() re-inserts
+                self._entries.pop(next(iter(self._entries)))
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+
+    def get(self, key):
+        """(value, saved_at epoch seconds) for key, or None if nothing was saved"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.served += 1
+            return entry
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'served': self.served}
@@ -0,0 +1,182 @@
+"""In-memory view of the live queue shared by app.py and app_mysql.py
+
+Waiting patients sit in one heap per department (plus one across all
+departments) ordered by (time_in, id), and patients in consultation in a
+small dict. The engine is loaded from the database on first use and kept
+up to date write-through by the register/call/complete routes, so the
+dashboard and "Call Next Patient" read the head of the queue and the
+waiting counts from memory instead of scanning patients.
+
+The database stays the source of truth: callers claim the patient returned
+by peek() with a conditional UPDATE and call discard() if the row turns out
+to have been taken already.
+"""
+import heapq
+import threading
+
+from timestamps import to_ms
+
+
+def _sort_key(patient):
+    # time_in is epoch ms in SQLite and a datetime in MySQL
+    return (to_ms(patient['time_in']), patient['id'])
+
+
+class QueueEngine:
+    """Per-department priority queues of waiting patients"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._waiting = {}
+        self._consulting = {}
+        self._heaps = {}
+        self._all = []
+        self._counts = {}
+        self._positions = {}
+        self._stale = 0
+
+    def load(self, patients):
+        """Rebuild from the Waiting and In Consultation rows in the database"""
+        with self._lock:
+            self._reset()
+            for patient in patients:
+                self._add(dict(patient))
+            self.loaded = True
+
+    def ensure_loaded(self, fetch_active):
+        """Load once, using fetch_active() to read the active rows"""
+        if self.loaded:
+            return
+        with self._lock:
+            if not self.loaded:
+                self.load(fetch_active())
+
+    def add(self, patient):
+        """Record a newly registered (or re-read) patient and return its copy"""
+        with self._lock:
+            self.complete(patient['id'])
+            patient = dict(patient)
+            self._add(patient)
+            return patient
+
+    def peek(self, department=None):
+        """Longest-waiting patient, overall or for one department"""
+        with self._lock:
+            heap = self._all if department is None else self._heaps.get(department)
+            while heap:
+                _, patient_id = heap[0]
+                patient = self._waiting.get(patient_id)
+                if patient is not None and (department is None or patient['department'] == department):
+                    return patient
+                heapq.heappop(heap)
+                self._stale = max(0, self._stale - 1)
+            return None
+
+    def call(self, patient_id, **changes):
+        """Move a waiting patient into consultation"""
+        with self._lock:
+            patient = self._remove_waiting(patient_id)
+            if patient is None:
+                return None
+            patient.update(changes)
+            patient['status'] = 'In Consultation'
+            self._consulting[patient_id] = patient
+            return patient
+
+    def complete(self, patient_id):
+        """Forget a patient whose consultation is finished"""
+        with self._lock:
+            self._consulting.pop(patient_id, None)
+            self._remove_waiting(patient_id)
+
+    def discard(self, patient_id):
+        """Drop a waiting entry that the database says is no longer waiting
+
+        Used after losing a claim race; the winner has already moved the
+        patient into consultation, so only the waiting entry is removed.
+        """
+        with self._lock:
+            self._remove_waiting(patient_id)
+
+    def current(self, department=None, doctor_id=None):
+        """Earliest-registered patient in consultation, optionally for one doctor"""
+        with self._lock:
+            patients = [p for p in self._consulting.values()
+                        if (department is None or p['department'] == department)
+                        and (doctor_id is None or p.get('doctor_id') == doctor_id)]
+            return min(patients, key=_sort_key) if patients else None
+
+    def positions(self, department):
+        """0-based place in line of each waiting patient in a department, by id
+
+        Built once per change to the department's queue and shared until the
+        next one, so callers can look up many patients cheaply.
+        """
+        with self._lock:
+            positions = self._positions.get(department)
+            if positions is None:
+                ordered = sorted(_sort_key(p) for p in self._waiting.values() if p['department'] == department)
+                positions = self._positions[department] = {patient_id: index
+                                                           for index, (_, patient_id) in enumerate(ordered)}
+            return positions
+
+    def find(self, token_no):
+        """Waiting or in-consultation patient holding a token, latest registration first"""
+        with self._lock:
+            matches = [p for p in list(self._waiting.values()) + list(self._consulting.values())
+                       if p['token_no'] == token_no]
+            return max(matches, key=lambda p: p['id']) if matches else None
+
+    def waiting_count(self, department=None):
+        with self._lock:
+            if department is None:
+                return len(self._waiting)
+            return self._counts.get(department, 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': self.loaded,
+                'waiting': dict(self._counts),
+                'in_consultation': len(self._consulting),
+                'stale_heap_entries': self._stale,
+            }
+
+    def _add(self, patient):
+        if patient['status'] == 'Waiting':
+            entry = _sort_key(patient)
+            self._waiting[patient['id']] = patient
+            heapq.heappush(self._heaps.setdefault(patient['department'], []), entry)
+            heapq.heappush(self._all, entry)
+            self._counts[patient['department']] = self._counts.get(patient['department'], 0) + 1
+            self._positions.pop(patient['department'], None)
+        elif patient['status'] == 'In Consultation':
+            self._consulting[patient['id']] = patient
+
+    def _remove_waiting(self, patient_id):
+        patient = self._waiting.pop(patient_id, None)
+        if patient is None:
+            return None
+        # Heap entries are removed lazily by peek(); compact if they pile up
+        self._counts[patient['department']] -= 1
+        self._positions.pop(patient['department'], None)
+        self._stale += 2
+        if self._stale > 2 * len(self._waiting) + 64:
+            self._compact()
+        return patient
+
+    def _compact(self):
+        self._heaps = {}
+        self._all = []
+        for patient in self._waiting.values():
+            entry = _sort_key(patient)
+            self._heaps.setdefault(patient['department'], []).append(entry)
+            self._all.append(entry)
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+        heapq.heapify(self._all)
+        self._stale = 0
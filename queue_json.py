@@ -0,0 +1,86 @@
+"""Cached, streamed JSON encoding of patient rows for /api/queue
+
+Each row is encoded once and the bytes are kept, keyed by
+(id, status, time_out), which is everything about a patient that changes
+after registration. Polls of an unchanged queue then cost a dict lookup
+per row instead of building and encoding a dict. Responses are assembled
+from those bytes; large ?since= deltas are streamed from the cursor in
+batches so memory stays flat however many rows match.
+
+orjson is used when installed (pip install orjson), otherwise the
+standard library encoder.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoded rows kept before the cache is emptied and refilled
+MAX_CACHED_ROWS = 20000
+
+# Rows pulled from the cursor per streamed chunk
+STREAM_BATCH_SIZE = 200
+
+
+def dumps(obj):
+    """Compact JSON bytes with sorted keys, like Flask's jsonify"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+
+class RowCache:
+    """Encoded-bytes cache for patient rows
+
+    `to_dict` is the app's patient_to_dict; it only runs on a cache miss.
+    The cache is simply emptied when it reaches max_rows, which keeps
+    lookups lock-free and is cheap to refill from the live queue.
+    """
+
+    def __init__(self, to_dict, max_rows=MAX_CACHED_ROWS):
+        self.to_dict = to_dict
+        self.max_rows = max_rows
+        self._rows = {}
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, row):
+        key = (row['id'], row['status'], row['time_out'])
+        encoded = self._rows.get(key)
+        if encoded is not None:
+            self.hits += 1
+            return encoded
+        self.misses += 1
+        encoded = dumps(self.to_dict(row))
+        if len(self._rows) >= self.max_rows:
+            self._rows = {}
+        self._rows[key] = encoded
+        return encoded
+
+    def clear(self):
+        """Drop every encoded row, e.g. after patients were archived"""
+        self._rows = {}
+
+    def stats(self):
+        return {'rows': len(self._rows), 'hits': self.hits, 'misses': self.misses,
+                'encoder': 'orjson' if orjson is not None else 'json'}
+
+
+def encode_array(rows, encode):
+    """JSON array of already-fetched rows"""
+    return b'[' + b','.join([encode(row) for row in rows]) + b']'
+
+
+def stream_rows(cursor, encode, prefix=b'[', suffix=b']', batch_size=STREAM_BATCH_SIZE):
+    """Yield a JSON array (wrapped in prefix/suffix) batch by batch from a cursor"""
+    yield prefix
+    separator = b''
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield separator + b','.join([encode(row) for row in rows])
+        separator = b','
+    yield suffix
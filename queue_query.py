@@ -0,0 +1,150 @@
+"""Filtered, keyset-paginated queue listing shared by app.py and app_mysql.py
+
+The queue is shown in status order (In Consultation, Waiting, Completed,
+anything else), newest first within each status. Instead of sorting on a
+computed CASE expression, a page is read one status at a time with
+`status = ? ... ORDER BY time_in DESC, id DESC`, which the composite
+(status, time_in) and (department, status, time_in) indexes answer
+directly. The cursor is the (status rank, time_in, id) of the last row sent,
+so every page costs the same no matter how deep into the table it is.
+
+Times travel in cursors as epoch milliseconds; `db_time` turns them and
+the date filters into the backend's column type (timestamps.DB_TIME).
+"""
+import base64
+import json
+from datetime import datetime, timedelta
+
+from timestamps import to_ms
+
+STATUS_ORDER = ['In Consultation', 'Waiting', 'Completed']
+OTHER_RANK = len(STATUS_ORDER)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def status_rank(status):
+    """Position of a status in the display order"""
+    try:
+        return STATUS_ORDER.index(status)
+    except ValueError:
+        return OTHER_RANK
+
+
+def encode_cursor(rank, time_in, patient_id):
+    """Opaque URL-safe cursor for the row a page ended on"""
+    raw = json.dumps([rank, to_ms(time_in), patient_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        rank, time_in, patient_id = json.loads(base64.urlsafe_b64decode(padded))
+        # Cursors handed out before times were stored as epoch ms hold text
+        return int(rank), to_ms(time_in), int(patient_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'{name} must be YYYY-MM-DD')
+
+
+def parse_queue_args(args):
+    """Read department/status/date_from/date_to/limit/cursor query parameters
+
+    Raises ValueError with a user-facing message for malformed values.
+    """
+    filters = {
+        'department': args.get('department', '').strip() or None,
+        'status': args.get('status', '').strip() or None,
+        'date_from': None,
+        'date_to': None,
+        'limit': DEFAULT_PAGE_SIZE,
+        'cursor': None,
+    }
+    if args.get('date_from'):
+        filters['date_from'] = _parse_date(args['date_from'], 'date_from').strftime('%Y-%m-%d %H:%M:%S')
+    if args.get('date_to'):
+        # date_to is inclusive, so compare against the start of the next day
+        end = _parse_date(args['date_to'], 'date_to') + timedelta(days=1)
+        filters['date_to'] = end.strftime('%Y-%m-%d %H:%M:%S')
+    if args.get('limit'):
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            raise ValueError('limit must be a number')
+        filters['limit'] = max(1, min(limit, MAX_PAGE_SIZE))
+    if args.get('cursor'):
+        filters['cursor'] = decode_cursor(args['cursor'])
+    return filters
+
+
+def fetch_queue_page(execute, filters, placeholder='?', db_time=to_ms):
+    """Return (rows, next_cursor) for one page of the queue
+
+    `execute(sql, params)` runs a query and returns its rows; rows must
+    support row['column'] access. next_cursor is None on the last page.
+    """
+    limit = filters['limit']
+    if filters['cursor']:
+        start_rank, after_time, after_id = filters['cursor']
+    else:
+        start_rank, after_time, after_id = 0, None, None
+
+    if filters['status']:
+        ranks = [status_rank(filters['status'])]
+    else:
+        ranks = range(OTHER_RANK + 1)
+
+    rows = []
+    for rank in ranks:
+        if rank < start_rank:
+            continue
+
+        where = []
+        params = []
+        if filters['status']:
+            where.append(f'status = {placeholder}')
+            params.append(filters['status'])
+        elif rank < OTHER_RANK:
+            where.append(f'status = {placeholder}')
+            params.append(STATUS_ORDER[rank])
+        else:
+            where.append(f"status NOT IN ({', '.join([placeholder] * len(STATUS_ORDER))})")
+            params.extend(STATUS_ORDER)
+        if filters['department']:
+            where.append(f'department = {placeholder}')
+            params.append(filters['department'])
+        if filters['date_from']:
+            where.append(f'time_in >= {placeholder}')
+            params.append(db_time(filters['date_from']))
+        if filters['date_to']:
+            where.append(f'time_in < {placeholder}')
+            params.append(db_time(filters['date_to']))
+        if after_time is not None and rank == start_rank:
+            where.append(f'(time_in < {placeholder} OR (time_in = {placeholder} AND id < {placeholder}))')
+            params.extend([db_time(after_time), db_time(after_time), after_id])
+
+        # One row past the page tells us whether there is a next page
+        wanted = limit + 1 - len(rows)
+        rows.extend(execute(f'''
+            SELECT * FROM patients
+            WHERE {' AND '.join(where)}
+            ORDER BY time_in DESC, id DESC
+            LIMIT {int(wanted)}
+        ''', params))
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(status_rank(last['status']), last['time_in'], last['id'])
+    return rows, next_cursor
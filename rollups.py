@@ -0,0 +1,260 @@
+"""Hourly report rollups shared by app.py and app_mysql.py
+
+Reports over months of history are answered from two small tables instead
+of GROUP BYs over the patient tables:
+
+- hourly_rollups: per (hour of arrival, department) the number of patients
+  and the summed wait (time_in to time_called) and consultation
+  (time_called to time_out) seconds
+- hourly_rollup_buckets: the same patients counted in fixed duration
+  buckets, so medians can be estimated over any range by adding counts
+
+complete_patient folds each patient in with a few upserts inside its own
+transaction. rebuild() recomputes a range from patients and
+patients_history (the backfill command).
+"""
+from bisect import bisect_left
+from datetime import date, timedelta
+
+from stats import row_values
+from timestamps import DB_TIME, format_time
+from wait_times import to_seconds
+
+# Bucket upper bounds in minutes; longer durations land in a final open bucket
+BUCKET_MINUTES = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240)
+
+# How reports can be grouped, besides by department
+GROUPS = ('department', 'day', 'hour', 'hour_of_day')
+
+# Patient rows read per fetch during a rebuild
+REBUILD_BATCH_SIZE = 1000
+
+SQL = {
+    'sqlite': {
+        'hourly': '''
+            INSERT INTO hourly_rollups (hour, department, patients, waited, wait_seconds, consulted, consultation_seconds)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(hour, department) DO UPDATE SET
+                patients = patients + excluded.patients,
+                waited = waited + excluded.waited,
+                wait_seconds = wait_seconds + excluded.wait_seconds,
+                consulted = consulted + excluded.consulted,
+                consultation_seconds = consultation_seconds + excluded.consultation_seconds
+        ''',
+        'bucket': '''
+            INSERT INTO hourly_rollup_buckets (hour, department, metric, bucket, patients) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(hour, department, metric, bucket) DO UPDATE SET patients = patients + excluded.patients
+        ''',
+        'periods': {
+            'department': "'all'",
+            'day': 'substr(hour, 1, 10)',
+            'hour': 'hour',
+            'hour_of_day': 'CAST(substr(hour, 12, 2) AS INTEGER)',
+        },
+        'placeholder': '?',
+    },
+    'mysql': {
+        'hourly': '''
+            INSERT INTO hourly_rollups (hour, department, patients, waited, wait_seconds, consulted, consultation_seconds)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                patients = patients + VALUES(patients),
+                waited = waited + VALUES(waited),
+                wait_seconds = wait_seconds + VALUES(wait_seconds),
+                consulted = consulted + VALUES(consulted),
+                consultation_seconds = consultation_seconds + VALUES(consultation_seconds)
+        ''',
+        'bucket': '''
+            INSERT INTO hourly_rollup_buckets (hour, department, metric, bucket, patients) VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE patients = patients + VALUES(patients)
+        ''',
+        'periods': {
+            'department': "'all'",
+            'day': 'DATE(hour)',
+            'hour': 'hour',
+            'hour_of_day': 'HOUR(hour)',
+        },
+        'placeholder': '%s',
+    },
+}
+
+
+def hour_of(value):
+    """Rollup key ('YYYY-MM-DD HH:00:00') for a stored time: epoch ms, datetime or text"""
+    return format_time(value)[:13] + ':00:00'
+
+
+def bucket_of(seconds):
+    return bisect_left(BUCKET_MINUTES, seconds / 60)
+
+
+def durations(time_in, time_called, time_out):
+    """(wait seconds, consultation seconds) for a completed patient, None where unknown"""
+    arrived, called, finished = to_seconds(time_in), to_seconds(time_called), to_seconds(time_out)
+    # Patients completed before doctors claimed them have no call time
+    if called is None:
+        return None, None
+    wait = called - arrived if called >= arrived else None
+    consultation = finished - called if finished is not None and finished >= called else None
+    return wait, consultation
+
+
+def median_minutes(buckets):
+    """Median in minutes from {bucket: count}, interpolated within its bucket"""
+    total = sum(buckets.values())
+    if not total:
+        return None
+    target = total / 2
+    seen = 0
+    for bucket in sorted(buckets):
+        count = buckets[bucket]
+        if seen + count >= target:
+            lower = BUCKET_MINUTES[bucket - 1] if bucket > 0 else 0
+            if bucket >= len(BUCKET_MINUTES):
+                return float(lower)
+            upper = BUCKET_MINUTES[bucket]
+            return round(lower + (upper - lower) * (target - seen) / count, 1)
+        seen += count
+    return None
+
+
+class HourlyRollups:
+    """Transactional rollup updates and range reports"""
+
+    def __init__(self, dialect):
+        self.sql = SQL[dialect]
+        self.db_time = DB_TIME[dialect]
+
+    def completed(self, cursor, department, time_in, time_called, time_out):
+        """Fold one completed patient into the hour they arrived in"""
+        wait, consultation = durations(time_in, time_called, time_out)
+        hour = hour_of(time_in)
+        cursor.execute(self.sql['hourly'], (
+            hour, department, 1,
+            1 if wait is not None else 0, round(wait or 0),
+            1 if consultation is not None else 0, round(consultation or 0)))
+        for metric, seconds in (('wait', wait), ('consultation', consultation)):
+            if seconds is not None:
+                cursor.execute(self.sql['bucket'], (hour, department, metric, bucket_of(seconds), 1))
+
+    def report(self, cursor, start, end, group='department', department=None):
+        """Patients and average / median wait and consultation per period and department
+
+        start and end are dates; end is inclusive.
+        """
+        ph = self.sql['placeholder']
+        period = self.sql['periods'][group]
+        where = f'hour >= {ph} AND hour < {ph}'
+        params = [f'{start.isoformat()} 00:00:00', f'{(end + timedelta(days=1)).isoformat()} 00:00:00']
+        if department:
+            where += f' AND department = {ph}'
+            params.append(department)
+
+        rows = {}
+        cursor.execute(f'''
+            SELECT {period} AS period, department, SUM(patients), SUM(waited), SUM(wait_seconds),
+                   SUM(consulted), SUM(consultation_seconds)
+            FROM hourly_rollups WHERE {where}
+            GROUP BY {period}, department
+        ''', params)
+        for row in cursor.fetchall():
+            key, dept, patients, waited, wait_seconds, consulted, consultation_seconds = row_values(row, 7)
+            rows[(_period(key), dept)] = {
+                'period': _period(key),
+                'department': dept,
+                'patients': int(patients),
+                'avg_wait_minutes': _average(wait_seconds, waited),
+                'median_wait_minutes': None,
+                'avg_consultation_minutes': _average(consultation_seconds, consulted),
+                'median_consultation_minutes': None,
+            }
+
+        buckets = {}
+        cursor.execute(f'''
+            SELECT {period} AS period, department, metric, bucket, SUM(patients)
+            FROM hourly_rollup_buckets WHERE {where}
+            GROUP BY {period}, department, metric, bucket
+        ''', params)
+        for row in cursor.fetchall():
+            key, dept, metric, bucket, count = row_values(row, 5)
+            buckets.setdefault((_period(key), dept, metric), {})[int(bucket)] = int(count)
+        for (key, dept, metric), counts in buckets.items():
+            if (key, dept) in rows:
+                rows[(key, dept)][f'median_{metric}_minutes'] = median_minutes(counts)
+
+        result = sorted(rows.values(), key=lambda r: (r['period'], r['department']))
+        if group == 'department':
+            for row in result:
+                del row['period']
+        return result
+
+    def rebuild(self, cursor, since=None):
+        """Recompute the rollups for arrivals on or after `since` (a date; None = everything)"""
+        ph = self.sql['placeholder']
+        since_key = f'{since.isoformat()} 00:00:00' if since else '0000-01-01 00:00:00'
+        arrived = f'AND time_in >= {ph}' if since else ''
+        hourly = {}
+        buckets = {}
+        for table in ('patients', 'patients_history'):
+            cursor.execute(f'''
+                SELECT department, time_in, time_called, time_out FROM {table}
+                WHERE status = 'Completed' {arrived}
+            ''', (self.db_time(since),) if since else ())
+            while True:
+                batch = cursor.fetchmany(REBUILD_BATCH_SIZE)
+                if not batch:
+                    break
+                for row in batch:
+                    department, time_in, time_called, time_out = row_values(row, 4)
+                    wait, consultation = durations(time_in, time_called, time_out)
+                    key = (hour_of(time_in), department)
+                    totals = hourly.setdefault(key, [0, 0, 0, 0, 0])
+                    totals[0] += 1
+                    for metric, seconds, offset in (('wait', wait, 1), ('consultation', consultation, 3)):
+                        if seconds is not None:
+                            totals[offset] += 1
+                            totals[offset + 1] += round(seconds)
+                            bucket_key = key + (metric, bucket_of(seconds))
+                            buckets[bucket_key] = buckets.get(bucket_key, 0) + 1
+
+        cursor.execute(f'DELETE FROM hourly_rollups WHERE hour >= {ph}', (since_key,))
+        cursor.execute(f'DELETE FROM hourly_rollup_buckets WHERE hour >= {ph}', (since_key,))
+        if hourly:
+            cursor.executemany(
+                f'INSERT INTO hourly_rollups (hour, department, patients, waited, wait_seconds, consulted, '
+                f'consultation_seconds) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})',
+                [key + tuple(totals) for key, totals in hourly.items()])
+        if buckets:
+            cursor.executemany(
+                f'INSERT INTO hourly_rollup_buckets (hour, department, metric, bucket, patients) '
+                f'VALUES ({ph}, {ph}, {ph}, {ph}, {ph})',
+                [key + (count,) for key, count in buckets.items()])
+        return {'hours': len({hour for hour, _ in hourly}), 'patients': sum(t[0] for t in hourly.values())}
+
+
+def parse_report_args(args):
+    """(start date, end date, group, department) from /api/reports query args
+
+    Defaults to the last 30 days grouped by department; raises ValueError
+    with a message for the client on bad input.
+    """
+    try:
+        end = date.fromisoformat(args['to']) if args.get('to') else date.today()
+        start = date.fromisoformat(args['from']) if args.get('from') else end - timedelta(days=29)
+    except ValueError:
+        raise ValueError('from and to must be YYYY-MM-DD') from None
+    if start > end:
+        raise ValueError('from must not be after to')
+    group = args.get('group') or 'department'
+    if group not in GROUPS:
+        raise ValueError(f"group must be one of: {', '.join(GROUPS)}")
+    return start, end, group, args.get('department') or None
+
+
+def _period(value):
+    # Dates and datetimes from MySQL, text from SQLite, ints for hour_of_day
+    return value if isinstance(value, (int, str)) else str(value)
+
+
+def _average(total_seconds, count):
+    return round(float(total_seconds) / int(count) / 60, 1) if count else None
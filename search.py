@@ -0,0 +1,100 @@
+"""Full-text patient search shared by app.py and app_mysql.py
+
+Name and symptoms are indexed so the front desk can find a patient by a
+name or a symptom keyword without a LIKE '%...%' scan:
+
+- SQLite: the patients_fts FTS5 table (external content over patients),
+  kept in sync by insert/update/delete triggers, ranked with bm25 and name
+  matches weighted above symptom matches
+- MySQL: a FULLTEXT index on (name, symptoms), queried in boolean mode and
+  ranked by relevance
+
+Every search word is matched as a prefix ("jo" finds "John"), and all words
+must match. Results are paged with limit/offset.
+"""
+import re
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Words beyond this are ignored, which keeps odd input from building huge queries
+MAX_TERMS = 8
+
+# bm25 weight of a name match relative to a symptoms match (SQLite)
+NAME_WEIGHT = 10.0
+
+SQL = {
+    'sqlite': {
+        'search': f'''
+            SELECT p.*, bm25(patients_fts, {NAME_WEIGHT}, 1.0) AS score
+            FROM patients_fts JOIN patients p ON p.id = patients_fts.rowid
+            WHERE patients_fts MATCH ? {{filters}}
+            ORDER BY score, p.id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        'column_prefix': 'p.',
+        'placeholder': '?',
+    },
+    'mysql': {
+        'search': '''
+            SELECT *, MATCH(name, symptoms) AGAINST (%s IN BOOLEAN MODE) AS score
+            FROM patients
+            WHERE MATCH(name, symptoms) AGAINST (%s IN BOOLEAN MODE) {filters}
+            ORDER BY score DESC, id DESC
+            LIMIT %s OFFSET %s
+        ''',
+        'column_prefix': '',
+        'placeholder': '%s',
+    },
+}
+
+
+def search_terms(query):
+    """Lower-cased words of a search box entry (punctuation and operators dropped)"""
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def match_expression(dialect, terms):
+    """Every term as a required prefix match, in the backend's query syntax"""
+    if dialect == 'sqlite':
+        return ' '.join(f'"{term}"*' for term in terms)
+    return ' '.join(f'+{term}*' for term in terms)
+
+
+def parse_search_args(args):
+    """(terms, department, status, limit, offset) from /api/search query args
+
+    Raises ValueError with a user-facing message for bad input.
+    """
+    terms = search_terms(args.get('q', ''))
+    if not terms:
+        raise ValueError('q must contain at least one word')
+    try:
+        limit = int(args.get('limit') or DEFAULT_LIMIT)
+        offset = int(args.get('offset') or 0)
+    except ValueError:
+        raise ValueError('limit and offset must be numbers') from None
+    return (terms, args.get('department', '').strip() or None, args.get('status', '').strip() or None,
+            max(1, min(limit, MAX_LIMIT)), max(0, offset))
+
+
+def search_patients(execute, dialect, terms, department=None, status=None, limit=DEFAULT_LIMIT, offset=0):
+    """One page of matching patients, best match first, plus the next page's offset
+
+    `execute(sql, params)` runs a query and returns its rows.
+    """
+    sql = SQL[dialect]
+    ph, prefix = sql['placeholder'], sql['column_prefix']
+    match = match_expression(dialect, terms)
+    filters = ''
+    params = [match] if dialect == 'sqlite' else [match, match]
+    if department:
+        filters += f' AND {prefix}department = {ph}'
+        params.append(department)
+    if status:
+        filters += f' AND {prefix}status = {ph}'
+        params.append(status)
+    # One extra row says whether there is another page
+    rows = execute(sql['search'].format(filters=filters), params + [limit + 1, offset])
+    next_offset = offset + limit if len(rows) > limit else None
+    return rows[:limit], next_offset
@@ -0,0 +1,179 @@
+"""Incrementally maintained queue counters shared by app.py and app_mysql.py
+
+Two small tables replace the COUNT(*) scans on the dashboard:
+
+- department_stats: current waiting / in-consultation gauges per department
+- daily_stats: registered / called / completed counts per day and department
+
+Every write route bumps them with upserts inside its own transaction, so the
+counters commit or roll back with the patient row they describe. rebuild()
+recomputes both from patients (and patients_history) for reconciliation.
+"""
+from datetime import date
+
+from timestamps import to_datetime
+
+SQL = {
+    'sqlite': {
+        'gauge': '''
+            INSERT INTO department_stats (department, waiting, in_consultation) VALUES (?, ?, ?)
+            ON CONFLICT(department) DO UPDATE SET
+                waiting = waiting + excluded.waiting,
+                in_consultation = in_consultation + excluded.in_consultation
+        ''',
+        'daily': '''
+            INSERT INTO daily_stats (day, department, registered, called, completed) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(day, department) DO UPDATE SET
+                registered = registered + excluded.registered,
+                called = called + excluded.called,
+                completed = completed + excluded.completed
+        ''',
+        # Databases older than migration 10 still hold text times
+        'day': "CASE typeof({column}) WHEN 'integer' THEN date({column} / 1000, 'unixepoch', 'localtime') "
+               "ELSE date({column}) END",
+        'placeholder': '?',
+    },
+    'mysql': {
+        'gauge': '''
+            INSERT INTO department_stats (department, waiting, in_consultation) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                waiting = waiting + VALUES(waiting),
+                in_consultation = in_consultation + VALUES(in_consultation)
+        ''',
+        'daily': '''
+            INSERT INTO daily_stats (day, department, registered, called, completed) VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                registered = registered + VALUES(registered),
+                called = called + VALUES(called),
+                completed = completed + VALUES(completed)
+        ''',
+        'day': 'DATE({column})',
+        'placeholder': '%s',
+    },
+}
+
+
+def day_of(value):
+    """Day key (YYYY-MM-DD) for a stored time: epoch ms, datetime, date or text"""
+    if value is None:
+        return date.today().isoformat()
+    if isinstance(value, (int, float)):
+        return to_datetime(value).date().isoformat()
+    return str(value)[:10]
+
+
+class QueueStats:
+    """Transactional counter updates and O(1) reads"""
+
+    def __init__(self, dialect):
+        self.sql = SQL[dialect]
+
+    def registered(self, cursor, department, time_in, count=1):
+        self._bump(cursor, department, day_of(time_in), waiting=count, registered=count)
+
+    def called(self, cursor, department, time_called):
+        self._bump(cursor, department, day_of(time_called), waiting=-1, in_consultation=1, called=1)
+
+    def completed(self, cursor, department, time_out, previous_status):
+        """Count a completion; previous_status says which gauge to take it from"""
+        self._bump(cursor, department, day_of(time_out),
+                   waiting=-1 if previous_status == 'Waiting' else 0,
+                   in_consultation=-1 if previous_status == 'In Consultation' else 0,
+                   completed=1)
+
+    def _bump(self, cursor, department, day, waiting=0, in_consultation=0,
+              registered=0, called=0, completed=0):
+        if waiting or in_consultation:
+            cursor.execute(self.sql['gauge'], (department, waiting, in_consultation))
+        if registered or called or completed:
+            cursor.execute(self.sql['daily'], (day, department, registered, called, completed))
+
+    def registered_on(self, cursor, day, department=None):
+        """Patients registered on a day (one primary-key range read)"""
+        ph = self.sql['placeholder']
+        if department:
+            cursor.execute(f'SELECT registered FROM daily_stats WHERE day = {ph} AND department = {ph}',
+                           (day, department))
+        else:
+            cursor.execute(f'SELECT SUM(registered) FROM daily_stats WHERE day = {ph}', (day,))
+        row = cursor.fetchone()
+        value = (row[0] if not isinstance(row, dict) else list(row.values())[0]) if row else None
+        return int(value or 0)
+
+    def snapshot(self, cursor, day):
+        """Per-department gauges and the day's counters, plus totals"""
+        ph = self.sql['placeholder']
+        departments = {}
+        cursor.execute('SELECT department, waiting, in_consultation FROM department_stats')
+        for row in cursor.fetchall():
+            department, waiting, in_consultation = row_values(row, 3)
+            departments[department] = _empty_stats()
+            departments[department].update(waiting=int(waiting), in_consultation=int(in_consultation))
+        cursor.execute(f'''
+            SELECT department, registered, called, completed FROM daily_stats WHERE day = {ph}
+        ''', (day,))
+        for row in cursor.fetchall():
+            department, registered, called, completed = row_values(row, 4)
+            departments.setdefault(department, _empty_stats()).update(
+                registered=int(registered), called=int(called), completed=int(completed))
+
+        totals = _empty_stats()
+        for counters in departments.values():
+            for key, value in counters.items():
+                totals[key] += value
+        return {'day': day, 'departments': departments, 'totals': totals}
+
+    def rebuild(self, cursor):
+        """Recompute every counter from the patient tables (reconciliation)"""
+        ph = self.sql['placeholder']
+        gauges = {}
+        cursor.execute('''
+            SELECT department, status, COUNT(*) FROM patients
+            WHERE status IN ('Waiting', 'In Consultation')
+            GROUP BY department, status
+        ''')
+        for row in cursor.fetchall():
+            department, status, count = row_values(row, 3)
+            gauge = gauges.setdefault(department, [0, 0])
+            gauge[0 if status == 'Waiting' else 1] = int(count)
+
+        daily = {}
+        for table in ('patients', 'patients_history'):
+            for column, slot in (('time_in', 0), ('time_called', 1), ('time_out', 2)):
+                day = self.sql['day'].format(column=column)
+                cursor.execute(f'''
+                    SELECT {day}, department, COUNT(*) FROM {table}
+                    WHERE {column} IS NOT NULL
+                    GROUP BY {day}, department
+                ''')
+                for row in cursor.fetchall():
+                    day, department, count = row_values(row, 3)
+                    counts = daily.setdefault((day_of(day), department), [0, 0, 0])
+                    counts[slot] += int(count)
+
+        cursor.execute('DELETE FROM department_stats')
+        cursor.execute('DELETE FROM daily_stats')
+        if gauges:
+            cursor.executemany(
+                f'INSERT INTO department_stats (department, waiting, in_consultation) VALUES ({ph}, {ph}, {ph})',
+                [(department, w, c) for department, (w, c) in gauges.items()])
+        if daily:
+            cursor.executemany(
+                f'INSERT INTO daily_stats (day, department, registered, called, completed) '
+                f'VALUES ({ph}, {ph}, {ph}, {ph}, {ph})',
+                [(day, department) + tuple(counts) for (day, department), counts in daily.items()])
+        return {'departments': len(gauges), 'days': len({day for day, _ in daily})}
+
+
+def _empty_stats():
+    return {'waiting': 0, 'in_consultation': 0, 'registered': 0, 'called': 0, 'completed': 0}
+
+
+def row_values(row, count):
+    """The first `count` columns of a row, positionally
+
+    Plain tuples, sqlite3.Row and MySQL dictionary rows all work.
+    """
+    if isinstance(row, dict):
+        return list(row.values())[:count]
+    return tuple(row)[:count]
@@ -0,0 +1,68 @@
+"""Shared fixtures: each app module imported against a scratch database
+
+SQLite runs use a temporary file. MySQL runs use a dedicated database
+(MYSQL_TEST_DATABASE, default hospital_queue_test) that is dropped first,
+and are skipped when no server is reachable.
+"""
+import importlib
+import os
+import tempfile
+
+import pytest
+
+BACKENDS = {'sqlite': 'app', 'mysql': 'app_mysql'}
+
+
+class BackendUnavailable(Exception):
+    """The backend's database server could not be reached"""
+
+
+def load_app(backend):
+    """Import the backend's app module against a scratch database"""
+    os.environ['ARCHIVE_INTERVAL'] = '0'
+    if backend == 'sqlite':
+        os.environ['HOSPITAL_DB'] = os.path.join(tempfile.mkdtemp(prefix='hospital-test-'), 'test.db')
+    else:
+        os.environ['MYSQL_DATABASE'] = os.environ.get('MYSQL_TEST_DATABASE', 'hospital_queue_test')
+        _drop_mysql_database(os.environ['MYSQL_DATABASE'])
+
+    module = importlib.import_module(BACKENDS[backend])
+    module.create_app(bootstrap=True)
+    try:
+        module.pool.release(module.pool.acquire())
+    except Exception as e:
+        raise BackendUnavailable(f"{backend} backend unavailable: {e}")
+    module.app.config['TESTING'] = True
+    return module
+
+
+def _drop_mysql_database(name):
+    import mysql.connector
+    try:
+        conn = mysql.connector.connect(
+            host=os.environ.get('MYSQL_HOST', 'localhost'),
+            port=int(os.environ.get('MYSQL_PORT', 3306)),
+            user=os.environ.get('MYSQL_USER', 'root'),
+            password=os.environ.get('MYSQL_PASSWORD', ''))
+    except mysql.connector.Error as e:
+        raise BackendUnavailable(f"mysql backend unavailable: {e}")
+    try:
+        conn.cursor().execute(f'DROP DATABASE IF EXISTS `{name}`')
+    finally:
+        conn.close()
+
+
+@pytest.fixture(scope='session')
+def sqlite_app():
+    """app.py against a temporary database file"""
+    return load_app('sqlite')
+
+
+@pytest.fixture(scope='session')
+def mysql_app():
+    """app_mysql.py against a scratch database, or a skip without a server"""
+    pytest.importorskip('mysql.connector')
+    try:
+        return load_app('mysql')
+    except BackendUnavailable as e:
+        pytest.skip(str(e))
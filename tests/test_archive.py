@@ -0,0 +1,65 @@
+"""Archived patients must reach ?since= pollers as removals
+
+A client that keeps merging /api/queue deltas only learns that a patient
+left the patients table through the delta's archived ids.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+OLD_DAYS = 30
+
+
+def add_completed(conn, ph, department, time_in, count):
+    cursor = conn.cursor()
+    cursor.executemany(f'''
+        INSERT INTO patients (token_no, name, department, symptoms, status, time_in, time_out)
+        VALUES ({ph}, {ph}, {ph}, {ph}, 'Completed', {ph}, {ph})
+    ''', [(f'A{i:03d}', f'Patient {i}', department, 'Fever', time_in, time_in) for i in range(count)])
+    # The newest patient row is never archived
+    cursor.execute(f'''
+        INSERT INTO patients (token_no, name, department, symptoms, status, time_in)
+        VALUES ('W001', 'Newest', {ph}, 'Fever', 'Waiting', {ph})
+    ''', (department, time_in))
+    # A client polling from version 0 has nothing to drop, so start above it
+    cursor.execute('UPDATE queue_version SET version = version + 1 WHERE id = 1')
+    cursor.execute(f'SELECT id FROM patients WHERE department = {ph} AND status = {ph}', (department, 'Completed'))
+    ids = sorted(row[0] for row in cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    return ids
+
+
+def poll(module, since):
+    response = module.app.test_client().get(f'/api/queue?since={since}')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def assert_archived_reported(module, ids):
+    before = poll(module, 0)['version']
+    assert module.archiver.run_once() >= len(ids)
+
+    delta = poll(module, before)
+    assert delta['version'] > before
+    assert set(ids) <= set(delta['archived'])
+    assert not set(ids) & {patient['id'] for patient in delta['patients']}
+    # Already reported: a poll from the new version has nothing to drop
+    assert poll(module, delta['version'])['archived'] == []
+
+
+def test_sqlite_delta_reports_archived_patients(sqlite_app):
+    module = sqlite_app
+    conn = module._open_sqlite()
+    old = module.now_ms() - OLD_DAYS * 86400 * 1000
+    ids = add_completed(conn, '?', f'ArchiveTest-{uuid.uuid4().hex[:8]}', old, 5)
+    conn.close()
+    assert_archived_reported(module, ids)
+
+
+def test_mysql_delta_reports_archived_patients(mysql_app):
+    module = mysql_app
+    conn = module.connect_mysql()
+    old = datetime.now().replace(microsecond=0) - timedelta(days=OLD_DAYS)
+    ids = add_completed(conn, '%s', f'ArchiveTest-{uuid.uuid4().hex[:8]}', old, 5)
+    conn.close()
+    assert_archived_reported(module, ids)
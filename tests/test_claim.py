@@ -0,0 +1,110 @@
+"""Concurrent claim_next_patient calls must never hand one patient to two doctors
+
+Every doctor thread keeps calling the next patient on its own connection
+until the queue is empty; each patient must end up claimed exactly once, by
+the doctor recorded on the row. Patients go into a department of their own,
+so other tests' rows in the shared scratch database do not interfere.
+"""
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+PATIENTS = 200
+DOCTORS = 8
+
+
+def add_waiting(conn, ph, department, times):
+    cursor = conn.cursor()
+    cursor.executemany(f'''
+        INSERT INTO patients (token_no, name, department, symptoms, status, time_in)
+        VALUES ({ph}, {ph}, {ph}, {ph}, 'Waiting', {ph})
+    ''', [(f'T{i:03d}', f'Patient {i}', department, 'Fever', time_in) for i, time_in in enumerate(times)])
+    conn.commit()
+    cursor.close()
+
+
+def claim_concurrently(claim_all):
+    """Run claim_all(doctor_id) on DOCTORS threads at once; return {doctor_id: [patient ids]}"""
+    claims = {}
+    start = threading.Barrier(DOCTORS)
+    errors = []
+
+    def doctor(doctor_id):
+        try:
+            start.wait()
+            claims[doctor_id] = claim_all(doctor_id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=doctor, args=(doctor_id,)) for doctor_id in range(1, DOCTORS + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    return claims
+
+
+def assert_claimed_once(claims, rows):
+    claimed = [patient_id for ids in claims.values() for patient_id in ids]
+    assert len(claimed) == len(set(claimed)), 'a patient was claimed twice'
+    assert len(claimed) == PATIENTS
+    owner = {patient_id: doctor_id for doctor_id, ids in claims.items() for patient_id in ids}
+    for row in rows:
+        assert row['status'] == 'In Consultation'
+        assert row['doctor_id'] == owner[row['id']]
+
+
+def test_sqlite_claims_are_exclusive(sqlite_app):
+    module = sqlite_app
+    department = f'ClaimTest-{uuid.uuid4().hex[:8]}'
+    conn = module._open_sqlite()
+    start = module.now_ms()
+    add_waiting(conn, '?', department, [start + i for i in range(PATIENTS)])
+
+    def claim_all(doctor_id):
+        ids = []
+        own = module._open_sqlite()
+        try:
+            while True:
+                patient, version = module.claim_next_patient(own, doctor_id, department)
+                if patient is None:
+                    return ids
+                ids.append(patient['id'])
+        finally:
+            own.close()
+
+    claims = claim_concurrently(claim_all)
+    rows = conn.execute('SELECT id, status, doctor_id FROM patients WHERE department = ?', (department,)).fetchall()
+    conn.close()
+    assert_claimed_once(claims, rows)
+
+
+def test_mysql_claims_are_exclusive(mysql_app):
+    module = mysql_app
+    department = f'ClaimTest-{uuid.uuid4().hex[:8]}'
+    conn = module.connect_mysql()
+    start = datetime.now().replace(microsecond=0)
+    add_waiting(conn, '%s', department, [start + timedelta(seconds=i) for i in range(PATIENTS)])
+
+    def claim_all(doctor_id):
+        ids = []
+        own = module.connect_mysql()
+        cursor = own.cursor(dictionary=True)
+        try:
+            while True:
+                patient, version = module.claim_next_patient(own, cursor, doctor_id, department)
+                if patient is None:
+                    return ids
+                ids.append(patient['id'])
+        finally:
+            cursor.close()
+            own.close()
+
+    claims = claim_concurrently(claim_all)
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute('SELECT id, status, doctor_id FROM patients WHERE department = %s', (department,))
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    assert_claimed_once(claims, rows)
@@ -0,0 +1,47 @@
+"""Wait estimates must not be served stale from a 304 or a ?since= delta"""
+import uuid
+
+from wait_times import WaitEstimator
+
+
+def test_estimate_key_changes_when_a_doctor_goes_idle():
+    estimator = WaitEstimator(default_minutes=10, doctor_window=3600)
+    estimator.called('General', 1, 0)
+    estimator.called('General', 2, 0)
+    assert estimator.estimate('General', 0, now=60) == 300
+    busy = estimator.estimate_key(now=60)
+
+    # No queue write in between, only the clock: doctor 1 leaves the window
+    estimator.called('General', 2, 1800)
+    assert estimator.estimate_key(now=3700) != busy
+    assert estimator.estimate('General', 0, now=3700) == 600
+
+
+def test_sqlite_etag_and_delta_follow_the_estimates(sqlite_app):
+    module = sqlite_app
+    department = f'WaitTest-{uuid.uuid4().hex[:8]}'
+    conn = module._open_sqlite()
+    start = module.now_ms()
+    conn.executemany('''
+        INSERT INTO patients (token_no, name, department, symptoms, status, time_in)
+        VALUES (?, ?, ?, 'Fever', 'Waiting', ?)
+    ''', [(f'T{i:03d}', f'Patient {i}', department, start + i) for i in range(3)])
+    conn.execute('UPDATE queue_version SET version = version + 1 WHERE id = 1')
+    conn.commit()
+    conn.close()
+    module.queue_engine.loaded = False
+    client = module.app.test_client()
+
+    first = client.get('/api/queue')
+    version = int(first.headers['X-Queue-Version'])
+    assert client.get('/api/queue', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    delta = client.get(f'/api/queue?since={version - 1}').get_json()
+    assert delta['wait_minutes_per_patient'][department] == 10
+    assert all('estimated_wait_minutes' not in patient for patient in delta['patients'])
+
+    # A second doctor starts calling: the estimates halve without a queue write
+    module.wait_estimator.called(department, 1, module.now_ms())
+    module.wait_estimator.called(department, 2, module.now_ms())
+    assert client.get('/api/queue', headers={'If-None-Match': first.headers['ETag']}).status_code == 200
+    delta = client.get(f'/api/queue?since={version - 1}').get_json()
+    assert delta['wait_minutes_per_patient'][department] == 5
@@ -0,0 +1,80 @@
+"""Patient time values shared by app.py and app_mysql.py
+
+SQLite stores time_in, time_called, time_out and archived_at as INTEGER
+epoch milliseconds (migration 10 converted the old 'YYYY-MM-DD HH:MM:SS'
+text): they compare and sort as plain integers, range filters and ORDER BY
+walk the indexes without collation work, durations are a subtraction, and
+each value takes at most 8 bytes instead of 19. MySQL keeps its native
+DATETIME columns.
+
+Both backends only turn times into text at the edge - JSON, templates and
+exports - through format_time(). Day and hour boundaries are local time,
+as the text columns were.
+"""
+import time
+from datetime import date, datetime
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Patient columns holding a time
+TIME_COLUMNS = ('time_in', 'time_called', 'time_out', 'archived_at')
+
+
+def now_ms():
+    """Current time as epoch milliseconds"""
+    return time.time_ns() // 1_000_000
+
+
+def to_ms(value):
+    """Epoch milliseconds for epoch ms, a datetime or date, or 'YYYY-MM-DD[ HH:MM:SS]' text
+
+    None (and '') pass through as None.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        return round(value.timestamp() * 1000)
+    if isinstance(value, date):
+        return round(datetime(value.year, value.month, value.day).timestamp() * 1000)
+    text = str(value)
+    if text.isdigit():
+        return int(text)
+    if len(text) == 10:
+        return round(datetime.strptime(text, '%Y-%m-%d').timestamp() * 1000)
+    return round(datetime.strptime(text[:19], TIME_FORMAT).timestamp() * 1000)
+
+
+def to_datetime(value):
+    """Naive local datetime for anything to_ms() accepts"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromtimestamp(to_ms(value) / 1000)
+
+
+def format_time(value):
+    """'YYYY-MM-DD HH:MM:SS' for a stored time, whichever backend it came from"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str) and not value.isdigit():
+        return value[:19]
+    return to_datetime(value).strftime(TIME_FORMAT)
+
+
+def format_times(row):
+    """Copy of a patient row with its time columns formatted, for templates"""
+    row = dict(row)
+    for column in TIME_COLUMNS:
+        if column in row:
+            row[column] = format_time(row[column])
+    return row
+
+
+# Bound-parameter form of a time for each backend's time columns
+DB_TIME = {
+    'sqlite': to_ms,
+    'mysql': to_datetime,
+}
@@ -0,0 +1,134 @@
+"""Per-department token number allocation shared by app.py and app_mysql.py
+
+Token numbers come from the token_sequences table, one counter row per
+department (and per day when daily reset is on). A counter is bumped with a
+single upsert inside the caller's transaction, so the token and the patient
+row that uses it commit or roll back together and two kiosks can never be
+handed the same number.
+"""
+import threading
+from datetime import date
+
+from timestamps import DB_TIME
+
+# Counter key used when tokens never reset
+ALL_TIME = 'all'
+
+SQL = {
+    'sqlite': {
+        'bump': '''
+            INSERT INTO token_sequences (department, period, last_value) VALUES (?, ?, ?)
+            ON CONFLICT(department, period) DO UPDATE SET last_value = last_value + excluded.last_value
+        ''',
+        'read': 'SELECT last_value FROM token_sequences WHERE department = ? AND period = ?',
+        'seed': 'INSERT OR IGNORE INTO token_sequences (department, period, last_value) VALUES (?, ?, ?)',
+        'last_tokens': '''
+            SELECT department, token_no FROM patients
+            WHERE id IN (SELECT MAX(id) FROM patients WHERE time_in >= ? GROUP BY department)
+        ''',
+    },
+    'mysql': {
+        'bump': '''
+            INSERT INTO token_sequences (department, period, last_value) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE last_value = last_value + VALUES(last_value)
+        ''',
+        'read': 'SELECT last_value FROM token_sequences WHERE department = %s AND period = %s',
+        'seed': 'INSERT IGNORE INTO token_sequences (department, period, last_value) VALUES (%s, %s, %s)',
+        'last_tokens': '''
+            SELECT department, token_no FROM patients
+            WHERE id IN (SELECT MAX(id) FROM patients WHERE time_in >= %s GROUP BY department)
+        ''',
+    },
+}
+
+
+def format_token(department, number):
+    """Format token as DEPT-001, DEPT-002, etc."""
+    dept_code = department[:5].upper()
+    return f"{dept_code}-{number:03d}"
+
+
+def parse_token_number(token_no):
+    """Extract number from token (e.g., "CARDIO-001" -> 1), None if malformed"""
+    try:
+        return int(token_no.split('-')[-1])
+    except (ValueError, AttributeError):
+        return None
+
+
+class TokenAllocator:
+    """Hands out token numbers per department
+
+    With block_size > 1 the allocator reserves that many numbers at a time
+    and serves them from memory. A block reservation is committed on its own
+    straight away, so it must be requested before the caller writes anything
+    else in the transaction. Numbers left in a block when the process exits
+    are skipped, never reused.
+    """
+
+    def __init__(self, dialect, daily_reset=False, block_size=1):
+        self.sql = SQL[dialect]
+        self.db_time = DB_TIME[dialect]
+        self.daily_reset = daily_reset
+        self.block_size = max(1, block_size)
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def period(self):
+        """Counter key for the current reset period"""
+        return date.today().isoformat() if self.daily_reset else ALL_TIME
+
+    def allocate(self, conn, department, count=1):
+        """Return a list of `count` fresh token numbers for a department"""
+        key = (department, self.period())
+        if self.block_size == 1:
+            last = self._bump(conn, key, count)
+            return list(range(last - count + 1, last + 1))
+
+        with self._lock:
+            numbers = []
+            while len(numbers) < count:
+                next_num, end = self._blocks.get(key, (1, 0))
+                if next_num > end:
+                    # Blocks from past days are never served again
+                    for stale in [k for k in self._blocks if k[1] != key[1]]:
+                        del self._blocks[stale]
+                    size = max(self.block_size, count - len(numbers))
+                    end = self._bump(conn, key, size)
+                    conn.commit()
+                    next_num = end - size + 1
+                take = min(count - len(numbers), end - next_num + 1)
+                numbers.extend(range(next_num, next_num + take))
+                self._blocks[key] = (next_num + take, end)
+            return numbers
+
+    def next_token(self, conn, department):
+        """Allocate and format a single token for a department"""
+        return format_token(department, self.allocate(conn, department)[0])
+
+    def seed(self, conn):
+        """Create missing counters from the last token issued per department
+
+        Lets an existing patients table switch to counters without restarting
+        every department at 001.
+        """
+        period = self.period()
+        since = self.db_time(date.fromisoformat(period) if self.daily_reset else 0)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self.sql['last_tokens'], (since,))
+            for department, token_no in cursor.fetchall():
+                last_num = parse_token_number(token_no) or 0
+                cursor.execute(self.sql['seed'], (department, period, last_num))
+        finally:
+            cursor.close()
+
+    def _bump(self, conn, key, count):
+        cursor = conn.cursor()
+        try:
+            # The upsert row-locks the counter until the caller commits
+            cursor.execute(self.sql['bump'], (key[0], key[1], count))
+            cursor.execute(self.sql['read'], key)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
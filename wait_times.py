@@ -0,0 +1,190 @@
+"""Streaming wait-time estimates shared by app.py and app_mysql.py
+
+Each department keeps an exponentially weighted moving average (EWMA) of
+consultation length (time_called to time_out), plus the doctors who called
+a patient from it recently. Every call / complete updates these in O(1),
+so nothing scans time_in/time_out history per request; warm_start() seeds
+them from recently completed patients when the app starts.
+
+A waiting patient at 0-based position p in a department with d active
+doctors is estimated to wait (p + 1) * consultation / d: each doctor
+frees up once per consultation, and the patient is called when p + 1
+doctors have done so.
+"""
+import math
+import threading
+import zlib
+from datetime import datetime
+
+from timestamps import to_ms
+
+# Weight of the newest sample in the moving averages
+ALPHA = 0.2
+
+# Consultation length assumed until a department has completed one
+DEFAULT_CONSULTATION_MINUTES = 10.0
+
+# A doctor counts as working in a department for this long after a call
+DOCTOR_WINDOW = 3600
+
+# Completed patients read at startup to warm the averages
+WARM_START_ROWS = 500
+
+
+def to_seconds(value):
+    """Epoch seconds for a stored time: epoch ms, datetime or text (None passes through)"""
+    ms = to_ms(value)
+    return None if ms is None else ms / 1000
+
+
+def _ewma(average, sample, alpha):
+    return sample if average is None else average + alpha * (sample - average)
+
+
+class _Department:
+    __slots__ = ('consultation', 'doctors', 'samples')
+
+    def __init__(self):
+        self.consultation = None
+        self.doctors = {}
+        self.samples = 0
+
+
+class WaitEstimator:
+    """Per-department moving averages and the wait estimates built on them"""
+
+    def __init__(self, alpha=ALPHA, default_minutes=DEFAULT_CONSULTATION_MINUTES,
+                 doctor_window=DOCTOR_WINDOW):
+        self.alpha = alpha
+        self.default_seconds = default_minutes * 60
+        self.doctor_window = doctor_window
+        self._departments = {}
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self.warmed = False
+
+    def _department(self, name):
+        department = self._departments.get(name)
+        if department is None:
+            department = self._departments[name] = _Department()
+        return department
+
+    def observe(self, event, row):
+        """Feed one committed change (called or completed patient rows; others are ignored)"""
+        if event == 'called':
+            self.called(row['department'], row['doctor_id'], row['time_called'])
+        elif event == 'completed':
+            self.completed(row['department'], row['time_called'], row['time_out'])
+
+    def called(self, department, doctor_id, time_called):
+        if doctor_id is None:
+            return
+        at = to_seconds(time_called)
+        with self._lock:
+            self._department(department).doctors[doctor_id] = at
+
+    def completed(self, department, time_called, time_out):
+        started, finished = to_seconds(time_called), to_seconds(time_out)
+        with self._lock:
+            stats = self._department(department)
+            # Rows completed before doctors claimed patients have no call time
+            if started is not None and finished is not None and finished >= started:
+                stats.consultation = _ewma(stats.consultation, finished - started, self.alpha)
+                stats.samples += 1
+
+    def warm_start(self, rows):
+        """Seed the averages from completed patient rows (any order)
+
+        Rows need department, doctor_id, time_called and time_out.
+        """
+        rows = list(rows)
+        for row in sorted(rows, key=lambda r: to_seconds(r['time_out']) or 0):
+            self.called(row['department'], row['doctor_id'], row['time_called'])
+            self.completed(row['department'], row['time_called'], row['time_out'])
+        return len(rows)
+
+    def ensure_warm(self, fetch_recent):
+        """Warm-start once, using fetch_recent() to read recently completed rows"""
+        if self.warmed:
+            return
+        with self._warm_lock:
+            if not self.warmed:
+                self.warm_start(fetch_recent())
+                self.warmed = True
+
+    def _active_doctors(self, stats, now):
+        cutoff = now - self.doctor_window
+        return sum(1 for called_at in stats.doctors.values() if called_at is not None and called_at >= cutoff)
+
+    def seconds_per_patient(self, department, now=None):
+        """Seconds each place in line adds to a department's wait (consultation / active doctors)"""
+        now = datetime.now().timestamp() if now is None else now
+        with self._lock:
+            stats = self._departments.get(department)
+            consultation = stats.consultation if stats and stats.consultation else self.default_seconds
+            doctors = max(1, self._active_doctors(stats, now)) if stats else 1
+        return consultation / doctors
+
+    def estimate(self, department, position, now=None):
+        """Estimated seconds until the patient at 0-based `position` is called"""
+        return (position + 1) * self.seconds_per_patient(department, now)
+
+    def estimate_key(self, now=None):
+        """Checksum of what the estimates depend on besides positions
+
+        Changes when a consultation average moves or a doctor leaves the
+        active window, neither of which necessarily bumps the queue version.
+        """
+        now = datetime.now().timestamp() if now is None else now
+        with self._lock:
+            inputs = [(name, stats.consultation, self._active_doctors(stats, now))
+                      for name, stats in sorted(self._departments.items())]
+        return zlib.crc32(repr(inputs).encode())
+
+    def estimate_minutes(self, department, position, now=None):
+        return math.ceil(self.estimate(department, position, now) / 60)
+
+    def snapshot(self, now=None):
+        """Current averages per department, in minutes"""
+        now = datetime.now().timestamp() if now is None else now
+        with self._lock:
+            result = {}
+            for name, stats in sorted(self._departments.items()):
+                result[name] = {
+                    'consultation_minutes': round(stats.consultation / 60, 1) if stats.consultation else None,
+                    'active_doctors': self._active_doctors(stats, now),
+                    'samples': stats.samples,
+                }
+            return result
+
+
+def wait_encoder(encode, engine, estimator):
+    """Wrap a RowCache.encode so waiting rows carry estimated_wait_minutes
+
+    The cached bytes stay shared; the estimate is spliced in front of them
+    per response. Positions come from the in-memory queue engine.
+    """
+    now = datetime.now().timestamp()
+
+    def encode_with_wait(row):
+        encoded = encode(row)
+        if row['status'] != 'Waiting':
+            return encoded
+        position = engine.positions(row['department']).get(row['id'])
+        if position is None:
+            return encoded
+        minutes = estimator.estimate_minutes(row['department'], position, now)
+        return b'{"estimated_wait_minutes":%d,' % minutes + encoded[1:]
+    return encode_with_wait
+
+
+def wait_rates(engine, estimator):
+    """Minutes each place in line adds, for every department with waiting patients
+
+    Sent with ?since= deltas instead of per-row estimates: a call moves every
+    waiting patient in the department up but re-sends only the called row, so
+    clients work out ceil((position + 1) * rate) from the rows they hold.
+    """
+    now = datetime.now().timestamp()
+    return {department: estimator.seconds_per_patient(department, now) / 60
+            for department, count in engine.stats()['waiting'].items() if count}
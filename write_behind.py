@@ -0,0 +1,246 @@
+"""Group-commit write-behind queue for /register, shared by app.py and app_mysql.py
+
+With one commit (and so one fsync) per registration, the morning rush
+serializes on the database write lock. In write-behind mode the route
+allocates the token up front, puts the patient on a bounded in-process
+queue and answers; a background thread takes everything queued within a
+few milliseconds and commits it as one transaction.
+
+Durability:
+- queued: the request returns once the patient is queued. Fastest, but
+  registrations still queued when the process dies are lost.
+- committed: the request waits until the batch holding its patient has
+  committed. Concurrent registrations still share one commit. If that takes
+  longer than commit_timeout, or the patient could not be written, submit()
+  raises WriteFailed.
+
+When the queue is full, submit() either waits up to full_timeout for room
+('wait') or fails straight away ('reject'); both raise QueueFull, which the
+routes turn into a 503. close() drains the queue on shutdown.
+
+A batch that fails with a transient error (is_transient(), e.g. a lost
+connection or a lock timeout) is retried with backoff, up to max_attempts
+times. Any other error means some row can never be written, such as a
+name too long for its column: the batch is then written one patient at a
+time, so only the bad rows fail and the rest of the queue keeps moving.
+"""
+import queue
+import threading
+import time
+
+# Registrations held in memory before submit() applies backpressure
+MAX_PENDING = 1000
+
+# Most registrations written in one transaction
+BATCH_SIZE = 200
+
+# How long the writer lingers after the first queued registration to fill a batch
+FLUSH_INTERVAL = 0.005
+
+DURABILITY_MODES = ('queued', 'committed')
+WHEN_FULL_MODES = ('wait', 'reject')
+
+
+class QueueFull(Exception):
+    """The write-behind queue has no room for another registration"""
+
+
+class WriteFailed(Exception):
+    """A committed-durability registration was not confirmed written"""
+
+
+class Pending:
+    """One queued registration; committed-durability requests wait on it"""
+
+    __slots__ = ('patient', 'done', 'error')
+
+    def __init__(self, patient):
+        self.patient = patient
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self, timeout=None):
+        """Block until the patient's batch is written, raising WriteFailed if it was lost or took too long"""
+        if not self.done.wait(timeout):
+            raise WriteFailed(f"Registration not written within {timeout:g}s")
+        if self.error is not None:
+            raise WriteFailed(f"Registration could not be written: {self.error}") from self.error
+
+
+class WriteBehindQueue:
+    """Bounded registration queue drained in batched transactions
+
+    The writer thread keeps its own connection from `connect()`, so it never
+    competes with the requests it is serving for a pooled one.
+    `flush(conn, patients)` writes and commits a list of patient dicts
+    (token_no and time_in already set) in one transaction, or raises after
+    rolling back. `is_transient(error)` says whether a failure is worth
+    retrying on a new connection; by default every error is.
+    """
+
+    def __init__(self, connect, flush, enabled=False, max_pending=MAX_PENDING, batch_size=BATCH_SIZE,
+                 interval=FLUSH_INTERVAL, durability='queued', when_full='wait', full_timeout=1.0,
+                 drain_timeout=10.0, commit_timeout=5.0, max_attempts=10, is_transient=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"durability must be one of {DURABILITY_MODES}")
+        if when_full not in WHEN_FULL_MODES:
+            raise ValueError(f"when_full must be one of {WHEN_FULL_MODES}")
+        self.connect = connect
+        self.flush = flush
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durability = durability
+        self.when_full = when_full
+        self.full_timeout = full_timeout
+        self.drain_timeout = drain_timeout
+        self.commit_timeout = commit_timeout
+        self.max_attempts = max_attempts
+        self.is_transient = is_transient or (lambda error: True)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._conn = None
+        self._closing = threading.Event()
+        self._drain_deadline = None
+        self.written = 0
+        self.batches = 0
+        self.rejected = 0
+        self.lost = 0
+
+    def start(self):
+        """Start the writer thread (no-op if disabled or already running)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._closing.clear()
+            self._thread = threading.Thread(target=self._run, name='registration-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, patient):
+        """Queue a patient for the next batch; returns its Pending entry
+
+        With committed durability this also waits (up to commit_timeout) for
+        the batch to commit.
+        """
+        if self._closing.is_set():
+            raise QueueFull("Registration queue is shutting down")
+        self.start()
+        pending = Pending(patient)
+        try:
+            if self.when_full == 'wait':
+                self._queue.put(pending, timeout=self.full_timeout)
+            else:
+                self._queue.put_nowait(pending)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull("Registration queue is full") from None
+        if self.durability == 'committed':
+            pending.wait(self.commit_timeout)
+        return pending
+
+    def close(self, timeout=None):
+        """Stop accepting registrations and write out everything queued"""
+        timeout = self.drain_timeout if timeout is None else timeout
+        self._drain_deadline = time.monotonic() + timeout
+        self._closing.set()
+        if self._thread:
+            self._thread.join(timeout)
+        leftover = self._discard_queued(RuntimeError("Registration queue closed before this patient was written"))
+        if leftover:
+            print(f"Write-behind queue closed with {leftover} registrations unwritten")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'durability': self.durability,
+                'pending': self._queue.qsize(),
+                'written': self.written,
+                'batches': self.batches,
+                'rejected': self.rejected,
+                'lost': self.lost,
+            }
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=0.05)
+            except queue.Empty:
+                if self._closing.is_set():
+                    self._disconnect()
+                    return
+                continue
+            batch = [first]
+            # Linger briefly so registrations arriving together share a commit
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0
+                                 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        attempt = 0
+        while True:
+            try:
+                if self._conn is None:
+                    self._conn = self.connect()
+                self.flush(self._conn, [pending.patient for pending in batch])
+                break
+            except Exception as e:
+                attempt += 1
+                print(f"Error writing {len(batch)} queued registrations (attempt {attempt}): {e}")
+                if not self.is_transient(e):
+                    if len(batch) > 1:
+                        # Retrying the batch would fail the same way: find the bad rows
+                        for pending in batch:
+                            self._write([pending])
+                    else:
+                        print(f"Dropping registration {batch[0].patient['token_no']}: {e}")
+                        self._fail(batch, e)
+                    return
+                self._disconnect()
+                if (attempt >= self.max_attempts
+                        or self._closing.is_set() and time.monotonic() >= self._drain_deadline):
+                    print(f"Dropping {len(batch)} queued registrations after {attempt} attempts")
+                    self._fail(batch, e)
+                    return
+                time.sleep(min(1.0, 0.05 * 2 ** attempt))
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+        for pending in batch:
+            pending.done.set()
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _fail(self, batch, error):
+        with self._lock:
+            self.lost += len(batch)
+        for pending in batch:
+            pending.error = error
+            pending.done.set()
+
+    def _discard_queued(self, error):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._fail(batch, error)
+        return len(batch)